@@ -14,6 +14,7 @@ INSTALLED_APPS = [
     'core',
 ]
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,3 +76,56 @@ STATIC_URL = '/static/'
 MINIO_BACKEND = 'http://localhost:9000'
 MINIO_ACCESS_KEY = 'cloudcloud'
 MINIO_SECRET_KEY = 'cloudcloud'
+MIME_CACHE_SIZE = 1024
+DIRMETA_STATS_TIMEOUT = 300
+CLOUD_TREE_BACKEND = 'core.tree.MPTTBackend'
+MINIO_BUCKET = 'cloud'
+OBJECT_STORE_BACKEND = 'core.objectstore.MinioBackend'
+UPLOAD_URL_EXPIRES = 900
+DOWNLOAD_URL_EXPIRES = 300
+UPLOAD_PART_SIZE = 8388608
+UPLOAD_MIN_PART_SIZE = 5242880
+UPLOAD_MAX_PART_SIZE = 5368709120
+UPLOAD_MAX_PARTS = 10000
+UPLOAD_SESSION_EXPIRES = 86400
+ARCHIVE_FETCH_CONCURRENCY = 4
+ARCHIVE_BUFFERED_CHUNKS = 16
+ARCHIVE_CHUNK_SIZE = 65536
+ARCHIVE_BATCH_SIZE = 500
+DOWNLOAD_CHUNK_SIZE = 65536
+DOWNLOAD_MAX_RANGES = 16
+CHANGE_JOURNAL_RETENTION_DAYS = 30
+LISTING_CACHE_BACKEND = 'core.listcache.LocalMemoryListingCache'
+LISTING_CACHE_SIZE = 1024
+DEDUP_INLINE_MAX_SIZE = 67108864
+DEDUP_CHUNK_SIZE = 1048576
+THUMBNAIL_SIZES = (128, 512)
+THUMBNAIL_LEASE = 300
+THUMBNAIL_MAX_ATTEMPTS = 5
+THUMBNAIL_RETRY_DELAY = 30
+THUMBNAIL_RETRY_MAX_DELAY = 3600
+THUMBNAIL_MAX_SOURCE_SIZE = 52428800
+THUMBNAIL_VIDEO_TIMEOUT = 60
+BATCH_MAX_ITEMS = 1000
+BATCH_ASYNC_THRESHOLD = 20000
+BATCH_JOB_LEASE = 3600
+TRASH_RETENTION_DAYS = 30
+TRASH_PURGE_BATCH_SIZE = 500
+OBJECT_DELETE_BATCH_SIZE = 1000
+SEARCH_FUZZY_THRESHOLD = 0.3
+SEARCH_MAX_CANDIDATES = 1000
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = ()
+METRICS_TOKEN = ''
+METRICS_SLOW_REQUEST_SECONDS = 1.0
+METRICS_SLOW_QUERY_LIMIT = 10
+PATH_MAX_LOOKUPS = 100
+OBJECT_STORE_POOL_SIZE = 32
+OBJECT_STORE_CONCURRENCY = 16
+OBJECT_STORE_CONNECT_TIMEOUT = 5
+OBJECT_STORE_READ_TIMEOUT = 60
+OBJECT_STORE_RETRIES = 3
+OBJECT_STORE_RETRY_DELAY = 0.1
+OBJECT_STORE_RETRY_MAX_DELAY = 2
+RECONCILE_BATCH_SIZE = 1000
+RECONCILE_GRACE_SECONDS = 86400
@@ -3,8 +3,10 @@ from django.conf.urls import url, include
 
 # Core
 from core.routers import router
+from core.views import metrics
 
 urlpatterns = [
     url(r'^api/', include(router.urls)),
-    url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework'))
+    url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
+    url(r'^metrics$', metrics, name='metrics'),
 ]
@@ -0,0 +1,81 @@
+# Django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+
+# Core
+from core.models import Profile, Service, provision_storages
+
+# Keeps IN (...) lists below SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+def clean_rows(rows):
+    # Splits CSV rows into accounts to create and (line, reason) pairs for
+    # rows that cannot be imported
+    services = set(str(pk) for pk in Service.objects.values_list('pk', flat=True))
+    languages = set(code for code, name in settings.LANGUAGES)
+    username_length = User._meta.get_field('username').max_length
+    accounts, invalid, seen = [], [], set()
+
+    for line, row in rows:
+        username = (row.get('username') or '').strip()
+        service = (row.get('service') or '').strip()
+        language = (row.get('language') or '').strip()
+
+        if not username or len(username) > username_length:
+            invalid.append((line, 'invalid username'))
+        elif username in seen:
+            invalid.append((line, 'duplicate username'))
+        elif service and service not in services:
+            invalid.append((line, 'unknown service'))
+        elif language and language not in languages:
+            invalid.append((line, 'unknown language'))
+        else:
+            seen.add(username)
+            accounts.append({
+                'username': username,
+                'email': (row.get('email') or '').strip(),
+                'password': row.get('password') or None,
+                'service': int(service) if service else None,
+                'language': language or None,
+            })
+    return accounts, invalid
+
+
+def provision_accounts(accounts, hasher='default'):
+    # Creates users, profiles and their storages with one bulk insert each,
+    # skipping usernames that are taken. Post-save receivers do not run for
+    # bulk inserts, so profiles and storages are created here. Accounts
+    # without a password get an unusable one.
+    created = 0
+    for start in range(0, len(accounts), CHUNK_SIZE):
+        chunk = accounts[start:start + CHUNK_SIZE]
+        with transaction.atomic():
+            taken = set(User.objects.filter(
+                username__in=[account['username'] for account in chunk]).values_list('username', flat=True))
+            chunk = [account for account in chunk if account['username'] not in taken]
+            if not chunk:
+                continue
+
+            User.objects.bulk_create([
+                User(username=account['username'], email=account['email'],
+                     password=make_password(account['password'], hasher=hasher))
+                for account in chunk])
+            ids = dict(User.objects.filter(
+                username__in=[account['username'] for account in chunk]).values_list('username', 'id'))
+
+            profiles = []
+            for account in chunk:
+                profile = Profile(user_id=ids[account['username']])
+                if account['service']:
+                    profile.service_id = account['service']
+                if account['language']:
+                    profile.language = account['language']
+                profiles.append(profile)
+            Profile.objects.bulk_create(profiles)
+
+            provision_storages(list(Profile.objects.filter(user_id__in=list(ids.values()))))
+            created += len(chunk)
+    return created
@@ -0,0 +1,198 @@
+# Django
+from django.conf import settings
+from django.utils import timezone
+
+# Core
+from core.bulk import keyset_iterator
+from core.models import FileMeta
+from core.objectstore import get_object_store, ObjectNotFound
+from core.tree import get_tree_backend
+
+# Misc
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import logging
+import queue
+import threading
+import zipfile
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of an object in a fetch queue
+END = object()
+
+
+class ZipSink(object):
+    # Write-only target for ZipFile. It has no tell() or seek(), so
+    # zipfile writes data descriptors and never goes back into the stream.
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+class ObjectFetcher(object):
+    # Fetches up to `concurrency` objects ahead of the one being written.
+    # Each fetch buffers at most `buffered` chunks, so memory per archive
+    # stays bounded by concurrency * buffered * chunk_size.
+
+    def __init__(self, store, concurrency, buffered, chunk_size):
+        self.store = store
+        self.concurrency = concurrency
+        self.buffered = buffered
+        self.chunk_size = chunk_size
+        self.cancelled = threading.Event()
+
+    def put(self, chunks, item):
+        while not self.cancelled.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch(self, key, chunks):
+        try:
+            stream = self.store.iter_chunks(key, self.chunk_size)
+            try:
+                for chunk in stream:
+                    if not self.put(chunks, chunk):
+                        return
+            finally:
+                stream.close()
+        except Exception as exc:
+            self.put(chunks, exc)
+            return
+        self.put(chunks, END)
+
+    def iterate(self, items, key):
+        # Yields (item, chunk iterator) in the order of `items`
+        window = deque()
+        items = iter(items)
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+
+        def submit():
+            for item in items:
+                chunks = None
+                if key(item) is not None:
+                    chunks = queue.Queue(maxsize=self.buffered)
+                    executor.submit(self.fetch, key(item), chunks)
+                window.append((item, chunks))
+                return
+
+        def drain(chunks):
+            while True:
+                chunk = chunks.get()
+                if chunk is END:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+
+        try:
+            for i in range(self.concurrency):
+                submit()
+            while window:
+                item, chunks = window.popleft()
+                submit()
+                yield item, drain(chunks) if chunks is not None else None
+        finally:
+            self.cancelled.set()
+            executor.shutdown(wait=False)
+
+
+def entry_name(name):
+    return name.replace('/', '_').replace('\\', '_') or '_'
+
+
+def zip_info(name, modified):
+    modified = timezone.localtime(modified) if timezone.is_aware(modified) else modified
+    return zipfile.ZipInfo(name, date_time=max(modified.timetuple()[:6], (1980, 1, 1, 0, 0, 0)))
+
+
+def walk_subtree(dirmeta):
+    # Merges the subtree's directories and files, both listed in the tree
+    # backend's depth-first order, keeping only the current branch in memory.
+    backend = get_tree_backend()
+    batch_size = getattr(settings, 'ARCHIVE_BATCH_SIZE', 500)
+
+    subtree = backend.descendants(dirmeta, include_self=True)
+    dirs = keyset_iterator(subtree, backend.ordering, batch_size)
+    files = keyset_iterator(
+        FileMeta.objects.filter(parent__in=subtree).select_related('parent', 'blob'),
+        ['parent__' + field for field in backend.ordering] + ['name', 'id'],
+        batch_size)
+
+    pending = next(files, None)
+    branch = []
+    for node in dirs:
+        while branch and branch[-1][0] != node.parent_id:
+            branch.pop()
+        prefix = (branch[-1][1] if branch else '') + entry_name(node.name) + '/'
+        branch.append((node.id, prefix))
+        yield prefix, node
+
+        while pending is not None and pending.parent_id == node.id:
+            yield prefix + entry_name(pending.name), pending
+            pending = next(files, None)
+
+
+def stream_archive(dirmeta):
+    return (chunk for chunk in build_archive(dirmeta) if chunk)
+
+
+def build_archive(dirmeta):
+    store = get_object_store()
+    fetcher = ObjectFetcher(
+        store,
+        concurrency=getattr(settings, 'ARCHIVE_FETCH_CONCURRENCY', 4),
+        buffered=getattr(settings, 'ARCHIVE_BUFFERED_CHUNKS', 16),
+        chunk_size=getattr(settings, 'ARCHIVE_CHUNK_SIZE', 65536))
+
+    sink = ZipSink()
+    archive = zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True)
+    entries = fetcher.iterate(
+        walk_subtree(dirmeta),
+        key=lambda entry: entry[1].object_key if isinstance(entry[1], FileMeta) else None)
+
+    try:
+        for (name, node), chunks in entries:
+            info = zip_info(name, node.modified_at)
+            if chunks is None:
+                info.external_attr = 0o40755 << 16 | 0x10
+                archive.writestr(info, b'')
+                yield sink.drain()
+                continue
+
+            try:
+                first = next(chunks, b'')
+            except ObjectNotFound:
+                logger.warning('Object missing from archive of %s: %s', dirmeta.id, node.object_key)
+                continue
+
+            info.file_size = node.size
+            info.external_attr = 0o644 << 16
+            # Writing members as streams needs Python 3.6
+            with archive.open(info, 'w', force_zip64=True) as member:
+                for chunk in itertools.chain([first], chunks):
+                    member.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+
+        archive.close()
+        yield sink.drain()
+    finally:
+        entries.close()
@@ -0,0 +1,402 @@
+# Django
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, When, F, Q, Max, Value, CharField
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+# Core
+from core.bulk import chunked, assign_file_positions
+from core.dedup import adopt_objects, retain_blobs
+from core.journal import record_changes, CHANGE_CREATE, CHANGE_MOVE, CHANGE_DELETE
+from core.models import (
+    DirMeta, FileMeta, BatchJob, enqueue_thumbnails,
+    BATCH_MOVE, BATCH_COPY, BATCH_TRASH, JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_FAILED)
+from core.search import get_search_backend
+from core.stats import subtree_stats, invalidate_tree, invalidate_nodes
+from core.tree import get_tree_backend, node_path
+
+# Misc
+from collections import Counter
+from datetime import timedelta
+import json
+import os
+import time
+import uuid
+
+# Every operation runs in one transaction. Directories cost a constant
+# number of queries each, whatever the size of their subtree; loose files
+# are handled with set-based statements for the whole batch.
+
+
+def select_items(storage, dirs, files):
+    # Locks the selected rows and drops those inside a selected directory,
+    # since they travel with it
+    dirs, files = set(dirs), set(files)
+
+    dirmetas = []
+    for chunk in chunked(dirs):
+        dirmetas.extend(DirMeta.objects.select_for_update().filter(storage=storage, id__in=chunk))
+    filemetas = []
+    for chunk in chunked(files):
+        filemetas.extend(FileMeta.objects.select_for_update().filter(storage=storage, id__in=chunk))
+
+    if len(dirmetas) != len(dirs):
+        raise ValidationError({'dirs': [_('Directory not found.')]})
+    if len(filemetas) != len(files):
+        raise ValidationError({'files': [_('File not found.')]})
+
+    paths = [dirmeta.path for dirmeta in dirmetas]
+    parent_paths = {}
+    for chunk in chunked(set(filemeta.parent_id for filemeta in filemetas if filemeta.parent_id)):
+        parent_paths.update(DirMeta.objects.filter(id__in=chunk).values_list('id', 'path'))
+
+    def covered(path, exact=True):
+        return any(path.startswith(prefix) and (exact or path != prefix) for prefix in paths)
+
+    dirmetas = sorted(
+        (dirmeta for dirmeta in dirmetas if not covered(dirmeta.path, exact=False)),
+        key=lambda dirmeta: dirmeta.path)
+    filemetas = [
+        filemeta for filemeta in filemetas
+        if filemeta.parent_id is None or not covered(parent_paths[filemeta.parent_id])]
+    return dirmetas, filemetas
+
+
+def lock_target(destination, target):
+    if target is None:
+        return None
+    try:
+        return DirMeta.objects.select_for_update().get(pk=target.pk, storage=destination)
+    except DirMeta.DoesNotExist:
+        raise ValidationError({'target': [_('Directory not found.')]})
+
+
+def name_conflicts(destination, target, nodes, moving=True):
+    # Names clashing with other children of the target or with each other;
+    # a node being moved never clashes with itself
+    if not nodes:
+        return set()
+
+    model = type(nodes[0])
+    ids = set(node.id for node in nodes) if moving else set()
+    names = Counter(node.name for node in nodes)
+    conflicts = set(name for name, count in names.items() if count > 1)
+    for chunk in chunked(names):
+        rows = model.objects.filter(storage=destination, parent=target, name__in=chunk).values_list('id', 'name')
+        conflicts.update(name for id, name in rows if id not in ids)
+    return conflicts
+
+
+def check_names(destination, target, dirmetas, filemetas, moving=True):
+    for field, nodes in (('dirs', dirmetas), ('files', filemetas)):
+        conflicts = name_conflicts(destination, target, nodes, moving=moving)
+        if conflicts:
+            raise ValidationError({field: [_('Duplicate names: %s.') % ', '.join(sorted(conflicts))]})
+
+
+def trash_name(node):
+    # Unique within the trash root, keeping a file's extension
+    if isinstance(node, DirMeta):
+        return '{} ({})'.format(node.name, node.id.hex[:8])
+    base, extension = os.path.splitext(node.name)
+    return '{} ({}){}'.format(base, node.id.hex[:8], extension)
+
+
+def parents_of(nodes):
+    ids = set(node.parent_id for node in nodes)
+    parents = list(DirMeta.objects.filter(id__in=ids - {None}))
+    if None in ids:
+        parents.append(None)
+    return parents
+
+
+def move_subtree(storage, dirmeta, target, destination):
+    backend = get_tree_backend()
+    usage = (0, 0, 0)
+    if destination != storage:
+        usage = storage.subtree_usage(dirmeta)
+        subtree = backend.descendants(dirmeta, include_self=True)
+        FileMeta.objects.filter(storage=storage, parent__in=subtree).update(storage=destination)
+        subtree.update(storage=destination)
+
+    # Earlier moves in the batch shifted the nested sets of both nodes
+    dirmeta.refresh_from_db()
+    if target is not None:
+        target.refresh_from_db()
+
+    tree_key = backend.tree_key(dirmeta)
+    backend.move(dirmeta, target)
+    dirmeta.parent = target
+    invalidate_tree(tree_key, backend.tree_key(dirmeta))
+    return usage
+
+
+def transfer(storage, dirmetas, filemetas, target, destination, renames=None, trashed_at=None):
+    renames = renames or {}
+    sources = parents_of(dirmetas + filemetas)
+
+    for dirmeta in dirmetas:
+        if dirmeta.id in renames:
+            dirmeta.name = renames[dirmeta.id]
+            DirMeta.objects.filter(pk=dirmeta.pk).update(name=dirmeta.name)
+
+    size = files = dirs = 0
+    for dirmeta in dirmetas:
+        usage = move_subtree(storage, dirmeta, target, destination)
+        size, files, dirs = size + usage[0], files + usage[1], dirs + usage[2]
+
+    # A plain update, as in Storage.move_filemeta
+    renamed = [filemeta for filemeta in filemetas if filemeta.id in renames]
+    for chunk in chunked(filemetas):
+        changes = {'storage': destination, 'parent': target}
+        chunk_renames = [filemeta for filemeta in renamed if filemeta in chunk]
+        if chunk_renames:
+            changes['name'] = Case(
+                *[When(id=filemeta.id, then=Value(renames[filemeta.id])) for filemeta in chunk_renames],
+                default=F('name'), output_field=CharField())
+        FileMeta.objects.filter(id__in=[filemeta.id for filemeta in chunk]).update(**changes)
+    for filemeta in filemetas:
+        filemeta.storage, filemeta.parent = destination, target
+        filemeta.name = renames.get(filemeta.id, filemeta.name)
+    get_search_backend().index(renamed, replace=True)
+
+    nodes = dirmetas + filemetas
+    for model, items in ((DirMeta, dirmetas), (FileMeta, filemetas)):
+        for chunk in chunked(items):
+            model.objects.filter(id__in=[item.id for item in chunk]).update(trashed_at=trashed_at)
+
+    if destination != storage:
+        size += sum(filemeta.size for filemeta in filemetas)
+        files += len(filemetas)
+        storage.update_usage(size=-size, files=-files, dirs=-dirs)
+        destination.update_usage(size=size, files=files, dirs=dirs)
+        # The destination's clients list moved subtrees from their roots
+        record_changes(storage, CHANGE_DELETE, nodes)
+        record_changes(destination, CHANGE_CREATE, nodes)
+    else:
+        record_changes(storage, CHANGE_MOVE, nodes)
+
+    storage.touch(*sources)
+    destination.touch(target)
+    invalidate_nodes(*[parent for parent in sources + [target] if parent is not None])
+    return {'dirs': len(dirmetas), 'files': len(filemetas)}
+
+
+def move_items(storage, dirs=(), files=(), target=None, destination=None):
+    destination = destination or storage
+
+    with transaction.atomic():
+        dirmetas, filemetas = select_items(storage, dirs, files)
+        target = lock_target(destination, target)
+        check_names(destination, target, dirmetas, filemetas)
+        for dirmeta in dirmetas:
+            get_tree_backend().check_move(dirmeta, target)
+        return transfer(storage, dirmetas, filemetas, target, destination)
+
+
+def trash_items(storage, dirs=(), files=()):
+    # Items land in the root of the owner's trash storage; names already
+    # taken there get the start of the item's id appended.
+    trash = storage.owner.trash_storage()
+
+    with transaction.atomic():
+        dirmetas, filemetas = select_items(storage, dirs, files)
+        renames = {}
+        for nodes in (dirmetas, filemetas):
+            conflicts = name_conflicts(trash, None, nodes)
+            renames.update((node.id, trash_name(node)) for node in nodes if node.name in conflicts)
+        return transfer(storage, dirmetas, filemetas, None, trash, renames=renames, trashed_at=timezone.now())
+
+
+def number_subtree(dirmetas, left):
+    # Assigns nested sets to dirmetas listed depth first, parents first
+    stack = []
+    for dirmeta in dirmetas:
+        while stack and stack[-1].level >= dirmeta.level:
+            stack.pop().rght = left
+            left += 1
+        dirmeta.lft = left
+        left += 1
+        stack.append(dirmeta)
+    while stack:
+        stack.pop().rght = left
+        left += 1
+
+
+def copy_subtree(root, target, destination, tree_id):
+    # Reads the subtree with two queries and builds unsaved copies of its
+    # directories and files. Returns (dirs, files, sources) where sources
+    # are the copied files, in the order of the copies.
+    backend = get_tree_backend()
+    root.refresh_from_db()
+    subtree = backend.descendants(root, include_self=True)
+    originals = list(subtree.order_by(*backend.ordering))
+    sources = list(FileMeta.objects.select_for_update().filter(parent__in=subtree).order_by('id'))
+
+    level = target.level + 1 if target is not None else 0
+    copies = {}
+    dirs = []
+    for original in originals:
+        parent = copies.get(original.parent_id, target) if original.pk != root.pk else target
+        dirmeta = DirMeta(
+            id=uuid.uuid4(), storage=destination, name=original.name, parent=parent,
+            tree_id=tree_id, level=original.level - root.level + level)
+        dirmeta.path = node_path(dirmeta, parent)
+        copies[original.id] = dirmeta
+        dirs.append(dirmeta)
+
+    files = [copy_file(filemeta, copies[filemeta.parent_id], destination) for filemeta in sources]
+    return dirs, files, sources
+
+
+def copy_file(filemeta, parent, destination):
+    return FileMeta(
+        id=uuid.uuid4(), storage=destination, name=filemeta.name, parent=parent, size=filemeta.size,
+        content_type_id=filemeta.content_type_id, category=filemeta.category)
+
+
+def place_subtree(dirs, target):
+    # Appends the copied subtree as the last child of the target, opening
+    # the gap with one UPDATE, or makes it a new tree
+    if target is None:
+        number_subtree(dirs, 1)
+        return
+
+    target.refresh_from_db()
+    width = 2 * len(dirs)
+    number_subtree(dirs, target.rght)
+    if get_tree_backend().nested_sets:
+        DirMeta.objects.filter(tree_id=target.tree_id, rght__gte=target.rght).update(
+            lft=Case(When(lft__gte=target.rght, then=F('lft') + width), default=F('lft')),
+            rght=F('rght') + width)
+    target.rght += width
+
+
+def copy_items(storage, dirs=(), files=(), target=None, destination=None):
+    # Copies share the bytes of their originals through blobs; nothing is
+    # copied in the object store.
+    destination = destination or storage
+
+    with transaction.atomic():
+        dirmetas, filemetas = select_items(storage, dirs, files)
+        target = lock_target(destination, target)
+        check_names(destination, target, dirmetas, filemetas, moving=False)
+
+        size = sum(filemeta.size for filemeta in filemetas) + sum(
+            stats['size'] for stats in subtree_stats(dirmetas, cached=False).values())
+        if not destination.has_space_for(size):
+            raise ValidationError({'size': [_('Storage quota exceeded.')]})
+
+        next_tree_id = DirMeta.objects.aggregate(tree_id=Max('tree_id'))['tree_id'] or 0
+        created_dirs, created_files, sources = [], [], list(filemetas)
+        for dirmeta in dirmetas:
+            if target is None:
+                next_tree_id += 1
+            subtree_dirs, subtree_files, subtree_sources = copy_subtree(
+                dirmeta, target, destination, target.tree_id if target is not None else next_tree_id)
+            place_subtree(subtree_dirs, target)
+            created_dirs.extend(subtree_dirs)
+            created_files.extend(subtree_files)
+            sources.extend(subtree_sources)
+        created_files = [copy_file(filemeta, target, destination) for filemeta in filemetas] + created_files
+
+        adopt_objects(sources)
+        for filemeta, source in zip(created_files, sources):
+            filemeta.blob_id = source.blob_id
+        retain_blobs([filemeta.blob_id for filemeta in created_files])
+
+        assign_file_positions(created_files)
+        DirMeta.objects.bulk_create(created_dirs)
+        FileMeta.objects.bulk_create(created_files)
+        get_search_backend().index(created_files)
+
+        destination.update_usage(size=size, files=len(created_files), dirs=len(created_dirs))
+        record_changes(destination, CHANGE_CREATE, created_dirs + created_files)
+        enqueue_thumbnails(created_files)
+        destination.touch(target)
+        if target is not None:
+            invalidate_nodes(target)
+
+    return {'dirs': len(created_dirs), 'files': len(created_files)}
+
+
+OPERATIONS = {
+    BATCH_MOVE: move_items,
+    BATCH_COPY: copy_items,
+    BATCH_TRASH: trash_items,
+}
+
+
+def parse_payload(storage, payload):
+    kwargs = {
+        'dirs': [uuid.UUID(str(id)) for id in payload.get('dirs', [])],
+        'files': [uuid.UUID(str(id)) for id in payload.get('files', [])],
+    }
+
+    target = payload.get('target', None)
+    if target:
+        kwargs['target'] = DirMeta.objects.filter(id=uuid.UUID(str(target)), storage=storage).first()
+        if kwargs['target'] is None:
+            raise ValidationError({'target': [_('Directory not found.')]})
+    return kwargs
+
+
+def run_batch(storage, operation, payload):
+    if operation == BATCH_TRASH:
+        payload = dict(payload, target=None)
+    return OPERATIONS[operation](storage, **parse_payload(storage, payload))
+
+
+def estimate_rows(storage, payload):
+    # Rows touched by a batch, from cached subtree stats
+    dirmetas = list(DirMeta.objects.filter(storage=storage, id__in=payload.get('dirs', [])))
+    stats = subtree_stats(dirmetas).values()
+    return len(payload.get('files', [])) + sum(item['files'] + item['dirs'] + 1 for item in stats)
+
+
+def enqueue_batch(storage, operation, payload):
+    target = payload.get('target', None)
+    return BatchJob.objects.create(storage=storage, operation=operation, payload=json.dumps({
+        'dirs': [str(id) for id in payload.get('dirs', [])],
+        'files': [str(id) for id in payload.get('files', [])],
+        'target': str(target) if target else None,
+    }))
+
+
+def claim_batch_job():
+    # Jobs whose worker died are retried once their lease runs out; the
+    # operation itself is atomic, so a retry never sees a half-done batch.
+    # A claim only succeeds if the row is still due when it is updated.
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.BATCH_JOB_LEASE)
+    due = Q(status=JOB_PENDING) | Q(status=JOB_RUNNING, started_at__lt=stale)
+    for job in BatchJob.objects.filter(due).select_related('storage').order_by('created_at')[:10]:
+        if BatchJob.objects.filter(due, pk=job.pk).update(status=JOB_RUNNING, started_at=now) == 1:
+            job.status, job.started_at = JOB_RUNNING, now
+            return job
+    return None
+
+
+def finish_batch_job(job, **fields):
+    # A worker that outlived its lease no longer owns the job
+    return BatchJob.objects.filter(pk=job.pk, status=JOB_RUNNING, started_at=job.started_at).update(
+        finished_at=timezone.now(), **fields) == 1
+
+
+def run_batch_job(job):
+    started = time.time()
+    try:
+        result = run_batch(job.storage, job.operation, json.loads(job.payload))
+    except ValidationError as exc:
+        errors = exc.message_dict if hasattr(exc, 'error_dict') else {'detail': exc.messages}
+        finish_batch_job(job, status=JOB_FAILED, error=json.dumps(errors))
+        return False
+    except Exception as exc:
+        finish_batch_job(job, status=JOB_FAILED, error=json.dumps({'detail': [str(exc)]}))
+        raise
+
+    result['seconds'] = round(time.time() - started, 3)
+    finish_batch_job(job, status=JOB_DONE, result=json.dumps(result))
+    return True
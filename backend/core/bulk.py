@@ -0,0 +1,329 @@
+# Django
+from django.db import transaction
+from django.db.models import Case, When, F, Q, Max
+from django.core.exceptions import ValidationError
+from django.utils.translation import ugettext_lazy as _
+
+# Core
+from core.journal import record_changes, CHANGE_CREATE
+from core.mimecache import mime_cache, file_extension, guess_mime_type
+from core.models import DirMeta, FileMeta, MimeContentType, content_category, enqueue_thumbnails
+from core.search import get_search_backend
+from core.stats import invalidate_tree
+from core.tree import get_tree_backend, node_path
+
+# Misc
+import time
+
+# Keeps IN (...) lists below SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+def chunked(items, size=CHUNK_SIZE):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def field_value(instance, field):
+    for name in field.split('__'):
+        instance = getattr(instance, name)
+    return instance
+
+
+def keyset_iterator(queryset, fields, batch_size=CHUNK_SIZE):
+    # Walks a queryset in batches keyed on a unique ordering, so memory and
+    # query cost stay flat however large the result is.
+    queryset = queryset.order_by(*fields)
+    last = None
+
+    while True:
+        batch = queryset
+        if last is not None:
+            query = Q()
+            for index, field in enumerate(fields):
+                step = Q(**{field + '__gt': last[index]})
+                for previous, value in zip(fields[:index], last):
+                    step &= Q(**{previous: value})
+                query |= step
+            batch = batch.filter(query)
+
+        rows = list(batch[:batch_size])
+        for row in rows:
+            yield row
+        if len(rows) < batch_size:
+            return
+        last = [field_value(rows[-1], field) for field in fields]
+
+
+class Node(object):
+    __slots__ = ('name', 'dirs', 'files', 'instance')
+
+    def __init__(self, name, instance=None):
+        self.name = name
+        self.dirs = {}
+        self.files = {}
+        self.instance = instance
+
+
+def parse_entry(entry):
+    try:
+        path = entry['path']
+        segments = [segment for segment in path.split('/') if segment not in ('', '.')]
+    except (KeyError, TypeError, AttributeError):
+        raise ValidationError(_('Invalid manifest entry.'))
+
+    if not segments or '..' in segments or any(len(segment) > 4096 for segment in segments):
+        raise ValidationError(_('Invalid manifest path.'))
+
+    kind = entry.get('type', 'file' if 'size' in entry else 'dir')
+    if kind == 'dir':
+        return segments, None
+
+    try:
+        size = int(entry['size'])
+    except (KeyError, TypeError, ValueError):
+        raise ValidationError(_('Invalid manifest file size.'))
+
+    if kind != 'file' or size < 0:
+        raise ValidationError(_('Invalid manifest entry.'))
+
+    return segments, size
+
+
+def build_tree(entries):
+    root = Node(None)
+    entries_read = skipped = 0
+
+    for entry in entries:
+        segments, size = parse_entry(entry)
+        entries_read += 1
+
+        node = root
+        dirs = segments if size is None else segments[:-1]
+        for segment in dirs:
+            node = node.dirs.setdefault(segment, Node(segment))
+
+        if size is not None:
+            if segments[-1] in node.files:
+                skipped += 1
+            node.files[segments[-1]] = size
+
+    return root, entries_read, skipped
+
+
+def parent_filter(instances):
+    ids = [instance.id for instance in instances if instance is not None]
+    query = Q(parent__in=ids)
+    if len(ids) < len(instances):
+        query |= Q(parent__isnull=True)
+    return query
+
+
+def resolve_existing(storage, root):
+    # Walk the manifest level by level, matching it against existing
+    # directories with one query per depth instead of one per node.
+    existing = []
+    level = [root]
+
+    while level:
+        existing.extend(level)
+        names = set(name for node in level for name in node.dirs)
+        found = {}
+        for chunk in chunked(names):
+            queryset = DirMeta.objects.select_for_update().filter(
+                parent_filter([node.instance for node in level]),
+                storage=storage, name__in=chunk)
+            for dirmeta in queryset:
+                found[(dirmeta.parent_id, dirmeta.name)] = dirmeta
+
+        next_level = []
+        for node in level:
+            parent_id = node.instance.id if node.instance else None
+            for name, child in sorted(node.dirs.items(), key=lambda item: item[0]):
+                child.instance = found.get((parent_id, name))
+                if child.instance is not None:
+                    next_level.append(child)
+        level = next_level
+
+    return existing
+
+
+def drop_existing_files(storage, existing):
+    nodes = dict(((node.instance.id if node.instance else None), node) for node in existing if node.files)
+    names = set(name for node in nodes.values() for name in node.files)
+    skipped = 0
+
+    for chunk in chunked(names):
+        queryset = FileMeta.objects.filter(
+            parent_filter([node.instance for node in nodes.values()]),
+            storage=storage, name__in=chunk).values_list('parent', 'name')
+        for parent_id, name in queryset:
+            node = nodes.get(parent_id)
+            if node is not None and node.files.pop(name, None) is not None:
+                skipped += 1
+
+    return skipped
+
+
+def assign_subtree(storage, node, parent, tree_id, left, level, created):
+    node.instance = DirMeta(
+        storage=storage, name=node.name, parent=parent,
+        tree_id=tree_id, lft=left, level=level)
+    node.instance.path = node_path(node.instance, parent)
+    created.append(node.instance)
+
+    right = left + 1
+    for name in sorted(node.dirs):
+        right = assign_subtree(storage, node.dirs[name], node.instance, tree_id, right, level + 1, created) + 1
+
+    node.instance.rght = right
+    return right
+
+
+def create_dirs(storage, existing):
+    created = []
+    roots = []
+    insertions = {}
+
+    for node in existing:
+        new = [node.dirs[name] for name in sorted(node.dirs) if node.dirs[name].instance is None]
+        if not new:
+            continue
+        if node.instance is None:
+            roots.extend(new)
+        else:
+            insertions.setdefault(node.instance.tree_id, []).append((node.instance, new))
+
+    # New subtrees are appended after their existing siblings. Positions
+    # are computed in final coordinates, then one gap is opened per
+    # insertion point, rightmost first so no gap is shifted twice.
+    for tree_id, points in insertions.items():
+        points.sort(key=lambda point: point[0].rght)
+        widths = []
+        offset = 0
+        for dirmeta, new in points:
+            left = dirmeta.rght + offset
+            for node in new:
+                left = assign_subtree(storage, node, dirmeta, tree_id, left, dirmeta.level + 1, created) + 1
+            widths.append(left - dirmeta.rght - offset)
+            offset += widths[-1]
+
+        if not get_tree_backend().nested_sets:
+            continue
+
+        for (dirmeta, new), width in reversed(list(zip(points, widths))):
+            DirMeta.objects.filter(tree_id=tree_id, rght__gte=dirmeta.rght).update(
+                lft=Case(When(lft__gte=dirmeta.rght, then=F('lft') + width), default=F('lft')),
+                rght=F('rght') + width)
+
+    if roots:
+        tree_id = DirMeta.objects.aggregate(tree_id=Max('tree_id'))['tree_id'] or 0
+        for node in roots:
+            tree_id += 1
+            assign_subtree(storage, node, None, tree_id, 1, 0, created)
+
+    DirMeta.objects.bulk_create(created)
+    return created
+
+
+def resolve_content_types(files):
+    extensions = set(file_extension(name) for node, name, size in files)
+
+    content_types = {}
+    for chunk in chunked(extensions):
+        content_types.update(mime_cache.get_many(chunk))
+
+    missing = [
+        MimeContentType(name=guess_mime_type(extension), extension=extension)
+        for extension in extensions if extension not in content_types]
+    MimeContentType.objects.bulk_create(missing)
+
+    # bulk_create skips post_save, so drop the negative entries by hand
+    for content_type in missing:
+        mime_cache.changed(content_type.extension)
+        content_types[content_type.extension] = content_type
+
+    return content_types
+
+
+def assign_file_positions(filemetas):
+    # File nodes are always leaves of their parent's tree, so they are
+    # appended after the rightmost file of that tree without any shifting.
+    tree_ids = set(filemeta.parent.tree_id for filemeta in filemetas if filemeta.parent is not None)
+    rights = {}
+    for chunk in chunked(tree_ids):
+        queryset = FileMeta.objects.filter(tree_id__in=chunk).order_by().values('tree_id').annotate(right=Max('rght'))
+        rights.update((row['tree_id'], row['right']) for row in queryset)
+    next_tree_id = FileMeta.objects.aggregate(tree_id=Max('tree_id'))['tree_id'] or 0
+
+    for filemeta in filemetas:
+        parent = filemeta.parent
+        if parent is None:
+            next_tree_id += 1
+            filemeta.tree_id, filemeta.lft, filemeta.rght, filemeta.level = next_tree_id, 1, 2, 0
+        else:
+            left = rights.get(parent.tree_id, 0) + 1
+            rights[parent.tree_id] = left + 1
+            filemeta.tree_id, filemeta.lft, filemeta.rght = parent.tree_id, left, left + 1
+            filemeta.level = parent.level + 1
+
+
+def create_files(storage, existing):
+    files = []
+    matched = set(existing)
+    pending = list(existing)
+    while pending:
+        node = pending.pop()
+        files.extend((node, name, size) for name, size in sorted(node.files.items()))
+        # Popped in name order, so positions don't depend on the manifest's
+        pending.extend(node.dirs[name] for name in sorted(node.dirs, reverse=True) if node.dirs[name] not in matched)
+
+    content_types = resolve_content_types(files)
+
+    created = []
+    for node, name, size in files:
+        content_type = content_types.get(file_extension(name))
+        created.append(FileMeta(
+            storage=storage, name=name, parent=node.instance, size=size,
+            content_type=content_type, category=content_category(content_type.name)))
+
+    assign_file_positions(created)
+    FileMeta.objects.bulk_create(created)
+    get_search_backend().index(created)
+    return created
+
+
+def import_tree(storage, entries, parent=None):
+    started = time.time()
+    root, entries_read, skipped = build_tree(entries)
+
+    with transaction.atomic():
+        if parent is not None:
+            root.instance = DirMeta.objects.select_for_update().get(pk=parent.pk, storage=storage)
+        existing = resolve_existing(storage, root)
+        skipped += drop_existing_files(storage, existing)
+        dirs = create_dirs(storage, existing)
+        files = create_files(storage, existing)
+        storage.update_usage(
+            size=sum(filemeta.size for filemeta in files),
+            files=len(files),
+            dirs=len(dirs))
+        record_changes(storage, CHANGE_CREATE, dirs + files)
+        enqueue_thumbnails(files)
+        created = set(dirmeta.id for dirmeta in dirs)
+        storage.touch(*[
+            node.instance for node in existing
+            if node.files or any(child.instance.id in created for child in node.dirs.values())])
+        backend = get_tree_backend()
+        invalidate_tree(*[backend.tree_key(node.instance) for node in existing if node.instance is not None])
+
+    seconds = time.time() - started
+    return {
+        'entries': entries_read,
+        'dirs': len(dirs),
+        'files': len(files),
+        'skipped': skipped,
+        'seconds': round(seconds, 3),
+        'rows_per_second': int((len(dirs) + len(files)) / seconds) if seconds else 0,
+    }
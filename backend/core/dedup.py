@@ -0,0 +1,162 @@
+# Django
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, When, Value, Count, F, IntegerField
+
+# Core
+from core.objectstore import get_object_store, ObjectNotFound
+
+# Misc
+from collections import Counter
+import hashlib
+import itertools
+
+# Shared blobs do not change accounting: every FileMeta keeps its full
+# size and counts it against its own storage, so quota never depends on
+# what other users happen to store. Deduplication only saves object store
+# space.
+
+CHUNK_SIZE = 500
+
+# Digest of blobs adopting a file's own object rather than hashed content
+ADOPTED_PREFIX = 'object:'
+
+
+def object_digest(key):
+    digest = hashlib.sha256()
+    for chunk in get_object_store().iter_chunks(key, settings.DEDUP_CHUNK_SIZE):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_blob(filemeta, digest):
+    # Points the file at the blob holding `digest`, creating the blob from
+    # the file's own object when it is the first copy. Returns True when
+    # the file turned out to be a duplicate.
+    Blob = apps.get_model('core', 'Blob')
+    FileMeta = apps.get_model('core', 'FileMeta')
+
+    with transaction.atomic():
+        filemeta = FileMeta.objects.select_for_update().filter(pk=filemeta.pk, blob__isnull=True).first()
+        if filemeta is None:
+            return False
+
+        key = filemeta.object_key
+        blob = Blob.objects.select_for_update().filter(digest=digest).first()
+        if blob is None:
+            blob = Blob.objects.create(digest=digest, key=key, size=filemeta.size, refcount=1)
+        else:
+            Blob.objects.filter(pk=blob.pk).update(refcount=F('refcount') + 1)
+        FileMeta.objects.filter(pk=filemeta.pk).update(blob=blob)
+
+    if blob.key == key:
+        return False
+
+    get_object_store().delete(key)
+    return True
+
+
+def deduplicate(filemeta):
+    try:
+        digest = object_digest(filemeta.object_key)
+    except ObjectNotFound:
+        return False
+    return link_blob(filemeta, digest)
+
+
+def deduplicate_upload(filemeta):
+    # Large uploads are left to the backfill rather than hashed in the request
+    if filemeta.size > settings.DEDUP_INLINE_MAX_SIZE:
+        return False
+    return deduplicate(filemeta)
+
+
+def change_refcounts(counts, sign):
+    # Blobs changing by the same number of references share one UPDATE
+    Blob = apps.get_model('core', 'Blob')
+
+    groups = {}
+    for blob_id, count in counts.items():
+        groups.setdefault(count, []).append(blob_id)
+
+    for count, ids in groups.items():
+        for start in range(0, len(ids), CHUNK_SIZE):
+            Blob.objects.filter(id__in=ids[start:start + CHUNK_SIZE]).update(refcount=F('refcount') + sign * count)
+
+
+def release_blobs(filemetas):
+    # Drops one reference per file; blobs reaching zero are left for
+    # collect_blobs.
+    rows = filemetas.filter(blob__isnull=False).order_by().values('blob').annotate(count=Count('id'))
+    change_refcounts(dict((row['blob'], row['count']) for row in rows), -1)
+
+
+def release_objects(filemetas):
+    # Everything deleting file rows goes through here, in the transaction
+    # deleting them: shared blobs lose a reference, and the objects of
+    # files without a blob get a tombstone so flush_tombstones deletes them.
+    ObjectTombstone = apps.get_model('core', 'ObjectTombstone')
+    release_blobs(filemetas)
+
+    # A file without a blob stores its bytes under its own id
+    ids = filemetas.filter(blob__isnull=True).order_by().values_list('id', flat=True).iterator()
+    while True:
+        chunk = list(itertools.islice(ids, CHUNK_SIZE))
+        if not chunk:
+            return
+        ObjectTombstone.objects.bulk_create([ObjectTombstone(key=id.hex) for id in chunk])
+
+
+def retain_blobs(blob_ids):
+    # Adds one reference per occurrence of a blob id
+    change_refcounts(Counter(blob_ids), 1)
+
+
+def adopt_objects(filemetas):
+    # Gives each file without a blob one that owns its existing object, so
+    # copies can share the bytes without hashing or copying them. The
+    # backfill only hashes files without a blob, so adopted objects are
+    # never merged with identical content; callers must hold row locks.
+    Blob = apps.get_model('core', 'Blob')
+    FileMeta = apps.get_model('core', 'FileMeta')
+
+    filemetas = [filemeta for filemeta in filemetas if filemeta.blob_id is None]
+    for start in range(0, len(filemetas), CHUNK_SIZE):
+        chunk = filemetas[start:start + CHUNK_SIZE]
+        digests = dict((ADOPTED_PREFIX + filemeta.id.hex, filemeta) for filemeta in chunk)
+        Blob.objects.bulk_create([
+            Blob(digest=digest, key=filemeta.object_key, size=filemeta.size, refcount=1)
+            for digest, filemeta in digests.items()])
+
+        for digest, blob_id in Blob.objects.filter(digest__in=list(digests)).values_list('digest', 'id'):
+            digests[digest].blob_id = blob_id
+        FileMeta.objects.filter(id__in=[filemeta.id for filemeta in chunk]).update(blob=Case(
+            *[When(id=filemeta.id, then=Value(filemeta.blob_id)) for filemeta in chunk],
+            output_field=IntegerField()))
+
+
+def collect_blobs(batch_size=CHUNK_SIZE):
+    Blob = apps.get_model('core', 'Blob')
+    FileMeta = apps.get_model('core', 'FileMeta')
+    store = get_object_store()
+    collected = 0
+
+    last_id = 0
+
+    while True:
+        with transaction.atomic():
+            blobs = list(Blob.objects.select_for_update().filter(
+                refcount__lte=0, id__gt=last_id).order_by('id')[:batch_size])
+            if not blobs:
+                return collected
+            last_id = blobs[-1].id
+
+            # A drifted refcount must never free bytes still in use
+            used = set(FileMeta.objects.filter(blob__in=blobs).values_list('blob', flat=True))
+            blobs = [blob for blob in blobs if blob.id not in used]
+            Blob.objects.filter(id__in=[blob.id for blob in blobs]).delete()
+
+        # Rows go first: a crash here leaks objects, never dangling blobs
+        store.delete_many([blob.key for blob in blobs])
+        collected += len(blobs)
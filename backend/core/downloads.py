@@ -0,0 +1,176 @@
+# Django
+from django.conf import settings
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, quote_etag, urlquote
+
+# Core
+from core.mimecache import DEFAULT_MIME_TYPE
+from core.objectstore import get_object_store, ObjectNotFound
+
+# Misc
+import calendar
+import itertools
+import uuid
+
+
+def file_etag(filemeta):
+    # File contents never change under a FileMeta id, so the id and size
+    # identify the exact bytes even after deduplication moves the object
+    return quote_etag('{}-{}'.format(filemeta.id.hex, filemeta.size))
+
+
+def last_modified(filemeta):
+    return calendar.timegm(filemeta.modified_at.utctimetuple())
+
+
+def parse_etag_list(value):
+    etags = []
+    for etag in value.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if etag:
+            etags.append(etag)
+    return etags
+
+
+def not_modified(request, etag, modified):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 7232, 6)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if if_none_match is not None:
+        etags = parse_etag_list(if_none_match)
+        return '*' in etags or etag in etags
+
+    since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return since is not None and modified <= since
+
+
+def range_applies(request, etag, modified):
+    if_range = request.META.get('HTTP_IF_RANGE', None)
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == modified
+
+
+def parse_range(value, size):
+    # Returns sorted, merged (start, end) pairs with inclusive ends, None
+    # when the header should be ignored and [] when nothing is satisfiable.
+    unit, equals, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not equals:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        start, dash, end = spec.strip().partition('-')
+        try:
+            if not dash:
+                return None
+            if not start:
+                length = int(end)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(start)
+                end = int(end) if end else size - 1
+                if start > end:
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > settings.DOWNLOAD_MAX_RANGES:
+        return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def open_stream(chunks):
+    # Starts the fetch before the response is committed, so a missing
+    # object becomes a 404 rather than a truncated 200
+    try:
+        first = next(chunks, b'')
+    except ObjectNotFound:
+        raise Http404()
+    return itertools.chain([first], chunks)
+
+
+def content_range(start, end, size):
+    return 'bytes {}-{}/{}'.format(start, end, size)
+
+
+def stream_ranges(filemeta, ranges, boundary, content_type):
+    store = get_object_store()
+    chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+
+    bodies = [store.iter_range(filemeta.object_key, start, end - start + 1, chunk_size) for start, end in ranges]
+    # Only the first part is opened up front, as for a single range
+    bodies[0] = open_stream(bodies[0])
+    parts = (
+        itertools.chain([part_header(boundary, content_type, content_range(start, end, filemeta.size))], body, [b'\r\n'])
+        for (start, end), body in zip(ranges, bodies))
+    return itertools.chain(itertools.chain.from_iterable(parts), ['--{}--\r\n'.format(boundary).encode('ascii')])
+
+
+def part_header(boundary, content_type, value):
+    return '--{}\r\nContent-Type: {}\r\nContent-Range: {}\r\n\r\n'.format(
+        boundary, content_type, value).encode('ascii')
+
+
+def download_response(request, filemeta):
+    etag = file_etag(filemeta)
+    modified = last_modified(filemeta)
+    content_type = filemeta.content_type.name if filemeta.content_type else DEFAULT_MIME_TYPE
+    size = filemeta.size
+
+    if not_modified(request, etag, modified):
+        response = HttpResponse(status=304)
+    else:
+        ranges = None
+        header = request.META.get('HTTP_RANGE', None)
+        if header and size and range_applies(request, etag, modified):
+            ranges = parse_range(header, size)
+
+        store = get_object_store()
+        chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+        if ranges is None:
+            response = StreamingHttpResponse(
+                open_stream(store.iter_chunks(filemeta.object_key, chunk_size)), content_type=content_type)
+            response['Content-Length'] = size
+        elif not ranges:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            response = StreamingHttpResponse(
+                open_stream(store.iter_range(filemeta.object_key, start, end - start + 1, chunk_size)),
+                status=206, content_type=content_type)
+            response['Content-Range'] = content_range(start, end, size)
+            response['Content-Length'] = end - start + 1
+        else:
+            boundary = uuid.uuid4().hex
+            response = StreamingHttpResponse(
+                stream_ranges(filemeta, ranges, boundary, content_type),
+                status=206, content_type='multipart/byteranges; boundary={}'.format(boundary))
+            response['Content-Length'] = sum(
+                len(part_header(boundary, content_type, content_range(start, end, size))) + end - start + 3
+                for start, end in ranges) + len(boundary) + 6
+
+        if response.status_code != 416:
+            response['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(urlquote(filemeta.name))
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified)
+    return response
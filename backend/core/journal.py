@@ -0,0 +1,155 @@
+# Django
+from django.apps import apps
+from django.db.models import F
+
+# Misc
+from collections import OrderedDict
+
+CHANGE_CREATE = 1
+CHANGE_RENAME = 2
+CHANGE_MOVE = 3
+CHANGE_DELETE = 4
+
+CHANGE_CHOICES = (
+    (CHANGE_CREATE, 'create'),
+    (CHANGE_RENAME, 'rename'),
+    (CHANGE_MOVE, 'move'),
+    (CHANGE_DELETE, 'delete'),
+)
+
+
+def node_kind(node):
+    return 'dir' if node._meta.model_name == 'dirmeta' else 'file'
+
+
+def reserve_sequence(storage, count):
+    # The counter lives on the storage row, so concurrent writers to one
+    # storage queue on its row lock and sequence numbers never repeat.
+    Storage = apps.get_model('core', 'Storage')
+    Storage.objects.filter(pk=storage.pk).update(change_seq=F('change_seq') + count)
+    last = Storage.objects.values_list('change_seq', flat=True).get(pk=storage.pk)
+    return last - count + 1
+
+
+def record_changes(storage, action, nodes):
+    # Must run inside the transaction that makes the change
+    ChangeEntry = apps.get_model('core', 'ChangeEntry')
+    nodes = list(nodes)
+    if not nodes:
+        return
+
+    seq = reserve_sequence(storage, len(nodes))
+    ChangeEntry.objects.bulk_create([
+        ChangeEntry(
+            storage=storage,
+            seq=seq + offset,
+            action=action,
+            kind=node_kind(node),
+            node_id=node.id,
+            parent_id=node.parent_id,
+            name=node.name)
+        for offset, node in enumerate(nodes)])
+
+
+def record_change(storage, action, node):
+    record_changes(storage, action, [node])
+
+
+def current_sequence(storage):
+    Storage = apps.get_model('core', 'Storage')
+    return Storage.objects.values_list('change_seq', flat=True).get(pk=storage.pk)
+
+
+def compact(entries):
+    # Folds a page of entries into one delta per node carrying its latest
+    # state. A node is gone when its last entry deletes it or puts it under
+    # a node that is gone; gone nodes the client may already hold get a
+    # delete, the ones created inside the page disappear. Upserts come
+    # first, each after its parent's, so a client can apply the deltas in
+    # order; deletes follow.
+    nodes = OrderedDict()
+    for entry in entries:
+        previous, created = nodes.get(entry.node_id, (None, entry.action == CHANGE_CREATE))
+        nodes[entry.node_id] = (entry, created)
+
+    def chain(node_id, done):
+        # The node and its ancestors inside the page, up to the first one
+        # already in done; walked without recursion, as pages can hold deep
+        # trees
+        path = []
+        while node_id in nodes and node_id not in done:
+            path.append(node_id)
+            node_id = nodes[node_id][0].parent_id
+        return path, node_id
+
+    gone = {}
+    for node_id in nodes:
+        path, top = chain(node_id, gone)
+        state = gone.get(top, False)
+        for ancestor in reversed(path):
+            state = state or nodes[ancestor][0].action == CHANGE_DELETE
+            gone[ancestor] = state
+
+    upserts = []
+    emitted = set()
+    for node_id in nodes:
+        if gone[node_id]:
+            continue
+        path, top = chain(node_id, emitted)
+        for ancestor in reversed(path):
+            entry = nodes[ancestor][0]
+            emitted.add(ancestor)
+            upserts.append({
+                'seq': entry.seq,
+                'action': 'upsert',
+                'kind': entry.kind,
+                'id': entry.node_id,
+                'parent': entry.parent_id,
+                'name': entry.name,
+            })
+
+    deletes = []
+    for node_id, (entry, created) in nodes.items():
+        if gone[node_id] and not created:
+            deletes.append({'seq': entry.seq, 'action': 'delete', 'kind': entry.kind, 'id': node_id})
+
+    return upserts + deletes
+
+
+def changes_since(storage, seq, limit=1000):
+    # Returns (deltas, cursor, more), or None when entries after `seq` were
+    # truncated and the client has to resync from a full listing.
+    ChangeEntry = apps.get_model('core', 'ChangeEntry')
+    Storage = apps.get_model('core', 'Storage')
+
+    floor = Storage.objects.values_list('change_floor', flat=True).get(pk=storage.pk)
+    if seq < floor:
+        return None
+
+    entries = list(ChangeEntry.objects.filter(storage=storage, seq__gt=seq).order_by('seq')[:limit + 1])
+    more = len(entries) > limit
+    entries = entries[:limit]
+
+    return compact(entries), entries[-1].seq if entries else seq, more
+
+
+def truncate(storage, before, batch_size=1000):
+    # Drops entries older than `before` and raises the floor so clients
+    # holding an older cursor are told to resync.
+    ChangeEntry = apps.get_model('core', 'ChangeEntry')
+    Storage = apps.get_model('core', 'Storage')
+
+    last = ChangeEntry.objects.filter(storage=storage, created_at__lt=before).order_by('-seq').values_list(
+        'seq', flat=True).first()
+    if last is None:
+        return 0
+
+    Storage.objects.filter(pk=storage.pk, change_floor__lt=last).update(change_floor=last)
+
+    deleted = 0
+    while True:
+        seqs = list(ChangeEntry.objects.filter(storage=storage, seq__lte=last).order_by('seq').values_list(
+            'seq', flat=True)[:batch_size])
+        if not seqs:
+            return deleted
+        deleted += ChangeEntry.objects.filter(storage=storage, seq__gte=seqs[0], seq__lte=seqs[-1]).delete()[0]
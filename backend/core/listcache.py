@@ -0,0 +1,84 @@
+# Django
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+# Misc
+from collections import OrderedDict
+import hashlib
+import threading
+
+DEFAULT_LISTING_CACHE = 'core.listcache.LocalMemoryListingCache'
+
+CACHES = {}
+
+
+def get_listing_cache():
+    path = getattr(settings, 'LISTING_CACHE_BACKEND', DEFAULT_LISTING_CACHE)
+    if path not in CACHES:
+        CACHES[path] = import_string(path)()
+    return CACHES[path]
+
+
+def listing_key(storage, parent, version, params):
+    # The version moves on every change to the listed directory, so stale
+    # entries are never read again and simply age out.
+    query = '&'.join('{}={}'.format(name, params[name]) for name in sorted(params))
+    return 'listing:{}:{}:{}:{}'.format(
+        storage.id, parent.id.hex if parent else 'root', version,
+        hashlib.md5(query.encode('utf-8')).hexdigest()[:16])
+
+
+class ListingCache(object):
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalMemoryListingCache(ListingCache):
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize or getattr(settings, 'LISTING_CACHE_SIZE', 1024)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key, None)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DjangoListingCache(ListingCache):
+    # Shares listings between processes through a configured Django cache
+
+    def __init__(self):
+        self.cache = caches[getattr(settings, 'LISTING_CACHE_ALIAS', 'default')]
+        self.timeout = getattr(settings, 'LISTING_CACHE_TIMEOUT', 300)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value, self.timeout)
+
+    def clear(self):
+        self.cache.clear()
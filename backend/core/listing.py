@@ -0,0 +1,108 @@
+# Django
+from django.apps import apps
+from django.db import connection
+from django.db.models import Q
+
+# DRF
+from rest_framework import serializers
+
+# Listings are read as row tuples rather than model instances: child
+# counts come from correlated subqueries and MIME names from a join, so a
+# page costs two queries however many entries it holds. Items carry the
+# fields of DirMetaSerializer/FileMetaSerializer, rendered the same way,
+# plus the annotations.
+
+DIR_COLUMNS = ('id', 'storage', 'created_at', 'modified_at', 'name', 'parent', 'dir_count', 'file_count')
+FILE_COLUMNS = ('id', 'storage', 'created_at', 'modified_at', 'name', 'parent', 'content_type', 'size',
+                'content_type__name')
+
+DATETIME = serializers.DateTimeField()
+
+
+def child_counts():
+    DirMeta = apps.get_model('core', 'DirMeta')
+    FileMeta = apps.get_model('core', 'FileMeta')
+    quote = connection.ops.quote_name
+
+    count = 'SELECT COUNT(*) FROM {} child WHERE child.{} = {}.{}'
+    return {
+        'dir_count': count.format(
+            quote(DirMeta._meta.db_table), quote('parent_id'), quote(DirMeta._meta.db_table), quote('id')),
+        'file_count': count.format(
+            quote(FileMeta._meta.db_table), quote('parent_id'), quote(DirMeta._meta.db_table), quote('id')),
+    }
+
+
+def dir_item(row):
+    id, storage, created_at, modified_at, name, parent, dirs, files = row
+    return {
+        'id': str(id),
+        'storage': storage,
+        'created_at': DATETIME.to_representation(created_at),
+        'modified_at': DATETIME.to_representation(modified_at),
+        'name': name,
+        'parent': parent,
+        'dir_count': dirs,
+        'file_count': files,
+        'is_empty': not dirs and not files,
+    }
+
+
+def file_item(row):
+    id, storage, created_at, modified_at, name, parent, content_type, size, mime_type = row
+    return {
+        'id': str(id),
+        'storage': storage,
+        'created_at': DATETIME.to_representation(created_at),
+        'modified_at': DATETIME.to_representation(modified_at),
+        'name': name,
+        'parent': parent,
+        'content_type': content_type,
+        'size': size,
+        'mime_type': mime_type,
+    }
+
+
+def keyset_page(storage, parent, cursor, limit, dirs=None, files=None, key=None):
+    # Directories then files, each ordered by (name, id). The cursor names
+    # the kind, name and id of the last entry served. dirs/files shape the
+    # querysets before slicing, key reads (name, id) back from an entry.
+    DirMeta = apps.get_model('core', 'DirMeta')
+    FileMeta = apps.get_model('core', 'FileMeta')
+    shape = lambda queryset: queryset
+    dirs, files = dirs or shape, files or shape
+    key = key or (lambda entry: (entry.name, entry.id))
+    kind, name, id = cursor if cursor else ('dir', None, None)
+    dir_page, file_page = [], []
+
+    def after(queryset):
+        if name is None:
+            return queryset
+        return queryset.filter(Q(name__gt=name) | Q(name=name, id__gt=id))
+
+    if kind == 'dir':
+        queryset = after(DirMeta.objects.filter(storage=storage, parent=parent)).order_by('name', 'id')
+        dir_page = list(dirs(queryset)[:limit + 1])
+        name = None
+
+    remaining = limit - len(dir_page)
+    if remaining >= 0:
+        queryset = after(FileMeta.objects.filter(storage=storage, parent=parent)).order_by('name', 'id')
+        file_page = list(files(queryset)[:remaining + 1])
+
+    cursor = None
+    if len(dir_page) + len(file_page) > limit:
+        dir_page = dir_page[:limit]
+        file_page = file_page[:limit - len(dir_page)]
+        cursor = ('file', ) + key(file_page[-1]) if file_page else ('dir', ) + key(dir_page[-1])
+
+    return dir_page, file_page, cursor
+
+
+def listing_page(storage, parent=None, cursor=None, limit=100):
+    dirs, files, cursor = keyset_page(
+        storage, parent, cursor, limit,
+        dirs=lambda queryset: queryset.extra(select=child_counts()).values_list(*DIR_COLUMNS),
+        files=lambda queryset: queryset.values_list(*FILE_COLUMNS),
+        key=lambda row: (row[4], row[0]))
+    return [dir_item(row) for row in dirs], [file_item(row) for row in files], cursor
@@ -0,0 +1,32 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Core
+from core.batch import claim_batch_job, run_batch_job
+
+# Misc
+import time
+
+
+class Command(BaseCommand):
+    help = 'Runs queued batch moves, copies and trash operations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--idle-sleep', type=float, default=2.0)
+        parser.add_argument('--once', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        while True:
+            job = claim_batch_job()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['idle_sleep'])
+                continue
+
+            try:
+                done = run_batch_job(job)
+            except Exception as exc:
+                self.stderr.write('{} {} crashed: {}'.format(job.operation, job.id, exc))
+                continue
+            self.stdout.write('{} {} {}.'.format(job.operation, job.id, 'done' if done else 'failed'))
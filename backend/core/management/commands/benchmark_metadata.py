@@ -0,0 +1,203 @@
+# Django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+# Core
+from core.bulk import import_tree
+from core.listing import listing_page
+from core.mimecache import mime_cache
+from core.models import DirMeta, Storage, CATEGORY_DOCUMENT, CATEGORY_IMAGE
+from core.search import get_search_backend, SEARCH_SUBSTRING
+from core.serializers import DirMetaSerializer, FileMetaSerializer
+
+# Misc
+import json
+import math
+import random
+import time
+import uuid
+
+EXTENSIONS = ('jpg', 'pdf', 'mp3', 'mp4', 'txt', 'docx', 'png', 'zip')
+
+LISTING_LIMIT = 1000
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(samples, fraction):
+    # Nearest rank on sorted samples
+    if not samples:
+        return 0.0
+    return samples[max(0, int(math.ceil(fraction * len(samples))) - 1)]
+
+
+def summarize(latencies, queries):
+    latencies = sorted(latencies)
+    seconds = sum(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        'queries_mean': round(sum(queries) / len(queries), 2) if queries else 0.0,
+        'queries_max': max(queries) if queries else 0,
+        'ops_per_second': round(len(latencies) / seconds, 1) if seconds else 0.0,
+    }
+
+
+def model_listing(storage, parent):
+    # The ModelSerializer path, with the folder flags and MIME names read
+    # from the instances
+    page, cursor = storage.browse_page(parent=parent, limit=LISTING_LIMIT)
+    dirs = [item for item in page if isinstance(item, DirMeta)]
+    files = [item for item in page if not isinstance(item, DirMeta)]
+
+    directories = DirMetaSerializer(dirs, many=True).data
+    for dirmeta, item in zip(dirs, directories):
+        item['is_empty'] = dirmeta.is_empty
+    data = FileMetaSerializer(files, many=True).data
+    for filemeta, item in zip(files, data):
+        item['mime_type'] = filemeta.content_type.name if filemeta.content_type_id else None
+    return directories, data
+
+
+def tree_manifest(rng, shape, dirs, files, fanout, depth):
+    # Wide trees give every directory `fanout` children; deep ones chain
+    # directories `depth` levels down before starting a new chain at the
+    # top.
+    paths = ['']
+    for index in range(1, dirs + 1):
+        if shape == 'wide':
+            parent = (index - 1) // fanout
+        else:
+            parent = 0 if (index - 1) % depth == 0 else index - 1
+        paths.append('{}/d{}'.format(paths[parent], index))
+
+    entries = [{'path': path, 'type': 'dir'} for path in paths[1:]]
+    for index in range(files):
+        entries.append({
+            'path': '{}/f{}.{}'.format(rng.choice(paths), index, EXTENSIONS[index % len(EXTENSIONS)]),
+            'size': rng.randint(1, 10485760),
+        })
+    return entries
+
+
+class Command(BaseCommand):
+    help = ('Loads synthetic users and DirMeta/FileMeta trees in bulk, then times the metadata operations '
+            'and writes p50/p95/p99 latencies, query counts and rates as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2)
+        parser.add_argument('--shape', choices=('wide', 'deep'), default='wide')
+        parser.add_argument('--dirs', type=int, default=1000, help='Directories per user.')
+        parser.add_argument('--files', type=int, default=10000, help='Files per user.')
+        parser.add_argument('--fanout', type=int, default=10)
+        parser.add_argument('--depth', type=int, default=50)
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--chunk-size', type=int, default=50000, help='Manifest entries per bulk import.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None, help='JSON file to write; defaults to stdout.')
+        parser.add_argument('--keep', action='store_true', default=False,
+                            help='Keep the generated data instead of rolling it back.')
+
+    def handle(self, *args, **options):
+        report = {}
+        try:
+            with transaction.atomic():
+                report = self.run(options)
+                if not options['keep']:
+                    raise Rollback()
+        except Rollback:
+            # Content types created during the run are gone with it
+            mime_cache.invalidate()
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as handle:
+                handle.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def run(self, options):
+        rng = random.Random(options['seed'])
+        run = uuid.uuid4().hex[:8]
+
+        started = time.time()
+        rows = 0
+        storages = []
+        for index in range(options['users']):
+            user = User.objects.create_user(username='bench-{}-{}'.format(run, index))
+            storage = user.profile.main_storage()
+            entries = tree_manifest(
+                rng, options['shape'], options['dirs'], options['files'], options['fanout'], options['depth'])
+            for start in range(0, len(entries), options['chunk_size']):
+                result = import_tree(storage, entries[start:start + options['chunk_size']])
+                rows += result['dirs'] + result['files']
+            storages.append(storage)
+        seconds = time.time() - started
+
+        return {
+            'meta': {
+                'created_at': timezone.now().isoformat(),
+                'database': connection.vendor,
+                'tree_backend': settings.CLOUD_TREE_BACKEND,
+                'search_backend': get_search_backend().name,
+                'options': dict((name, options[name]) for name in (
+                    'users', 'shape', 'dirs', 'files', 'fanout', 'depth', 'iterations', 'seed')),
+            },
+            'load': {
+                'rows': rows,
+                'seconds': round(seconds, 3),
+                'rows_per_second': int(rows / seconds) if seconds else 0,
+            },
+            'operations': self.matrix(rng, storages, options['iterations']),
+        }
+
+    def matrix(self, rng, storages, iterations):
+        dirs = dict(
+            (storage.id, list(DirMeta.objects.filter(storage=storage).values_list('id', flat=True)))
+            for storage in storages)
+        counter = iter(range(10 ** 9))
+
+        def pick_dir(storage):
+            return DirMeta.objects.select_related('parent').get(pk=rng.choice(dirs[storage.id])) if dirs[storage.id] else None
+
+        # Each operation takes a storage and a directory picked outside the
+        # timed section
+        operations = (
+            ('browse', lambda storage, parent: storage.browse_page(parent=parent)),
+            ('browse_all', lambda storage, parent: storage.browse(parent=parent)),
+            ('listing_models', model_listing),
+            ('listing_rows', lambda storage, parent: listing_page(storage, parent=parent, limit=LISTING_LIMIT)),
+            ('total_size', lambda storage, parent: Storage.objects.get(pk=storage.pk).total_size),
+            ('subtree_stats', lambda storage, parent: parent and parent.subtree_stats(cached=False)),
+            ('feed_images', lambda storage, parent: storage.category_page(CATEGORY_IMAGE)),
+            ('feed_documents', lambda storage, parent: storage.category_page(CATEGORY_DOCUMENT)),
+            ('search', lambda storage, parent: get_search_backend().search(
+                storage, 'f{}'.format(rng.randint(1, 99)), SEARCH_SUBSTRING, limit=100)),
+            ('create_filemeta', lambda storage, parent: storage.create_filemeta(
+                parent=parent, name='bench-{}.txt'.format(next(counter)), size=1)),
+            ('rename_dirmeta', lambda storage, parent: parent and storage.rename_dirmeta(
+                parent=parent.parent, id=parent.id, name='renamed-{}'.format(next(counter)))),
+        )
+
+        results = {}
+        for name, operation in operations:
+            latencies, queries = [], []
+            for index in range(iterations):
+                storage = storages[index % len(storages)]
+                parent = pick_dir(storage)
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.time()
+                    operation(storage, parent)
+                    latencies.append(time.time() - started)
+                queries.append(len(captured))
+            results[name] = summarize(latencies, queries)
+        return results
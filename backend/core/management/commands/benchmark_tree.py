@@ -0,0 +1,106 @@
+# Django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+# Core
+from core.models import Storage, DirMeta, FileMeta
+
+# Misc
+import random
+import time
+
+BACKENDS = (
+    ('mptt', 'core.tree.MPTTBackend'),
+    ('path', 'core.tree.PathBackend'),
+)
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Compares directory insert, file insert and move throughput of the tree backends.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--storage', type=int, default=None)
+        parser.add_argument('--dirs', type=int, default=500)
+        parser.add_argument('--fanout', type=int, default=8)
+        parser.add_argument('--files', type=int, default=500)
+        parser.add_argument('--moves', type=int, default=100)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['storage']:
+            storage = Storage.objects.filter(pk=options['storage']).first()
+        else:
+            storage = Storage.objects.filter(storage_type=1).order_by('id').first()
+        if storage is None:
+            raise CommandError('No storage to benchmark against.')
+
+        for name, backend in BACKENDS:
+            with override_settings(CLOUD_TREE_BACKEND=backend):
+                try:
+                    with transaction.atomic():
+                        results = self.run(storage, name, options)
+                        raise Rollback()
+                except Rollback:
+                    pass
+
+            for operation, count, seconds in results:
+                self.stdout.write('{:<6} {:<14} {:>8} ops {:>10.1f} ops/s'.format(
+                    name, operation, count, count / seconds if seconds else 0))
+
+    def timed(self, operations):
+        started = time.time()
+        count = 0
+        for operation in operations:
+            operation()
+            count += 1
+        return count, time.time() - started
+
+    def run(self, storage, name, options):
+        rng = random.Random(options['seed'])
+        storage.create_dirmeta(parent=None, name='benchmark-' + name)
+        root = DirMeta.objects.get(storage=storage, parent=None, name='benchmark-' + name)
+        dirs = [root]
+
+        def create_dir(index):
+            def operation():
+                parent = dirs[index // options['fanout']]
+                parent.refresh_from_db()
+                storage.create_dirmeta(parent=parent, name='dir-' + str(index))
+                dirs.append(DirMeta.objects.get(storage=storage, parent=parent, name='dir-' + str(index)))
+            return operation
+
+        def create_file(index):
+            def operation():
+                parent = rng.choice(dirs)
+                parent.refresh_from_db()
+                storage.create_filemeta(parent=parent, name='file-' + str(index) + '.txt', size=1)
+            return operation
+
+        def move_dir(index):
+            def operation():
+                node = rng.choice(dirs[1:])
+                node.refresh_from_db()
+                target = rng.choice(dirs)
+                target.refresh_from_db()
+                if target.path.startswith(node.path) or target.id == node.parent_id:
+                    return
+                storage.move_dirmeta(parent=node.parent, id=node.id, target=target)
+            return operation
+
+        results = []
+        count, seconds = self.timed(create_dir(index) for index in range(options['dirs']))
+        results.append(('dir inserts', count, seconds))
+        count, seconds = self.timed(create_file(index) for index in range(options['files']))
+        results.append(('file inserts', count, seconds))
+        count, seconds = self.timed(move_dir(index) for index in range(options['moves']))
+        results.append(('moves', count, seconds))
+
+        if FileMeta.objects.filter(storage=storage, parent__in=dirs).count() != options['files']:
+            raise CommandError('{} backend lost files during the benchmark.'.format(name))
+
+        return results
@@ -0,0 +1,16 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Core
+from core.dedup import collect_blobs
+
+
+class Command(BaseCommand):
+    help = 'Deletes blobs no file references anymore, along with their objects.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        collected = collect_blobs(batch_size=options['batch_size'])
+        self.stdout.write('Collected {} blobs.'.format(collected))
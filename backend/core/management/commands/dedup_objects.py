@@ -0,0 +1,25 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Core
+from core.bulk import keyset_iterator
+from core.dedup import deduplicate
+from core.models import FileMeta
+
+
+class Command(BaseCommand):
+    help = 'Hashes stored objects not yet linked to a blob and deduplicates them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        checked = duplicates = 0
+        queryset = FileMeta.objects.filter(blob__isnull=True)
+
+        for filemeta in keyset_iterator(queryset, ['id'], options['batch_size']):
+            checked += 1
+            if deduplicate(filemeta):
+                duplicates += 1
+
+        self.stdout.write('Checked {} files, {} duplicates linked.'.format(checked, duplicates))
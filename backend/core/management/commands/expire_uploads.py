@@ -0,0 +1,16 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Core
+from core.uploads import expire_sessions
+
+
+class Command(BaseCommand):
+    help = 'Aborts upload sessions that expired and releases their uploaded parts.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        expired = expire_sessions(batch_size=options['batch_size'])
+        self.stdout.write('Expired {} upload sessions.'.format(expired))
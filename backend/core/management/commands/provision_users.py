@@ -0,0 +1,63 @@
+# Django
+from django.contrib.auth.hashers import get_hashers_by_algorithm
+from django.core.management.base import BaseCommand, CommandError
+
+# Core
+from core.accounts import clean_rows, provision_accounts
+
+# Misc
+import csv
+import sys
+import time
+
+
+class Command(BaseCommand):
+    help = ('Creates accounts in bulk from a CSV file with a header row and the columns username, '
+            'email, password, service and language; only username is required. Existing usernames '
+            'are skipped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file to read, or - for standard input.')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows read and created per batch.')
+        parser.add_argument('--hasher', default='default',
+                            help='Password hasher algorithm. A cheaper one from PASSWORD_HASHERS speeds up '
+                                 'large imports; passwords are rehashed with the preferred one on first login.')
+
+    def handle(self, *args, **options):
+        if options['hasher'] != 'default' and options['hasher'] not in get_hashers_by_algorithm():
+            raise CommandError('Unknown password hasher: {}'.format(options['hasher']))
+
+        started = time.time()
+        created = skipped = 0
+        invalid = []
+
+        handle = sys.stdin if options['path'] == '-' else open(options['path'], newline='')
+        try:
+            reader = csv.DictReader(handle)
+            if 'username' not in (reader.fieldnames or ()):
+                raise CommandError('The CSV file needs a username column.')
+
+            batch = []
+            for row in reader:
+                batch.append((reader.line_num, row))
+                if len(batch) >= options['batch_size']:
+                    counts = self.provision(batch, options['hasher'], invalid)
+                    created, skipped = created + counts[0], skipped + counts[1]
+                    batch = []
+            if batch:
+                counts = self.provision(batch, options['hasher'], invalid)
+                created, skipped = created + counts[0], skipped + counts[1]
+        finally:
+            if handle is not sys.stdin:
+                handle.close()
+
+        for line, reason in invalid:
+            self.stderr.write('Line {}: {}'.format(line, reason))
+        self.stdout.write('Created {} accounts, skipped {} existing and {} invalid rows in {:.1f}s.'.format(
+            created, skipped, len(invalid), time.time() - started))
+
+    def provision(self, rows, hasher, invalid):
+        accounts, rejected = clean_rows(rows)
+        invalid.extend(rejected)
+        created = provision_accounts(accounts, hasher=hasher)
+        return created, len(accounts) - created
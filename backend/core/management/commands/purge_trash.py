@@ -0,0 +1,20 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Core
+from core.purge import purge_trash
+
+
+class Command(BaseCommand):
+    help = 'Purges trash past its retention window or over quota, oldest first, and deletes the freed objects.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches to spread the load.')
+
+    def handle(self, *args, **options):
+        stats = purge_trash(batch_size=options['batch_size'], pause=options['pause'])
+        self.stdout.write('Purged {roots} items: {files} files, {dirs} directories, {size} bytes; '
+                          'deleted {objects} objects.'.format(**dict(
+                              dict.fromkeys(('roots', 'files', 'dirs', 'size', 'objects'), 0), **stats)))
@@ -0,0 +1,13 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Core
+from core.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the file name search index of the configured search backend.'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        self.stdout.write('Indexed {} files with the {} backend.'.format(backend.rebuild(), backend.name))
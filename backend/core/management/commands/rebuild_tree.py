@@ -0,0 +1,32 @@
+# Django
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+# Core
+from core.models import DirMeta
+from core.tree import rebuild_paths
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the materialized paths and/or MPTT nested sets of DirMeta, e.g. after switching tree backends.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--paths', action='store_true', default=False)
+        parser.add_argument('--nested-sets', action='store_true', default=False)
+        parser.add_argument('--batch-size', type=int, default=300)
+
+    def handle(self, *args, **options):
+        paths = options['paths']
+        nested_sets = options['nested_sets']
+        if not (paths or nested_sets):
+            paths = nested_sets = True
+
+        if nested_sets:
+            with transaction.atomic():
+                DirMeta.objects.rebuild()
+            self.stdout.write('Rebuilt nested sets.')
+
+        # Paths are rebuilt by level, which the nested set rebuild refreshes
+        if paths:
+            rebuild_paths(DirMeta, batch_size=options['batch_size'])
+            self.stdout.write('Rebuilt materialized paths.')
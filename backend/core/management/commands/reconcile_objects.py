@@ -0,0 +1,39 @@
+# Django
+from django.core.management.base import BaseCommand
+
+# Core
+from core.reconcile import latest_run, reconcile_objects
+
+
+class Command(BaseCommand):
+    help = ('Compares the object store with the file and blob rows, reporting objects no row references and '
+            'rows whose object is gone. An interrupted pass resumes from its last checkpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='Keys checked between checkpoints.')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches to spread the load.')
+        parser.add_argument('--rate', type=float, default=None, help='Most keys to check per second.')
+        parser.add_argument('--delete-orphans', action='store_true',
+                            help='Delete objects no row references, once past the grace period.')
+        parser.add_argument('--repair', action='store_true',
+                            help='Delete files whose object is gone, once past the grace period.')
+        parser.add_argument('--restart', action='store_true', help='Start a new pass instead of resuming.')
+
+    def handle(self, *args, **options):
+        run = latest_run(restart=options['restart'])
+        if run.last_key:
+            self.stdout.write('Resuming after {}.'.format(run.last_key))
+
+        def report(kind, key, detail):
+            self.stdout.write('{} {} {}'.format(kind, key, detail))
+
+        stats = reconcile_objects(
+            run, batch_size=options['batch_size'], delete=options['delete_orphans'], repair=options['repair'],
+            pause=options['pause'], rate=options['rate'], report=report)
+        self.stdout.write('Checked {keys} keys: {orphans} orphaned objects ({orphan_bytes} bytes, {recent} recent), '
+                          '{missing_files} files and {missing_blobs} blobs missing their object, {size_mismatches} '
+                          'size mismatches; deleted {deleted} objects ({failed} failed), removed {repaired} '
+                          'files.'.format(**dict(dict.fromkeys((
+                              'keys', 'orphans', 'orphan_bytes', 'recent', 'missing_files', 'missing_blobs',
+                              'size_mismatches', 'deleted', 'failed', 'repaired'), 0), **stats)))
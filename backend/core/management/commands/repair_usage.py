@@ -0,0 +1,58 @@
+# Django
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum, Count
+
+# Core
+from core.models import Storage, DirMeta, FileMeta
+
+
+class Command(BaseCommand):
+    help = 'Recomputes per-storage usage counters and repairs the ones that drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+        last_id = 0
+        checked = repaired = 0
+
+        while True:
+            ids = list(Storage.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+
+            for id in ids:
+                # The row lock holds off concurrent counter updates between
+                # reading the aggregates and writing them back
+                with transaction.atomic():
+                    storage = Storage.objects.select_for_update().filter(pk=id).first()
+                    if storage is None:
+                        continue
+
+                    usage = FileMeta.objects.filter(storage=storage).aggregate(size=Sum('size'), count=Count('id'))
+                    used_size = usage['size'] or 0
+                    file_count = usage['count']
+                    dir_count = DirMeta.objects.filter(storage=storage).count()
+                    checked += 1
+
+                    if (storage.used_size, storage.file_count, storage.dir_count) == (used_size, file_count, dir_count):
+                        continue
+
+                    repaired += 1
+                    self.stdout.write('Storage {}: size {} -> {}, files {} -> {}, dirs {} -> {}'.format(
+                        storage.id, storage.used_size, used_size,
+                        storage.file_count, file_count,
+                        storage.dir_count, dir_count))
+
+                    if not dry_run:
+                        Storage.objects.filter(pk=storage.pk).update(
+                            used_size=used_size,
+                            file_count=file_count,
+                            dir_count=dir_count)
+
+        self.stdout.write('Checked {} storages, {} repaired.'.format(checked, repaired))
@@ -0,0 +1,54 @@
+# Django
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+# Core
+from core.thumbnails import claim_jobs, process_jobs, prune_thumbnails, queue_stats, Metrics
+
+# Misc
+from concurrent.futures import ProcessPoolExecutor
+import time
+
+
+class RenderPool(ProcessPoolExecutor):
+    # Forked renderers must not inherit open database connections. Workers
+    # are forked inside submit(), all at once before Python 3.9 and on
+    # demand since, so every submit drops the connections first; the next
+    # query reopens them.
+
+    def submit(self, *args, **kwargs):
+        connections.close_all()
+        return super(RenderPool, self).submit(*args, **kwargs)
+
+
+class Command(BaseCommand):
+    help = 'Renders queued thumbnails into the thumb storages using a pool of processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=32)
+        parser.add_argument('--idle-sleep', type=float, default=2.0)
+        parser.add_argument('--once', action='store_true', default=False)
+        parser.add_argument('--prune', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        if options['prune']:
+            self.stdout.write('Pruned {} orphaned thumbnails.'.format(prune_thumbnails()))
+            return
+
+        metrics = Metrics()
+
+        with RenderPool(max_workers=options['processes']) as pool:
+            while True:
+                jobs = claim_jobs(options['batch_size'])
+                if not jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['idle_sleep'])
+                    continue
+
+                metrics.add(*process_jobs(jobs, pool))
+                self.stdout.write('{done} done, {failed} failed, {thumbnails_per_second}/s'.format(
+                    **metrics.as_dict()))
+
+        self.stdout.write('Finished: {}; queue: {}'.format(metrics.as_dict(), queue_stats()))
@@ -0,0 +1,31 @@
+# Django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+# Core
+from core.journal import truncate
+from core.models import Storage
+
+# Misc
+from datetime import timedelta
+
+
+class Command(BaseCommand):
+    help = 'Drops change journal entries past the retention period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = settings.CHANGE_JOURNAL_RETENTION_DAYS
+        before = timezone.now() - timedelta(days=days)
+
+        deleted = 0
+        for storage in Storage.objects.filter(changeentry__created_at__lt=before).distinct().iterator():
+            deleted += truncate(storage, before, batch_size=options['batch_size'])
+
+        self.stdout.write('Deleted {} change entries.'.format(deleted))
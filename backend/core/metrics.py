@@ -0,0 +1,251 @@
+# Django
+from django.conf import settings
+from django.db import connections
+
+# Misc
+from collections import Counter
+import functools
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+HISTOGRAMS = {
+    'cloud_request_duration_seconds': ('Time spent serving requests.', SECONDS_BUCKETS),
+    'cloud_request_db_seconds': ('Time spent running SQL per request.', SECONDS_BUCKETS),
+    'cloud_request_queries': ('SQL queries run per request.', QUERY_BUCKETS),
+    'cloud_request_serialization_seconds': ('Time spent rendering response bodies.', SECONDS_BUCKETS),
+    'cloud_method_duration_seconds': ('Time spent in instrumented model methods.', SECONDS_BUCKETS),
+    'cloud_method_db_seconds': ('Time spent running SQL per model method call.', SECONDS_BUCKETS),
+    'cloud_method_queries': ('SQL queries run per model method call.', QUERY_BUCKETS),
+    'cloud_object_store_seconds': ('Time spent per object store request attempt.', SECONDS_BUCKETS),
+}
+
+COUNTERS = {
+    'cloud_requests_total': 'Requests served.',
+    'cloud_slow_requests_total': 'Requests slower than METRICS_SLOW_REQUEST_SECONDS.',
+    'cloud_object_store_retries_total': 'Object store requests retried after a transient failure.',
+    'cloud_object_store_failures_total': 'Object store requests that failed for good, missing keys included.',
+}
+
+# Quoted strings and bare numbers, so that statements differing only in
+# their parameters group together
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')) for name, value in labels) + '}'
+
+
+def normalize_sql(sql):
+    return LITERALS.sub('?', sql)
+
+
+class MetricsRegistry(object):
+    # Numbers are kept per process: scrape every worker, or run one worker
+    # per target
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = Counter()
+
+    def clear(self):
+        with self.lock:
+            self.histograms = {}
+            self.counters = Counter()
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [[0] * len(buckets), 0, 0.0]
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def render(self):
+        # Prometheus text exposition format
+        with self.lock:
+            histograms = dict((key, (list(series[0]), series[1], series[2])) for key, series in self.histograms.items())
+            counters = dict(self.counters)
+
+        lines = []
+        for name in sorted(COUNTERS):
+            lines.append('# HELP {} {}'.format(name, COUNTERS[name]))
+            lines.append('# TYPE {} counter'.format(name))
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+
+        for name in sorted(HISTOGRAMS):
+            help, buckets = HISTOGRAMS[name]
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} histogram'.format(name))
+            for (series, labels), (counts, count, total) in sorted(histograms.items()):
+                if series != name:
+                    continue
+                for bound, value in zip(buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '{:g}'.format(bound)),)), value))
+                lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', '+Inf'),)), count))
+                lines.append('{}_sum{} {!r}'.format(name, format_labels(labels), total))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+class QueryLog(object):
+    # Stands in for a connection's queries_log during a capture. Every query
+    # reaches the capture; the log it replaced only gets the ones DEBUG (or
+    # an enclosing capture) asked for. Counting appends rather than the
+    # length of the log keeps the numbers right once its deque is full.
+
+    def __init__(self, log, queries, keep):
+        self.log = log
+        self.queries = queries
+        self.keep = keep
+
+    def append(self, query):
+        self.queries.append(query)
+        if self.keep:
+            self.log.append(query)
+
+    def __len__(self):
+        return len(self.log)
+
+    def __iter__(self):
+        return iter(self.log)
+
+    def __getattr__(self, name):
+        return getattr(self.log, name)
+
+
+class QueryCapture(object):
+    # Turns on the debug cursor of every connection for the duration of the
+    # block and keeps the queries it ran, without leaving them in the
+    # connection's log outside DEBUG.
+
+    def __init__(self):
+        self.queries = []
+
+    def __enter__(self):
+        self.state = []
+        for connection in connections.all():
+            self.state.append((connection, connection.force_debug_cursor, connection.queries_log))
+            connection.queries_log = QueryLog(connection.queries_log, self.queries, connection.queries_logged)
+            connection.force_debug_cursor = True
+        return self
+
+    def __exit__(self, *exc_info):
+        for connection, forced, log in self.state:
+            connection.force_debug_cursor = forced
+            connection.queries_log = log
+
+    @property
+    def seconds(self):
+        return sum(float(query['time']) for query in self.queries)
+
+
+def describe_queries(queries, limit):
+    lines = ['Slowest queries:']
+    for query in sorted(queries, key=lambda query: -float(query['time']))[:limit]:
+        lines.append('  {}s {}'.format(query['time'], query['sql']))
+
+    # The same statement over and over is usually an N+1
+    repeated = [(sql, count) for sql, count in Counter(
+        normalize_sql(query['sql']) for query in queries).most_common(limit) if count > 1]
+    if repeated:
+        lines.append('Repeated queries:')
+        for sql, count in repeated:
+            lines.append('  {}x {}'.format(count, sql))
+    return '\n'.join(lines)
+
+
+def instrument(function):
+    # Records duration, query count and SQL time of every call under the
+    # method's qualified name, e.g. Storage.browse_page
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not settings.METRICS_ENABLED:
+            return function(*args, **kwargs)
+
+        capture = QueryCapture()
+        started = time.time()
+        try:
+            with capture:
+                return function(*args, **kwargs)
+        finally:
+            labels = {'method': name}
+            registry.observe('cloud_method_duration_seconds', labels, time.time() - started)
+            registry.observe('cloud_method_queries', labels, len(capture.queries))
+            registry.observe('cloud_method_db_seconds', labels, capture.seconds)
+    return wrapper
+
+
+class MetricsMiddleware(object):
+    # Goes first in MIDDLEWARE so the whole stack is timed. Requests are
+    # labelled by their URL name, which keeps the series bounded.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_ENABLED:
+            return self.get_response(request)
+
+        request.render_seconds = 0.0
+        capture = QueryCapture()
+        started = time.time()
+        with capture:
+            response = self.get_response(request)
+        duration = time.time() - started
+
+        match = getattr(request, 'resolver_match', None)
+        labels = {'endpoint': match.view_name if match else 'unmatched', 'method': request.method}
+        registry.inc('cloud_requests_total', dict(labels, status=response.status_code))
+        registry.observe('cloud_request_duration_seconds', labels, duration)
+        registry.observe('cloud_request_queries', labels, len(capture.queries))
+        registry.observe('cloud_request_db_seconds', labels, capture.seconds)
+        registry.observe('cloud_request_serialization_seconds', labels, request.render_seconds)
+
+        if duration >= settings.METRICS_SLOW_REQUEST_SECONDS:
+            registry.inc('cloud_slow_requests_total', labels)
+            logger.warning(
+                'Slow request %s %s (%s): %.3fs, %d queries, %.3fs in SQL\n%s',
+                request.method, request.get_full_path(), labels['endpoint'], duration, len(capture.queries),
+                capture.seconds, describe_queries(capture.queries, settings.METRICS_SLOW_QUERY_LIMIT))
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered right after this hook returns
+        if not settings.METRICS_ENABLED:
+            return response
+
+        started = time.time()
+
+        def rendered(response):
+            request.render_seconds += time.time() - started
+        response.add_post_render_callback(rendered)
+        return response
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.4 on 2026-10-18 19:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Sum, Count
+
+
+def backfill_usage(apps, schema_editor):
+    Storage = apps.get_model('core', 'Storage')
+    FileMeta = apps.get_model('core', 'FileMeta')
+    DirMeta = apps.get_model('core', 'DirMeta')
+
+    files = FileMeta.objects.order_by().values('storage').annotate(size=Sum('size'), count=Count('id'))
+    for row in files.iterator():
+        Storage.objects.filter(pk=row['storage']).update(used_size=row['size'] or 0, file_count=row['count'])
+
+    dirs = DirMeta.objects.order_by().values('storage').annotate(count=Count('id'))
+    for row in dirs.iterator():
+        Storage.objects.filter(pk=row['storage']).update(dir_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='dir_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='file_count',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='used_size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_usage, migrations.RunPython.noop),
+    ]
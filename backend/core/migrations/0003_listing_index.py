@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.4 on 2026-10-18 19:22
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_storage_usage'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='dirmeta',
+            index_together=set([('storage', 'parent', 'name', 'id'), ('storage', 'name', 'parent')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='filemeta',
+            index_together=set([('storage', 'parent', 'name', 'id'), ('storage', 'name', 'parent')]),
+        ),
+    ]
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.4 on 2026-10-18 19:26
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+# The categories as they stood when the column was added, kept here so
+# later changes to core.models do not change what this migration does
+CATEGORY_OTHER = 0
+CATEGORY_DOCUMENT = 1
+CATEGORY_IMAGE = 2
+CATEGORY_AUDIO = 3
+CATEGORY_VIDEO = 4
+
+DOCUMENT_MIME_TYPES = (
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.template',
+    'application/vnd.ms-word.document.macroenabled.12',
+    'application/vnd.ms-word.template.macroenabled.12',
+    'application/vnd.ms-excel',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.template',
+    'application/vnd.ms-excel.sheet.macroenabled.12',
+    'application/vnd.ms-excel.template.macroenabled.12',
+    'application/vnd.ms-excel.addin.macroenabled.12',
+    'application/vnd.ms-excel.sheet.binary.macroenabled.12',
+    'application/vnd.ms-powerpoint',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.openxmlformats-officedocument.presentationml.template',
+    'application/vnd.openxmlformats-officedocument.presentationml.slideshow',
+    'application/vnd.ms-powerpoint.addin.macroenabled.12',
+    'application/vnd.ms-powerpoint.presentation.macroenabled.12',
+    'application/vnd.ms-powerpoint.template.macroenabled.12',
+    'application/vnd.ms-powerpoint.slideshow.macroenabled.12',
+)
+
+IMAGE_MIME_TYPES = (
+    'image/gif',
+    'image/jpeg',
+    'image/png',
+    'image/svg+xml',
+)
+
+
+def content_category(mime_type):
+    mime_type = (mime_type or '').lower()
+
+    if mime_type in DOCUMENT_MIME_TYPES:
+        return CATEGORY_DOCUMENT
+    if mime_type in IMAGE_MIME_TYPES:
+        return CATEGORY_IMAGE
+    if 'audio' in mime_type:
+        return CATEGORY_AUDIO
+    if 'video' in mime_type:
+        return CATEGORY_VIDEO
+    return CATEGORY_OTHER
+
+
+def backfill_category(apps, schema_editor):
+    MimeContentType = apps.get_model('core', 'MimeContentType')
+    FileMeta = apps.get_model('core', 'FileMeta')
+
+    categories = {}
+    for id, name in MimeContentType.objects.values_list('id', 'name').iterator():
+        category = content_category(name)
+        if category != CATEGORY_OTHER:
+            categories.setdefault(category, []).append(id)
+
+    last_id = None
+    while True:
+        queryset = FileMeta.objects.order_by('id')
+        if last_id is not None:
+            queryset = queryset.filter(id__gt=last_id)
+        batch = list(queryset.values_list('id', flat=True)[:BATCH_SIZE])
+        if not batch:
+            break
+
+        last_id = batch[-1]
+        for category, content_types in categories.items():
+            FileMeta.objects.filter(id__in=batch, content_type__in=content_types).update(category=category)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_listing_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filemeta',
+            name='category',
+            field=models.SmallIntegerField(choices=[(0, 'other'), (1, 'documents'), (2, 'images'), (3, 'audios'), (4, 'videos')], default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='filemeta',
+            index_together=set([('storage', 'parent', 'name', 'id'), ('storage', 'category', 'modified_at', 'id'), ('storage', 'name', 'parent')]),
+        ),
+        migrations.RunPython(backfill_category, migrations.RunPython.noop),
+    ]
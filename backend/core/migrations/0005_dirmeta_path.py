@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.4 on 2026-10-18 19:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from core.tree import rebuild_paths
+
+
+def backfill_paths(apps, schema_editor):
+    rebuild_paths(apps.get_model('core', 'DirMeta'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_filemeta_category'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dirmeta',
+            name='path',
+            field=models.TextField(db_index=True, default='', editable=False),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
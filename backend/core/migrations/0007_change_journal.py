@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.4 on 2026-10-18 19:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_upload_sessions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField()),
+                ('action', models.SmallIntegerField(choices=[(1, 'create'), (2, 'rename'), (3, 'move'), (4, 'delete')])),
+                ('kind', models.CharField(max_length=4)),
+                ('node_id', models.UUIDField()),
+                ('parent_id', models.UUIDField(null=True)),
+                ('name', models.CharField(max_length=4096)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'ordering': ('seq',),
+            },
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='change_floor',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='change_seq',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='changeentry',
+            name='storage',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='core.Storage'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='changeentry',
+            unique_together=set([('storage', 'seq')]),
+        ),
+    ]
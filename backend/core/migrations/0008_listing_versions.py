@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.4 on 2026-10-18 19:42
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_change_journal'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dirmeta',
+            name='version',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='root_version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.4 on 2026-10-18 19:59
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 500
+
+THUMB = 3
+
+
+def trigrams(value):
+    # The tokenizer as it stood when tokens were introduced; core.search
+    # keeps its own copy
+    value = value.lower()
+    if len(value) < 3:
+        return set([value]) if value else set()
+    return set(value[index:index + 3] for index in range(len(value) - 2))
+
+
+def build_tokens(apps):
+    FileMeta = apps.get_model('core', 'FileMeta')
+    NameToken = apps.get_model('core', 'NameToken')
+
+    last_id = None
+    while True:
+        queryset = FileMeta.objects.exclude(storage__storage_type=THUMB).order_by('id')
+        if last_id is not None:
+            queryset = queryset.filter(id__gt=last_id)
+        rows = list(queryset.values_list('id', 'name')[:BATCH_SIZE])
+        if not rows:
+            return
+
+        last_id = rows[-1][0]
+        NameToken.objects.bulk_create([
+            NameToken(filemeta_id=id, token=token) for id, name in rows for token in sorted(trigrams(name))])
+
+
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(
+            'CREATE INDEX core_filemeta_name_trgm ON core_filemeta USING gin (name gin_trgm_ops)')
+    else:
+        build_tokens(apps)
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS core_filemeta_name_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_object_tombstones'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NameToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=3)),
+                ('filemeta', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='name_tokens', to='core.FileMeta')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='nametoken',
+            index_together=set([('token', 'filemeta')]),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
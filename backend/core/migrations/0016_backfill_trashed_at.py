@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.utils import timezone
+
+# Trash roots from before trashed_at existed start their retention window
+# now rather than being purged on the first run
+TRASH = 2
+
+
+def backfill_trashed_at(apps, schema_editor):
+    now = timezone.now()
+    for name in ('DirMeta', 'FileMeta'):
+        model = apps.get_model('core', name)
+        model.objects.filter(storage__storage_type=TRASH, parent=None, trashed_at__isnull=True).update(trashed_at=now)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0015_reconcile_runs'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_trashed_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,133 @@
+# Django
+from django.apps import apps
+from django.conf import settings
+from django.db import transaction
+
+# Misc
+from collections import OrderedDict
+import mimetypes
+import threading
+
+DEFAULT_MIME_TYPE = 'application/octet-stream'
+
+# Marks extensions known to have no MimeContentType row
+MISSING = object()
+
+
+def file_extension(name):
+    # 'a.tar.gz' -> 'gz', '.bashrc' -> '', 'README' -> ''
+    stem, dot, extension = name.strip('.').rpartition('.')
+    if not dot or len(extension) > 16:
+        return ''
+    return extension.lower()
+
+
+def guess_mime_type(extension):
+    if not extension:
+        return DEFAULT_MIME_TYPE
+    return mimetypes.guess_type('file.' + extension)[0] or DEFAULT_MIME_TYPE
+
+
+class MimeTypeCache(object):
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize or getattr(settings, 'MIME_CACHE_SIZE', 1024)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Extensions whose rows changed in a transaction that hasn't
+        # committed yet; they are served from the database meanwhile
+        self.pending = set()
+        self.warmed = False
+        self.hits = self.misses = 0
+
+    @property
+    def model(self):
+        return apps.get_model('core', 'MimeContentType')
+
+    def store(self, extension, content_type):
+        if extension in self.pending:
+            return
+        self.entries[extension] = content_type
+        self.entries.move_to_end(extension)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def warm(self):
+        content_types = self.model.objects.order_by('extension')[:self.maxsize]
+        with self.lock:
+            for content_type in content_types:
+                if content_type.extension not in self.entries:
+                    self.store(content_type.extension, content_type)
+            self.warmed = True
+
+    def get_many(self, extensions):
+        if not self.warmed:
+            self.warm()
+
+        found = {}
+        missing = []
+        with self.lock:
+            for extension in set(extensions):
+                content_type = self.entries.get(extension, None)
+                if content_type is None:
+                    missing.append(extension)
+                    continue
+                self.entries.move_to_end(extension)
+                self.hits += 1
+                if content_type is not MISSING:
+                    found[extension] = content_type
+
+        if missing:
+            loaded = {}
+            for content_type in self.model.objects.filter(extension__in=missing):
+                loaded.setdefault(content_type.extension, content_type)
+
+            with self.lock:
+                self.misses += len(missing)
+                for extension in missing:
+                    self.store(extension, loaded.get(extension, MISSING))
+            found.update(loaded)
+
+        return found
+
+    def get(self, extension):
+        return self.get_many([extension]).get(extension, None)
+
+    def get_or_create(self, extension):
+        content_type = self.get(extension)
+        if content_type is None:
+            content_type, created = self.model.objects.get_or_create(
+                extension=extension,
+                defaults={'name': guess_mime_type(extension)})
+        return content_type
+
+    def changed(self, extension, pk=None):
+        # Rows written inside a transaction aren't cached until it commits,
+        # so a rollback can't leave them behind
+        self.invalidate(extension=extension, pk=pk)
+        if not transaction.get_connection().in_atomic_block:
+            return
+        with self.lock:
+            self.pending.add(extension)
+        transaction.on_commit(lambda: self.release(extension))
+
+    def release(self, extension):
+        with self.lock:
+            self.pending.discard(extension)
+        self.invalidate(extension=extension)
+
+    def invalidate(self, extension=None, pk=None):
+        with self.lock:
+            if extension is None and pk is None:
+                self.entries.clear()
+                self.pending.clear()
+                self.warmed = False
+                return
+
+            self.entries.pop(extension, None)
+            for key, content_type in list(self.entries.items()):
+                if content_type is not MISSING and content_type.pk == pk:
+                    del self.entries[key]
+
+
+mime_cache = MimeTypeCache()
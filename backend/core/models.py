@@ -1,23 +1,36 @@
 # Django
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.template import defaultfilters
 from django.dispatch import receiver
-from django.db.models import signals, Sum, Q
+from django.db.models import signals, Q, F
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 # MPTT
 from mptt.models import MPTTModel, TreeForeignKey
 
-# Minio
-from minio import Minio
-from minio.error import ResponseError
+# Core
+from core.dedup import release_objects
+from core.metrics import instrument
+from core.journal import (
+    record_change, CHANGE_CREATE, CHANGE_RENAME, CHANGE_MOVE, CHANGE_DELETE, CHANGE_CHOICES)
+from core.mimecache import mime_cache, file_extension
+from core.objectstore import get_object_store
+from core.listing import keyset_page
+from core.paths import PathResolver
+from core.search import get_search_backend
+from core.stats import subtree_stats, invalidate_tree, invalidate_nodes
+from core.tree import get_tree_backend, node_path
 
 # Misc
 import uuid
 import itertools
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Choices
 CAPACITY_CHOICES = (
@@ -25,6 +38,93 @@ CAPACITY_CHOICES = (
     (1073741824, '1GB'),
 )
 
+STORAGE_MAIN = 1
+STORAGE_TRASH = 2
+STORAGE_THUMB = 3
+
+STORAGE_TYPES = (STORAGE_MAIN, STORAGE_TRASH, STORAGE_THUMB)
+
+CATEGORY_OTHER = 0
+CATEGORY_DOCUMENT = 1
+CATEGORY_IMAGE = 2
+CATEGORY_AUDIO = 3
+CATEGORY_VIDEO = 4
+
+CATEGORY_CHOICES = (
+    (CATEGORY_OTHER, 'other'),
+    (CATEGORY_DOCUMENT, 'documents'),
+    (CATEGORY_IMAGE, 'images'),
+    (CATEGORY_AUDIO, 'audios'),
+    (CATEGORY_VIDEO, 'videos'),
+)
+
+DOCUMENT_MIME_TYPES = (
+    'application/msword',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.template',
+    'application/vnd.ms-word.document.macroenabled.12',
+    'application/vnd.ms-word.template.macroenabled.12',
+    'application/vnd.ms-excel',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.template',
+    'application/vnd.ms-excel.sheet.macroenabled.12',
+    'application/vnd.ms-excel.template.macroenabled.12',
+    'application/vnd.ms-excel.addin.macroenabled.12',
+    'application/vnd.ms-excel.sheet.binary.macroenabled.12',
+    'application/vnd.ms-powerpoint',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.openxmlformats-officedocument.presentationml.template',
+    'application/vnd.openxmlformats-officedocument.presentationml.slideshow',
+    'application/vnd.ms-powerpoint.addin.macroenabled.12',
+    'application/vnd.ms-powerpoint.presentation.macroenabled.12',
+    'application/vnd.ms-powerpoint.template.macroenabled.12',
+    'application/vnd.ms-powerpoint.slideshow.macroenabled.12',
+)
+
+IMAGE_MIME_TYPES = (
+    'image/gif',
+    'image/jpeg',
+    'image/png',
+    'image/svg+xml',
+)
+
+
+JOB_PENDING = 0
+JOB_RUNNING = 1
+JOB_DONE = 2
+JOB_FAILED = 3
+
+JOB_STATUS_CHOICES = (
+    (JOB_PENDING, 'pending'),
+    (JOB_RUNNING, 'running'),
+    (JOB_DONE, 'done'),
+    (JOB_FAILED, 'failed'),
+)
+
+BATCH_MOVE = 'move'
+BATCH_COPY = 'copy'
+BATCH_TRASH = 'trash'
+
+BATCH_OPERATION_CHOICES = (
+    (BATCH_MOVE, 'move'),
+    (BATCH_COPY, 'copy'),
+    (BATCH_TRASH, 'trash'),
+)
+
+
+def content_category(mime_type):
+    mime_type = (mime_type or '').lower()
+
+    if mime_type in DOCUMENT_MIME_TYPES:
+        return CATEGORY_DOCUMENT
+    if mime_type in IMAGE_MIME_TYPES:
+        return CATEGORY_IMAGE
+    if 'audio' in mime_type:
+        return CATEGORY_AUDIO
+    if 'video' in mime_type:
+        return CATEGORY_VIDEO
+    return CATEGORY_OTHER
+
 
 class Service(models.Model):
     name = models.CharField(max_length=100)
@@ -38,25 +138,53 @@ class Service(models.Model):
 
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
-    service = models.OneToOneField(Service, on_delete=models.CASCADE, default=1)
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, default=1)
     language = models.CharField(max_length=2, choices=settings.LANGUAGES, default=settings.LANGUAGE_CODE)
 
     def __str__(self):
         return self.user.username
 
+    @property
+    def storages(self):
+        # Every storage of the profile by type, loaded once per instance
+        if not hasattr(self, '_storages'):
+            self._storages = dict((storage.storage_type, storage) for storage in self.storage_set.all())
+        return self._storages
+
+    def get_storage(self, storage_type):
+        try:
+            return self.storages[storage_type]
+        except KeyError:
+            raise Storage.DoesNotExist('Profile {} has no storage of type {}.'.format(self.pk, storage_type))
+
     def main_storage(self):
-        return Storage.objects.get(owner=self, storage_type=0)
+        return self.get_storage(STORAGE_MAIN)
 
     def trash_storage(self):
-        return Storage.objects.get(owner=self, storage_type=1)
+        return self.get_storage(STORAGE_TRASH)
 
     def thumb_storage(self):
-        return Storage.objects.get(owner=self, storage_type=2)
+        return self.get_storage(STORAGE_THUMB)
+
+
+def provision_storages(profiles):
+    # One insert for all storages of all the profiles
+    Storage.objects.bulk_create([
+        Storage(storage_type=storage_type, owner=profile)
+        for profile in profiles for storage_type in STORAGE_TYPES])
+    for profile in profiles:
+        profile.__dict__.pop('_storages', None)
 
 
 class Storage(models.Model):
     storage_type = models.SmallIntegerField(default=0)
     owner = models.ForeignKey(Profile, on_delete=models.CASCADE)
+    used_size = models.BigIntegerField(default=0)
+    file_count = models.BigIntegerField(default=0)
+    dir_count = models.BigIntegerField(default=0)
+    change_seq = models.BigIntegerField(default=0)
+    change_floor = models.BigIntegerField(default=0)
+    root_version = models.BigIntegerField(default=0)
 
     def __str__(self):
         storage_types = {
@@ -81,106 +209,269 @@ class Storage(models.Model):
 
     @property
     def total_size(self):
-        if FileMeta.objects.filter(storage=self).exists():
-            return FileMeta.objects.filter(storage=self).aggregate(total_size=Sum('size')).get('total_size')
-        
-        return 0
-
+        return self.used_size
+
+    def has_space_for(self, size):
+        return self.total_size + size <= self.capacity_quota
+
+    def update_usage(self, size=0, files=0, dirs=0):
+        if not any([size, files, dirs]):
+            return
+
+        Storage.objects.filter(pk=self.pk).update(
+            used_size=F('used_size') + size,
+            file_count=F('file_count') + files,
+            dir_count=F('dir_count') + dirs)
+        self.refresh_from_db(fields=['used_size', 'file_count', 'dir_count'])
+
+    def touch(self, *parents):
+        # Bumps the listing version of each parent; None is the storage root.
+        # Listings carry the entry counts of every directory they show, so
+        # the directory listing a touched parent is bumped as well.
+        ids = set()
+        root = False
+        for parent in parents:
+            if parent is None:
+                root = True
+                continue
+            ids.add(parent.id)
+            if parent.parent_id is None:
+                root = True
+            else:
+                ids.add(parent.parent_id)
+
+        if ids:
+            DirMeta.objects.filter(id__in=ids).update(version=F('version') + 1)
+        if root:
+            Storage.objects.filter(pk=self.pk).update(root_version=F('root_version') + 1)
+
+    def subtree_usage(self, dirmeta):
+        stats = dirmeta.subtree_stats(cached=False)
+        return stats['size'], stats['files'], stats['dirs'] + 1
+
+    @instrument
     def create_dirmeta(self, parent=None, **kwargs):
         name = kwargs.get('name', None)
         
         if name:
-            DirMeta.objects.create(
-                storage=self,
-                name=name,
-                parent=parent)
-
+            with transaction.atomic():
+                dirmeta = DirMeta.objects.create(
+                    storage=self,
+                    name=name,
+                    parent=parent)
+                self.update_usage(dirs=1)
+                record_change(self, CHANGE_CREATE, dirmeta)
+                self.touch(parent)
+                invalidate_nodes(parent)
+
+            return dirmeta
+
+    @instrument
     def create_filemeta(self, parent=None, **kwargs):
         name = kwargs.get('name', None)
         content_type = kwargs.get('content_type', None)
         size = kwargs.get('size', None)
 
-        if not content_type:
-            filename, extension = name.split('.') if '.' in name else (name, name)
-            try:
-                content_type = MimeContentType.objects.get(extension=extension)
-            except MimeContentType.DoesNotExist:
-                content_type = MimeContentType.objects.create(name=filename, extension=extension)
+        if not content_type and name:
+            content_type = mime_cache.get_or_create(file_extension(name))
         
-        if all([name, content_type, size]):
-            FileMeta.objects.create(
-                storage=self,
-                name=name,
-                parent=parent,
-                content_type=content_type,
-                size=size)
+        if all([name, content_type]) and size is not None:
+            with transaction.atomic():
+                filemeta = FileMeta.objects.create(
+                    id=kwargs.get('id', None) or uuid.uuid4(),
+                    storage=self,
+                    name=name,
+                    parent=parent,
+                    content_type=content_type,
+                    size=size)
+                self.update_usage(size=size, files=1)
+                get_search_backend().index([filemeta])
+                record_change(self, CHANGE_CREATE, filemeta)
+                self.touch(parent)
+                invalidate_nodes(parent)
+
+            return filemeta
     
+    @instrument
     def rename_dirmeta(self, parent=None, **kwargs):
         id = kwargs.get('id', None)
         name = kwargs.get('name', None)
 
         if all([id, name]):
-            DirMeta.objects.filter(id=id, storage=self, parent=parent).update(name=name)
+            with transaction.atomic():
+                dirmeta = DirMeta.objects.select_for_update().filter(id=id, storage=self, parent=parent).first()
+                if dirmeta is None:
+                    return
 
+                DirMeta.objects.filter(pk=dirmeta.pk).update(name=name)
+                dirmeta.name = name
+                record_change(self, CHANGE_RENAME, dirmeta)
+                self.touch(parent)
+
+    @instrument
     def rename_filemeta(self, parent=None, **kwargs):
         id = kwargs.get('id', None)
         name = kwargs.get('name', None)
 
         if all([id, name]):
-            FileMeta.objects.filter(id=id, storage=self, parent=parent).update(name=name)
+            with transaction.atomic():
+                filemeta = FileMeta.objects.select_for_update().filter(id=id, storage=self, parent=parent).first()
+                if filemeta is None:
+                    return
+
+                FileMeta.objects.filter(pk=filemeta.pk).update(name=name)
+                filemeta.name = name
+                get_search_backend().index([filemeta], replace=True)
+                record_change(self, CHANGE_RENAME, filemeta)
+                self.touch(parent)
+
+    @instrument
+    def delete_dirmeta(self, parent=None, **kwargs):
+        id = kwargs.get('id', None)
+
+        if id:
+            with transaction.atomic():
+                try:
+                    dirmeta = DirMeta.objects.select_for_update().get(id=id, storage=self, parent=parent)
+                except DirMeta.DoesNotExist:
+                    return
+
+                size, files, dirs = self.subtree_usage(dirmeta)
+                release_objects(FileMeta.objects.filter(parent__in=get_tree_backend().descendants(dirmeta, include_self=True)))
+                # Clients drop the whole subtree with its root
+                record_change(self, CHANGE_DELETE, dirmeta)
+                get_tree_backend().delete(dirmeta)
+                self.update_usage(size=-size, files=-files, dirs=-dirs)
+                self.touch(parent)
+                invalidate_nodes(dirmeta)
+
+    @instrument
+    def delete_filemeta(self, parent=None, **kwargs):
+        id = kwargs.get('id', None)
 
+        if id:
+            with transaction.atomic():
+                try:
+                    filemeta = FileMeta.objects.select_for_update().get(id=id, storage=self, parent=parent)
+                except FileMeta.DoesNotExist:
+                    return
+
+                release_objects(FileMeta.objects.filter(pk=filemeta.pk))
+                record_change(self, CHANGE_DELETE, filemeta)
+                get_tree_backend().delete(filemeta)
+                self.update_usage(size=-filemeta.size, files=-1)
+                self.touch(parent)
+                invalidate_nodes(parent)
+
+    @instrument
+    def move_dirmeta(self, parent=None, **kwargs):
+        id = kwargs.get('id', None)
+        target = kwargs.get('target', None)
+        storage = kwargs.get('storage', None) or self
+
+        if id:
+            with transaction.atomic():
+                try:
+                    dirmeta = DirMeta.objects.select_for_update().get(id=id, storage=self, parent=parent)
+                except DirMeta.DoesNotExist:
+                    return
+
+                backend = get_tree_backend()
+                size, files, dirs = self.subtree_usage(dirmeta)
+                subtree = backend.descendants(dirmeta, include_self=True)
+                FileMeta.objects.filter(storage=self, parent__in=subtree).update(storage=storage)
+                subtree.update(storage=storage)
+
+                dirmeta.refresh_from_db()
+                tree_key = backend.tree_key(dirmeta)
+                backend.move(dirmeta, target)
+                invalidate_tree(tree_key, backend.tree_key(dirmeta))
+                self.touch(parent)
+                storage.touch(target)
+
+                if storage != self:
+                    self.update_usage(size=-size, files=-files, dirs=-dirs)
+                    storage.update_usage(size=size, files=files, dirs=dirs)
+                    # The target's clients list the new subtree from its root
+                    record_change(self, CHANGE_DELETE, dirmeta)
+                    record_change(storage, CHANGE_CREATE, dirmeta)
+                else:
+                    record_change(self, CHANGE_MOVE, dirmeta)
+
+    @instrument
+    def move_filemeta(self, parent=None, **kwargs):
+        id = kwargs.get('id', None)
+        target = kwargs.get('target', None)
+        storage = kwargs.get('storage', None) or self
+
+        if id:
+            with transaction.atomic():
+                try:
+                    filemeta = FileMeta.objects.select_for_update().get(id=id, storage=self, parent=parent)
+                except FileMeta.DoesNotExist:
+                    return
+
+                # A plain update: the nested set fields of files carry no
+                # meaning, and an MPTT move would compare them with the
+                # target directory's.
+                filemeta.storage = storage
+                filemeta.parent = target
+                filemeta.clean()
+                FileMeta.objects.filter(pk=filemeta.pk).update(storage=storage, parent=target)
+                self.touch(parent)
+                storage.touch(target)
+                invalidate_nodes(parent, target)
+
+                if storage != self:
+                    self.update_usage(size=-filemeta.size, files=-1)
+                    storage.update_usage(size=filemeta.size, files=1)
+                    record_change(self, CHANGE_DELETE, filemeta)
+                    record_change(storage, CHANGE_CREATE, filemeta)
+                else:
+                    record_change(self, CHANGE_MOVE, filemeta)
+
+    @instrument
+    def resolve(self, path, resolver=None):
+        # Pass a PathResolver to share resolved prefixes between lookups
+        return (resolver or PathResolver(self)).resolve(path)
+
+    @instrument
     def browse(self, parent=None):
         return list(itertools.chain(
             DirMeta.objects.filter(storage=self, parent=parent),
             FileMeta.objects.filter(storage=self, parent=parent)))
 
+    @instrument
+    def browse_page(self, parent=None, cursor=None, limit=100):
+        dirs, files, cursor = keyset_page(self, parent, cursor, limit)
+        return dirs + files, cursor
+
+    @instrument
+    def category_page(self, category, cursor=None, limit=100):
+        queryset = FileMeta.objects.filter(storage=self, category=category)
+        if cursor:
+            modified_at, id = cursor
+            queryset = queryset.filter(
+                Q(modified_at__lt=modified_at) | Q(modified_at=modified_at, id__lt=id))
+
+        page = list(queryset.order_by('-modified_at', '-id')[:limit + 1])
+        if len(page) <= limit:
+            return page, None
+
+        page = page[:limit]
+        return page, (page[-1].modified_at, page[-1].id)
+
     def documents(self):
-        document_mime_types = (
-            'application/msword',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.template',
-            'application/vnd.ms-word.document.macroEnabled.12',
-            'application/vnd.ms-word.template.macroEnabled.12',
-            'application/vnd.ms-excel',
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            'application/vnd.openxmlformats-officedocument.spreadsheetml.template',
-            'application/vnd.ms-excel.sheet.macroEnabled.12',
-            'application/vnd.ms-excel.template.macroEnabled.12',
-            'application/vnd.ms-excel.addin.macroEnabled.12',
-            'application/vnd.ms-excel.sheet.binary.macroEnabled.12',
-            'application/vnd.ms-powerpoint',
-            'application/vnd.openxmlformats-officedocument.presentationml.presentation',
-            'application/vnd.openxmlformats-officedocument.presentationml.template',
-            'application/vnd.openxmlformats-officedocument.presentationml.slideshow',
-            'application/vnd.ms-powerpoint.addin.macroEnabled.12',
-            'application/vnd.ms-powerpoint.presentation.macroEnabled.12',
-            'application/vnd.ms-powerpoint.template.macroEnabled.12',
-            'application/vnd.ms-powerpoint.slideshow.macroEnabled.12',
-        )
-        return FileMeta.objects.filter(
-            Q(storage=self),
-            Q(content_type__name__in=document_mime_types)).order_by('-modified_at')
+        return FileMeta.objects.filter(storage=self, category=CATEGORY_DOCUMENT).order_by('-modified_at', '-id')
 
     def images(self):
-        image_mime_types = (
-            'image/gif',
-            'image/jpeg',
-            'image/png',
-            'image/svg+xml',
-        )
-        return FileMeta.objects.filter(
-            Q(storage=self),
-            Q(content_type__name__in=image_mime_types)).order_by('-modified_at')
+        return FileMeta.objects.filter(storage=self, category=CATEGORY_IMAGE).order_by('-modified_at', '-id')
 
     def audios(self):
-        return FileMeta.objects.filter(
-            Q(storage=self),
-            Q(content_type__name__icontains='audio')).order_by('-modified_at')
+        return FileMeta.objects.filter(storage=self, category=CATEGORY_AUDIO).order_by('-modified_at', '-id')
 
     def videos(self):
-        return FileMeta.objects.filter(
-            Q(storage=self),
-            Q(content_type__name__icontains='video')).order_by('-modified_at')
+        return FileMeta.objects.filter(storage=self, category=CATEGORY_VIDEO).order_by('-modified_at', '-id')
 
 
 class MetaObject(MPTTModel):
@@ -188,6 +479,8 @@ class MetaObject(MPTTModel):
     storage = models.ForeignKey(Storage, null=False, blank=False)
     created_at = models.DateTimeField(auto_now=True, db_index=True)
     modified_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    # Set on the roots of what was moved into a trash storage
+    trashed_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     class Meta:
         abstract = True
@@ -196,10 +489,15 @@ class MetaObject(MPTTModel):
 class DirMeta(MetaObject):
     name = models.CharField(max_length=4096, null=False, blank=False, db_index=True)
     parent = TreeForeignKey('self', null=True, blank=False, related_name='children_dirs', db_index=True)
+    path = models.TextField(default='', editable=False, db_index=True)
+    version = models.BigIntegerField(default=0, editable=False)
 
     class Meta:
         unique_together = ('storage', 'name', 'parent')
-        index_together = ('storage', 'name', 'parent')
+        index_together = (
+            ('storage', 'name', 'parent'),
+            ('storage', 'parent', 'name', 'id'),
+        )
         ordering = ('name',)
 
     class MPTTMeta:
@@ -210,14 +508,18 @@ class DirMeta(MetaObject):
 
     def clean(self):
         if DirMeta.objects.filter(
-            Q(storage=self.storage), Q(name=self.name), Q(parent__isnull=True)).exists():
+            Q(storage=self.storage), Q(name=self.name), Q(parent=self.parent)).exclude(pk=self.pk).exists():
             raise ValidationError(_('Duplicate directory name.'))
 
         super(DirMeta, self).clean()
 
     def save(self, *args, **kwargs):
         self.clean()
-        super(DirMeta, self).save(*args, **kwargs)
+        if self._state.adding and not self.path:
+            self.path = node_path(self, self.parent)
+
+        with get_tree_backend().updates(DirMeta):
+            super(DirMeta, self).save(*args, **kwargs)
 
     @property
     def content_type(self):
@@ -232,11 +534,32 @@ class DirMeta(MetaObject):
         return self.parent is not None
 
     @property
+    @instrument
     def is_empty(self):
         return not any([
             DirMeta.objects.filter(parent=self).exists(),
             FileMeta.objects.filter(parent=self).exists()])
 
+    def ancestors(self, include_self=False):
+        return get_tree_backend().ancestors(self, include_self=include_self)
+
+    def descendants(self, include_self=False):
+        return get_tree_backend().descendants(self, include_self=include_self)
+
+    @instrument
+    def subtree_stats(self, cached=True):
+        return subtree_stats([self], cached=cached)[self.id]
+
+
+class TreeVersion(models.Model):
+    # Bumped whenever a tree changes. Cached subtree rollups are keyed on
+    # it, so every worker stops serving a tree's old rollups at once.
+    tree_key = models.CharField(max_length=64, unique=True)
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return '{} ({})'.format(self.tree_key, self.version)
+
 
 class MimeContentType(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -247,56 +570,246 @@ class MimeContentType(models.Model):
         return self.name
 
 
+class Blob(models.Model):
+    # Content shared by every FileMeta with the same sha256 digest
+    digest = models.CharField(max_length=64, unique=True)
+    key = models.CharField(max_length=1024)
+    size = models.BigIntegerField()
+    refcount = models.BigIntegerField(default=0, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest
+
+
 class FileMeta(MetaObject):
     name = models.CharField(max_length=4096, db_index=True)
     parent = TreeForeignKey(DirMeta, null=True, blank=False, related_name='children_files', db_index=True)
     content_type = models.ForeignKey(MimeContentType, null=True, blank=True)
     size = models.BigIntegerField()
+    category = models.SmallIntegerField(choices=CATEGORY_CHOICES, default=CATEGORY_OTHER)
+    blob = models.ForeignKey(Blob, null=True, blank=True, on_delete=models.PROTECT)
 
     class Meta:
         unique_together = ('storage', 'name', 'parent')
-        index_together = ('storage', 'name', 'parent')
-        ordering = ('name',)
-
+        index_together = (
+            ('storage', 'name', 'parent'),
+            ('storage', 'parent', 'name', 'id'),
+            ('storage', 'category', 'modified_at', 'id'),
+        )
         ordering = ('name',)
 
     def __str__(self):
         return self.name
 
     def clean(self):
-        if FileMeta.objects.filter(Q(storage=self.storage), Q(name=self.name), Q(parent__isnull=True)).exists():
+        if FileMeta.objects.filter(
+            Q(storage=self.storage), Q(name=self.name), Q(parent=self.parent)).exclude(pk=self.pk).exists():
             raise ValidationError(_('Duplicate file name.'))
 
         super(FileMeta, self).clean()
 
     def save(self, *args, **kwargs):
         self.clean()
-        super(FileMeta, self).save(*args, **kwargs)
+        self.category = content_category(self.content_type.name if self.content_type else None)
+        with get_tree_backend().updates(FileMeta):
+            super(FileMeta, self).save(*args, **kwargs)
 
     @property
     def has_parent(self):
         return self.parent is not None
 
+    @property
+    def object_key(self):
+        # Deduplicated files read their bytes from the shared blob
+        return self.blob.key if self.blob_id else self.id.hex
+
+
+class NameToken(models.Model):
+    # A trigram of a lowercased file name, for databases without pg_trgm
+    filemeta = models.ForeignKey(FileMeta, on_delete=models.CASCADE, related_name='name_tokens')
+    token = models.CharField(max_length=3)
+
+    class Meta:
+        index_together = (('token', 'filemeta'),)
+
+    def __str__(self):
+        return self.token
+
+
+class ChangeEntry(models.Model):
+    # Append-only journal of tree changes; seq increases per storage
+    storage = models.ForeignKey(Storage, on_delete=models.CASCADE)
+    seq = models.BigIntegerField()
+    action = models.SmallIntegerField(choices=CHANGE_CHOICES)
+    kind = models.CharField(max_length=4)
+    node_id = models.UUIDField()
+    parent_id = models.UUIDField(null=True)
+    name = models.CharField(max_length=4096)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = ('storage', 'seq')
+        ordering = ('seq',)
+
+    def __str__(self):
+        return '{} {}'.format(self.get_action_display(), self.name)
+
+
+class ThumbnailJob(models.Model):
+    # One job per (file, size); the worker writes the result into the
+    # owner's thumb storage
+    filemeta = models.ForeignKey(FileMeta, on_delete=models.CASCADE)
+    size = models.PositiveIntegerField()
+    status = models.SmallIntegerField(choices=JOB_STATUS_CHOICES, default=JOB_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    claim = models.UUIDField(null=True, blank=True, db_index=True)
+    thumbnail = models.ForeignKey(
+        FileMeta, null=True, blank=True, on_delete=models.SET_NULL, related_name='thumbnail_sources')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('filemeta', 'size')
+        index_together = (('status', 'run_after'),)
+
+    def __str__(self):
+        return '{} ({}px)'.format(self.filemeta_id, self.size)
+
+
+def enqueue_thumbnails(filemetas):
+    # Idempotent per (file, size): existing jobs are left alone
+    filemetas = [
+        filemeta for filemeta in filemetas
+        if filemeta.category in (CATEGORY_IMAGE, CATEGORY_VIDEO) and filemeta.storage.storage_type == STORAGE_MAIN]
+    if not filemetas:
+        return 0
+
+    existing = set(ThumbnailJob.objects.filter(filemeta__in=filemetas).values_list('filemeta', 'size'))
+    jobs = [
+        ThumbnailJob(filemeta=filemeta, size=size)
+        for filemeta in filemetas for size in settings.THUMBNAIL_SIZES
+        if (filemeta.id, size) not in existing]
+    ThumbnailJob.objects.bulk_create(jobs)
+    return len(jobs)
+
+
+class BatchJob(models.Model):
+    # A batch move, copy or trash too large to run inside a request; the
+    # payload holds the hex ids of the selected items and the target.
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    storage = models.ForeignKey(Storage, on_delete=models.CASCADE)
+    operation = models.CharField(max_length=8, choices=BATCH_OPERATION_CHOICES)
+    payload = models.TextField()
+    status = models.SmallIntegerField(choices=JOB_STATUS_CHOICES, default=JOB_PENDING)
+    result = models.TextField(blank=True, default='')
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('status', 'created_at'),)
+
+    def __str__(self):
+        return '{} ({})'.format(self.operation, self.get_status_display())
+
+
+class ObjectTombstone(models.Model):
+    # An object whose rows are gone. Written in the transaction deleting
+    # the rows and removed once the object store confirms the delete, so a
+    # crash in between never leaks the object.
+    key = models.CharField(max_length=1024)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.key
+
+
+class ReconcileRun(models.Model):
+    # One pass of reconcile_objects over the bucket. last_key is saved
+    # after every batch, so an interrupted pass resumes where it stopped.
+    last_key = models.CharField(max_length=1024, blank=True, default='')
+    stats = models.TextField(blank=True, default='')
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '{} ({})'.format(self.started_at, self.last_key or 'start')
+
+
+class UploadSession(models.Model):
+    # A resumable multipart upload; its id becomes the id (and object key)
+    # of the FileMeta created on completion.
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    storage = models.ForeignKey(Storage, on_delete=models.CASCADE)
+    parent = models.ForeignKey(DirMeta, null=True, blank=True, on_delete=models.CASCADE)
+    name = models.CharField(max_length=4096)
+    size = models.BigIntegerField()
+    part_size = models.BigIntegerField()
+    upload_id = models.CharField(max_length=1024)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def object_key(self):
+        return self.id.hex
+
+    @property
+    def part_count(self):
+        return max(1, -(-self.size // self.part_size))
+
+    def expected_part_size(self, number):
+        if number < self.part_count:
+            return self.part_size
+        return self.size - self.part_size * (self.part_count - 1)
+
+    def missing_parts(self, parts):
+        uploaded = dict((part.number, part.size) for part in parts)
+        return [
+            number for number in range(1, self.part_count + 1)
+            if uploaded.get(number, None) != self.expected_part_size(number)]
+
 # Create user profile
 @receiver(signals.post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
         Profile.objects.create(user=instance)
 
-# Create main storage for user profile
-@receiver(signals.post_save, sender=Profile)
-def create_main_storage(sender, instance, created, **kwargs):
-    if created:
-        Storage.objects.create(storage_type=1, owner=instance)
-
-# Create trash storage for user profile
+# Create the storages of a new profile
 @receiver(signals.post_save, sender=Profile)
-def create_trash_storage(sender, instance, created, **kwargs):
+def create_storages(sender, instance, created, **kwargs):
     if created:
-        Storage.objects.create(storage_type=2, owner=instance)
+        provision_storages([instance])
 
-# Create thumb storage for user profile
-@receiver(signals.post_save, sender=Profile)
-def create_thumb_storage(sender, instance, created, **kwargs):
+# Queue thumbnails for new images and videos
+@receiver(signals.post_save, sender=FileMeta)
+def queue_thumbnails(sender, instance, created, **kwargs):
     if created:
-        Storage.objects.create(storage_type=3, owner=instance)
+        enqueue_thumbnails([instance])
+
+# Drop cached content types when they change
+@receiver(signals.post_save, sender=MimeContentType)
+@receiver(signals.post_delete, sender=MimeContentType)
+def invalidate_mime_cache(sender, instance, **kwargs):
+    mime_cache.changed(instance.extension, pk=instance.pk)
+
+# Sessions deleted along with their storage or directory still hold parts
+# in the object store. Aborting is idempotent, so sessions completed or
+# aborted already cost one extra request.
+@receiver(signals.post_delete, sender=UploadSession)
+def abort_upload(sender, instance, **kwargs):
+    # The instance loses its pk once deleted
+    key, upload_id = instance.object_key, instance.upload_id
+
+    def abort():
+        try:
+            get_object_store().abort_multipart(key, upload_id)
+        except Exception:
+            logger.warning('Could not abort upload %s', upload_id, exc_info=True)
+    transaction.on_commit(abort)
@@ -0,0 +1,485 @@
+# Django
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Core
+from core.metrics import registry
+
+# Minio
+from minio import Minio
+from minio.definitions import UploadPart
+from minio.error import ResponseError
+from minio.helpers import get_target_url
+from minio.parsers import parse_list_objects_v2
+from minio.signer import presign_v4
+
+# Misc
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlparse, urlencode
+import certifi
+import hashlib
+import random
+import socket
+import threading
+import time
+import urllib3
+import uuid
+
+DEFAULT_OBJECT_STORE = 'core.objectstore.MinioBackend'
+
+STORES = {}
+
+ObjectInfo = namedtuple('ObjectInfo', ('key', 'size', 'etag', 'modified'))
+
+PartInfo = namedtuple('PartInfo', ('number', 'size', 'etag'))
+
+# S3 error codes worth another attempt
+TRANSIENT_CODES = ('InternalError', 'ServiceUnavailable', 'SlowDown', 'RequestTimeout')
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+def get_object_store():
+    # Stores are shared by the whole process, along with their connection
+    # and thread pools
+    path = getattr(settings, 'OBJECT_STORE_BACKEND', DEFAULT_OBJECT_STORE)
+    if path not in STORES:
+        STORES[path] = import_string(path)()
+    return STORES[path]
+
+
+def retry_delay(attempt):
+    # Full jitter, so clients that failed together do not retry together
+    delay = min(settings.OBJECT_STORE_RETRY_DELAY * 2 ** (attempt - 1), settings.OBJECT_STORE_RETRY_MAX_DELAY)
+    return random.uniform(0, delay)
+
+
+class ObjectStore(object):
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket or getattr(settings, 'MINIO_BUCKET', 'cloud')
+        self.executor = None
+        self.executor_lock = threading.Lock()
+
+    def transient(self, exc):
+        return False
+
+    def call(self, operation, function, *args, **kwargs):
+        # Runs one request against the store, retrying transient failures
+        # and recording the latency of every attempt
+        labels = {'operation': operation}
+        attempt = 0
+        while True:
+            attempt += 1
+            started = time.time()
+            try:
+                result = function(*args, **kwargs)
+                error = None
+            except Exception as exc:
+                error = exc
+            registry.observe('cloud_object_store_seconds', labels, time.time() - started)
+
+            if error is None:
+                return result
+            if attempt > settings.OBJECT_STORE_RETRIES or not self.transient(error):
+                registry.inc('cloud_object_store_failures_total', labels)
+                raise error
+            registry.inc('cloud_object_store_retries_total', labels)
+            time.sleep(retry_delay(attempt))
+
+    def map(self, function, items):
+        # Runs function over items on the store's bounded thread pool and
+        # returns the results in order
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=settings.OBJECT_STORE_CONCURRENCY)
+        return list(self.executor.map(function, items))
+
+    def stat_many(self, keys):
+        keys = list(keys)
+        return dict(zip(keys, self.map(self.stat, keys)))
+
+    def get_many(self, keys):
+        # Missing keys are left out
+        def get(key):
+            try:
+                return self.get(key)
+            except ObjectNotFound:
+                return None
+
+        keys = list(keys)
+        return dict((key, data) for key, data in zip(keys, self.map(get, keys)) if data is not None)
+
+    def put_many(self, items):
+        # items are (key, data) pairs
+        self.map(lambda item: self.put(*item), list(items))
+
+    def presigned_put_url(self, key, expires):
+        raise NotImplementedError
+
+    def presigned_get_url(self, key, expires):
+        raise NotImplementedError
+
+    def stat(self, key):
+        raise NotImplementedError
+
+    def put(self, key, data):
+        raise NotImplementedError
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def list_objects(self, start_after=None):
+        # Every object in key order, after start_after when given
+        raise NotImplementedError
+
+    def iter_chunks(self, key, chunk_size):
+        raise NotImplementedError
+
+    def iter_range(self, key, offset, length, chunk_size):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def delete_many(self, keys):
+        # Returns the keys that could not be deleted
+        def delete(key):
+            try:
+                self.delete(key)
+            except Exception:
+                return key
+
+        return [key for key in self.map(delete, list(keys)) if key is not None]
+
+    def create_multipart(self, key):
+        raise NotImplementedError
+
+    def presigned_part_url(self, key, upload_id, number, expires):
+        raise NotImplementedError
+
+    def list_parts(self, key, upload_id):
+        raise NotImplementedError
+
+    def complete_multipart(self, key, upload_id, parts):
+        raise NotImplementedError
+
+    def abort_multipart(self, key, upload_id):
+        raise NotImplementedError
+
+
+class MinioBackend(ObjectStore):
+
+    def __init__(self, bucket=None):
+        super(MinioBackend, self).__init__(bucket=bucket)
+        endpoint = urlparse(settings.MINIO_BACKEND)
+        self.client = Minio(
+            endpoint.netloc,
+            access_key=settings.MINIO_ACCESS_KEY,
+            secret_key=settings.MINIO_SECRET_KEY,
+            secure=endpoint.scheme == 'https')
+
+        # Keep-alive connections shared by every thread, so requests skip
+        # the TCP and TLS handshakes. Retries are left to call(). minio 2.0
+        # takes no http_client, so this and the private helpers below are
+        # tied to the pinned release; ObjectStoreTestCase covers them.
+        self.client._http = urllib3.PoolManager(
+            maxsize=settings.OBJECT_STORE_POOL_SIZE,
+            timeout=urllib3.Timeout(
+                connect=settings.OBJECT_STORE_CONNECT_TIMEOUT, read=settings.OBJECT_STORE_READ_TIMEOUT),
+            retries=False,
+            cert_reqs='CERT_REQUIRED',
+            ca_certs=certifi.where())
+
+    def transient(self, exc):
+        if isinstance(exc, ResponseError):
+            return exc.code in TRANSIENT_CODES
+        return isinstance(exc, (urllib3.exceptions.HTTPError, socket.error))
+
+    def presigned_put_url(self, key, expires):
+        return self.client.presigned_put_object(self.bucket, key, expires=timedelta(seconds=expires))
+
+    def presigned_get_url(self, key, expires):
+        return self.client.presigned_get_object(self.bucket, key, expires=timedelta(seconds=expires))
+
+    def stat(self, key):
+        try:
+            info = self.call('stat', self.client.stat_object, self.bucket, key)
+        except ResponseError as exc:
+            if exc.code in ('NoSuchKey', 'NoSuchObject'):
+                return None
+            raise
+
+        return ObjectInfo(key, info.size, info.etag, info.last_modified)
+
+    def put(self, key, data):
+        # A fresh reader per attempt, since a failed one may be half read
+        self.call('put', lambda: self.client.put_object(self.bucket, key, BytesReader(data), len(data)))
+
+    def get(self, key):
+        def get():
+            response = self.client.get_object(self.bucket, key)
+            try:
+                return response.data
+            finally:
+                response.release_conn()
+
+        try:
+            return self.call('get', get)
+        except ResponseError as exc:
+            if exc.code in ('NoSuchKey', 'NoSuchObject'):
+                raise ObjectNotFound(key)
+            raise
+
+    def list_objects(self, start_after=None):
+        # Pages through ListObjectsV2 by hand, since minio 2.0 cannot start
+        # after a key. Each page is one request, retried on its own.
+        query = {'list-type': 2, 'max-keys': 1000}
+        if start_after:
+            query['start-after'] = start_after
+
+        while True:
+            def page():
+                response = self.client._url_open('GET', bucket_name=self.bucket, query=query, headers={})
+                try:
+                    return parse_list_objects_v2(response.data, bucket_name=self.bucket)
+                finally:
+                    response.release_conn()
+
+            objects, truncated, token = self.call('list', page)
+            for info in objects:
+                yield ObjectInfo(info.object_name, info.size, info.etag, info.last_modified.timestamp())
+            if not truncated:
+                return
+            query['continuation-token'] = token
+
+    def iter_chunks(self, key, chunk_size):
+        return self.iter_range(key, 0, None, chunk_size)
+
+    def iter_range(self, key, offset, length, chunk_size):
+        # length=None reads to the end of the object. Only opening the
+        # stream is retried; a failure halfway through reaches the caller.
+        try:
+            if offset or length:
+                response = self.call(
+                    'get_range', self.client.get_partial_object, self.bucket, key, offset, length or 0)
+            else:
+                response = self.call('get', self.client.get_object, self.bucket, key)
+        except ResponseError as exc:
+            if exc.code in ('NoSuchKey', 'NoSuchObject'):
+                raise ObjectNotFound(key)
+            raise
+
+        try:
+            for chunk in response.stream(chunk_size):
+                yield chunk
+        finally:
+            response.release_conn()
+
+    def delete(self, key):
+        self.call('delete', self.client.remove_object, self.bucket, key)
+
+    def delete_many(self, keys):
+        # One request per 1000 keys; keys already gone count as deleted
+        def remove():
+            return list(self.client.remove_objects(self.bucket, list(keys)))
+
+        errors = self.call('delete_many', remove)
+        return [error.object_name for error in errors if error.error_code != 'NoSuchKey']
+
+    # minio 2.0 only exposes the multipart API through its private helpers
+
+    def create_multipart(self, key):
+        return self.call('create_multipart', self.client._new_multipart_upload, self.bucket, key)
+
+    def presigned_part_url(self, key, upload_id, number, expires):
+        region = self.client._get_bucket_region(self.bucket)
+        url = get_target_url(self.client._endpoint_url, bucket_name=self.bucket, object_name=key, bucket_region=region)
+        # presign_v4 cannot sign a url that already has a query string, but
+        # it signs response_headers as query parameters
+        return presign_v4(
+            'PUT', url, self.client._access_key, self.client._secret_key, region=region,
+            response_headers={'partNumber': str(number), 'uploadId': upload_id}, expires=expires)
+
+    def list_parts(self, key, upload_id):
+        try:
+            return self.call('list_parts', lambda: [
+                PartInfo(part.part_number, part.size, part.etag)
+                for part in self.client._list_object_parts(self.bucket, key, upload_id)])
+        except ResponseError as exc:
+            if exc.code == 'NoSuchUpload':
+                raise ObjectNotFound(key)
+            raise
+
+    def complete_multipart(self, key, upload_id, parts):
+        uploaded = OrderedDict(
+            (part.number, UploadPart(self.bucket, key, upload_id, part.number, part.etag, None, part.size))
+            for part in sorted(parts))
+        self.call('complete_multipart', self.client._complete_multipart_upload, self.bucket, key, upload_id, uploaded)
+
+    def abort_multipart(self, key, upload_id):
+        try:
+            self.call('abort_multipart', self.client._remove_incomplete_upload, self.bucket, key, upload_id)
+        except ResponseError as exc:
+            if exc.code != 'NoSuchUpload':
+                raise
+
+
+class BytesReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size < 0 else self.offset + size
+        chunk = self.data[self.offset:end]
+        self.offset += len(chunk)
+        return chunk
+
+
+class MemoryBackend(ObjectStore):
+    # In-process stand-in for an S3-compatible server, for tests and local
+    # development. Presigned URLs use a memory:// scheme; clients "upload"
+    # by calling put() directly. Failures can be injected to exercise the
+    # retries.
+
+    def __init__(self, bucket=None):
+        super(MemoryBackend, self).__init__(bucket=bucket)
+        self.objects = {}
+        self.uploads = {}
+        self.faults = {}
+        self.lock = threading.Lock()
+
+    def transient(self, exc):
+        return isinstance(exc, ConnectionError)
+
+    def inject(self, operation, error, times=1):
+        # The next `times` attempts of the operation raise `error`
+        with self.lock:
+            self.faults[operation] = [error] * times
+
+    def request(self, operation, function, *args):
+        def attempt():
+            with self.lock:
+                faults = self.faults.get(operation, None)
+                if faults:
+                    raise faults.pop()
+            return function(*args)
+        return self.call(operation, attempt)
+
+    def presign(self, method, key, expires):
+        return 'memory://{}/{}?{}'.format(self.bucket, key, urlencode({
+            'method': method,
+            'expires': int(time.time()) + expires,
+        }))
+
+    def presigned_put_url(self, key, expires):
+        return self.presign('PUT', key, expires)
+
+    def presigned_get_url(self, key, expires):
+        return self.presign('GET', key, expires)
+
+    def stat(self, key):
+        def stat():
+            with self.lock:
+                return self.objects.get(key, None)
+
+        entry = self.request('stat', stat)
+        if entry is None:
+            return None
+
+        data, modified = entry
+        return ObjectInfo(key, len(data), hashlib.md5(data).hexdigest(), modified)
+
+    def put(self, key, data):
+        def put():
+            with self.lock:
+                self.objects[key] = (bytes(data), time.time())
+        self.request('put', put)
+
+    def get(self, key):
+        def get():
+            with self.lock:
+                if key not in self.objects:
+                    raise ObjectNotFound(key)
+                return self.objects[key][0]
+        return self.request('get', get)
+
+    def list_objects(self, start_after=None):
+        def snapshot():
+            with self.lock:
+                return sorted(
+                    (key, entry) for key, entry in self.objects.items() if start_after is None or key > start_after)
+
+        for key, (data, modified) in self.request('list', snapshot):
+            yield ObjectInfo(key, len(data), hashlib.md5(data).hexdigest(), modified)
+
+    def iter_chunks(self, key, chunk_size):
+        return self.iter_range(key, 0, None, chunk_size)
+
+    def iter_range(self, key, offset, length, chunk_size):
+        data = self.get(key)
+        end = len(data) if length is None else min(len(data), offset + length)
+        for start in range(offset, end, chunk_size):
+            yield data[start:min(start + chunk_size, end)]
+
+    def delete(self, key):
+        def delete():
+            with self.lock:
+                self.objects.pop(key, None)
+        self.request('delete', delete)
+
+    def create_multipart(self, key):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.uploads[upload_id] = (key, {})
+        return upload_id
+
+    def presigned_part_url(self, key, upload_id, number, expires):
+        return '{}&{}'.format(self.presign('PUT', key, expires), urlencode({
+            'uploadId': upload_id,
+            'partNumber': number,
+        }))
+
+    def upload_parts(self, key, upload_id):
+        upload = self.uploads.get(upload_id, None)
+        if upload is None or upload[0] != key:
+            raise ObjectNotFound(key)
+        return upload[1]
+
+    def put_part(self, key, upload_id, number, data):
+        with self.lock:
+            self.upload_parts(key, upload_id)[number] = bytes(data)
+
+    def list_parts(self, key, upload_id):
+        with self.lock:
+            parts = self.upload_parts(key, upload_id)
+            return [
+                PartInfo(number, len(data), hashlib.md5(data).hexdigest())
+                for number, data in sorted(parts.items())]
+
+    def complete_multipart(self, key, upload_id, parts):
+        with self.lock:
+            uploaded = self.upload_parts(key, upload_id)
+            for part in parts:
+                data = uploaded.get(part.number, None)
+                if data is None or hashlib.md5(data).hexdigest() != part.etag:
+                    raise ValueError('Invalid part {}.'.format(part.number))
+
+            self.objects[key] = (b''.join(uploaded[part.number] for part in sorted(parts)), time.time())
+            del self.uploads[upload_id]
+
+    def abort_multipart(self, key, upload_id):
+        with self.lock:
+            self.uploads.pop(upload_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.objects.clear()
+            self.uploads.clear()
+            self.faults.clear()
@@ -0,0 +1,28 @@
+# DRF
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+# Misc
+import json
+
+
+class NDJSONParser(BaseParser):
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', 'utf-8')
+        return self.iter_lines(stream, encoding)
+
+    def iter_lines(self, stream, encoding):
+        if stream is None:
+            return
+
+        for number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                yield json.loads(line.decode(encoding))
+            except ValueError as exc:
+                raise ParseError('NDJSON parse error on line {} - {}'.format(number, exc))
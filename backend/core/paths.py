@@ -0,0 +1,107 @@
+# Django
+from django.apps import apps
+from django.db.models import Q
+
+# Core
+from core.tree import get_tree_backend
+
+CHUNK_SIZE = 500
+
+# Marks prefixes known to name no directory
+MISSING = object()
+
+
+def split_path(path):
+    # '/photos/2016/' -> ('photos', '2016')
+    return tuple(segment for segment in path.split('/') if segment)
+
+
+class PathResolver(object):
+    # Resolves paths within one storage. The directories of any number of
+    # paths come from a single query matching each segment by name and
+    # depth; the candidates are then walked from the root in memory. Files
+    # take one more query. Resolved prefixes are kept, so later lookups
+    # made through the same resolver only query the segments that are new.
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.prefixes = {(): None}
+
+    def load(self, paths):
+        DirMeta = apps.get_model('core', 'DirMeta')
+
+        wanted = {}
+        for segments in paths:
+            for depth in range(len(segments)):
+                if segments[:depth + 1] not in self.prefixes:
+                    wanted.setdefault(depth, set()).add(segments[depth])
+        if not wanted:
+            return
+
+        query = Q()
+        for depth, names in wanted.items():
+            query |= Q(level=depth, name__in=names)
+        children = dict(
+            ((dirmeta.parent_id, dirmeta.name), dirmeta)
+            for dirmeta in DirMeta.objects.filter(query, storage=self.storage))
+
+        for segments in paths:
+            parent = None
+            for depth in range(len(segments)):
+                prefix = segments[:depth + 1]
+                if prefix not in self.prefixes:
+                    self.prefixes[prefix] = MISSING if parent is MISSING else children.get(
+                        (parent.id if parent else None, segments[depth]), MISSING)
+                parent = self.prefixes[prefix]
+
+    def directory(self, segments):
+        node = self.prefixes.get(segments, MISSING)
+        return None if node is MISSING else node
+
+    def breadcrumbs(self, segments):
+        # The directories above a resolved path, root first
+        return [self.prefixes[segments[:depth]] for depth in range(1, len(segments))]
+
+    def resolve_many(self, paths):
+        # Maps each path to its DirMeta or FileMeta, or None. A directory
+        # wins over a file of the same name; a trailing slash rules files out.
+        FileMeta = apps.get_model('core', 'FileMeta')
+        parsed = dict((path, split_path(path)) for path in paths)
+        self.load(set(parsed.values()))
+
+        results = {}
+        files = {}
+        for path, segments in parsed.items():
+            node = self.directory(segments) if segments else None
+            results[path] = node
+            if node is None and segments and not path.endswith('/'):
+                parent = self.directory(segments[:-1]) if len(segments) > 1 else None
+                if len(segments) == 1 or parent is not None:
+                    key = (parent.id if parent else None, segments[-1])
+                    files.setdefault(key, (parent, []))[1].append(path)
+
+        keys = list(files)
+        for start in range(0, len(keys), CHUNK_SIZE):
+            query = Q()
+            for parent_id, name in keys[start:start + CHUNK_SIZE]:
+                query |= Q(parent_id=parent_id, name=name)
+            for filemeta in FileMeta.objects.filter(query, storage=self.storage):
+                parent, matched = files[(filemeta.parent_id, filemeta.name)]
+                filemeta.parent = parent
+                for path in matched:
+                    results[path] = filemeta
+        return results
+
+    def resolve(self, path):
+        return self.resolve_many([path])[path]
+
+
+def breadcrumbs(node):
+    # Ancestors of a DirMeta or FileMeta, root first, in one query once a
+    # file's parent is loaded
+    DirMeta = apps.get_model('core', 'DirMeta')
+    if isinstance(node, DirMeta):
+        return list(get_tree_backend().ancestors(node))
+    if node.parent_id is None:
+        return []
+    return list(get_tree_backend().ancestors(node.parent, include_self=True))
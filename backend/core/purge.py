@@ -0,0 +1,166 @@
+# Django
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+# Core
+from core.dedup import release_objects
+from core.journal import record_change, CHANGE_DELETE
+from core.models import DirMeta, FileMeta, ObjectTombstone, Storage, STORAGE_TRASH
+from core.objectstore import get_object_store
+from core.tree import get_tree_backend
+
+# Misc
+from collections import Counter
+from datetime import timedelta
+import time
+
+# Trash is purged one root at a time, oldest first, in small transactions
+# that lock only the rows of their batch. Each batch updates the storage's
+# usage and writes tombstones for the objects it frees, so a crash loses
+# nothing: the next run carries on with what is left of the root and
+# flushes the tombstones. Files sharing a blob only drop their reference;
+# the blob's object is left to collect_blobs.
+
+
+def trashed_key(root):
+    # Roots without trashed_at go last
+    return (root.trashed_at is None, root.trashed_at.timestamp() if root.trashed_at else 0, root.id.hex)
+
+
+def oldest_root(storage, cutoff=None):
+    # Roots moved into the trash without going through trash_items have no
+    # trashed_at. They never age past the retention window and are only
+    # purged when the storage is over quota and no dated root is left.
+    roots = []
+    for model in (DirMeta, FileMeta):
+        queryset = model.objects.filter(storage=storage, parent=None, trashed_at__isnull=False)
+        if cutoff is not None:
+            queryset = queryset.filter(trashed_at__lt=cutoff)
+        roots.extend(queryset.order_by('trashed_at', 'id')[:1])
+
+    if not roots and cutoff is None:
+        for model in (DirMeta, FileMeta):
+            roots.extend(model.objects.filter(storage=storage, parent=None, trashed_at__isnull=True).order_by('id')[:1])
+    return min(roots, key=trashed_key) if roots else None
+
+
+def delete_files(storage, ids):
+    with transaction.atomic():
+        files = list(FileMeta.objects.select_for_update().filter(storage=storage, id__in=ids))
+        if not files:
+            return 0, 0
+
+        queryset = FileMeta.objects.filter(id__in=[filemeta.id for filemeta in files])
+        release_objects(queryset)
+        queryset.delete()
+
+        size = sum(filemeta.size for filemeta in files)
+        storage.update_usage(size=-size, files=-len(files))
+    return len(files), size
+
+
+def delete_dirs(storage, ids):
+    # Called deepest first, so the batch has no children left outside it
+    with transaction.atomic():
+        ids = list(DirMeta.objects.select_for_update().filter(storage=storage, id__in=ids).values_list('id', flat=True))
+        DirMeta.objects.filter(id__in=ids).delete()
+        storage.update_usage(dirs=-len(ids))
+    return len(ids)
+
+
+def purge_root(storage, root, stats, batch_size, pause=0):
+    if isinstance(root, FileMeta):
+        with transaction.atomic():
+            files, size = delete_files(storage, [root.id])
+            if files:
+                record_change(storage, CHANGE_DELETE, root)
+                storage.touch(None)
+        stats.update(roots=files, files=files, size=size)
+        return
+
+    backend = get_tree_backend()
+    subtree = backend.descendants(root, include_self=True)
+    while True:
+        ids = list(FileMeta.objects.filter(storage=storage, parent__in=subtree).values_list('id', flat=True)[:batch_size])
+        files, size = delete_files(storage, ids) if ids else (0, 0)
+        if not files:
+            break
+        stats.update(files=files, size=size)
+        stats['objects'] += flush_tombstones()
+        time.sleep(pause)
+
+    while True:
+        ids = list(backend.descendants(root).filter(storage=storage).order_by('-level', 'id').values_list(
+            'id', flat=True)[:batch_size])
+        dirs = delete_dirs(storage, ids) if ids else 0
+        if not dirs:
+            break
+        stats.update(dirs=dirs)
+        time.sleep(pause)
+
+    # The subtree is empty now, so closing its gap is a single UPDATE
+    with transaction.atomic():
+        root = DirMeta.objects.select_for_update().filter(pk=root.pk, storage=storage, parent=None).first()
+        if root is None:
+            return
+        record_change(storage, CHANGE_DELETE, root)
+        backend.delete(root)
+        storage.update_usage(dirs=-1)
+        storage.touch(None)
+    stats.update(roots=1, dirs=1)
+
+
+def flush_tombstones(batch_size=None):
+    # Keys the store failed to delete keep their tombstone for the next run
+    batch_size = batch_size or settings.OBJECT_DELETE_BATCH_SIZE
+    store = get_object_store()
+    flushed = 0
+    last_id = 0
+
+    while True:
+        tombstones = list(ObjectTombstone.objects.filter(id__gt=last_id).order_by('id')[:batch_size])
+        if not tombstones:
+            return flushed
+        last_id = tombstones[-1].id
+
+        failed = set(store.delete_many([tombstone.key for tombstone in tombstones]))
+        deleted = [tombstone.id for tombstone in tombstones if tombstone.key not in failed]
+        ObjectTombstone.objects.filter(id__in=deleted).delete()
+        flushed += len(deleted)
+
+
+def purge_storage(storage, now=None, batch_size=None, pause=0):
+    # Purges roots past the retention window, then keeps purging the
+    # oldest ones while the storage is over its quota
+    now = now or timezone.now()
+    batch_size = batch_size or settings.TRASH_PURGE_BATCH_SIZE
+    cutoff = now - timedelta(days=settings.TRASH_RETENTION_DAYS)
+    stats = Counter()
+
+    while True:
+        storage.refresh_from_db(fields=['used_size'])
+        over_quota = storage.used_size > storage.capacity_quota
+        root = oldest_root(storage, None if over_quota else cutoff)
+        if root is None:
+            break
+        purge_root(storage, root, stats, batch_size, pause)
+
+    stats['objects'] += flush_tombstones()
+    return stats
+
+
+def purge_trash(now=None, batch_size=None, pause=0):
+    # Leftover tombstones of a crashed run go first
+    stats = Counter(objects=flush_tombstones())
+    storages = Storage.objects.filter(storage_type=STORAGE_TRASH).select_related('owner__service').order_by('id')
+
+    last_id = 0
+    while True:
+        batch = list(storages.filter(id__gt=last_id)[:100])
+        if not batch:
+            return stats
+        last_id = batch[-1].id
+
+        for storage in batch:
+            stats.update(purge_storage(storage, now=now, batch_size=batch_size, pause=pause))
@@ -0,0 +1,158 @@
+# Django
+from django.conf import settings
+from django.utils import timezone
+
+# Core
+from core.bulk import chunked, keyset_iterator
+from core.models import Blob, FileMeta, ReconcileRun
+from core.objectstore import get_object_store
+
+# Misc
+from collections import Counter
+from datetime import timedelta
+import heapq
+import itertools
+import json
+import string
+import time
+import uuid
+
+# The bucket listing and the keys the metadata expects are both walked in
+# key order and merge-joined, a batch of keys at a time, so memory stays
+# flat however large the bucket is. Object keys are flat hex ids shared by
+# every storage, so the pass covers the whole bucket; mismatches name the
+# storage of the row involved. Anything younger than the grace period may
+# still be mid-upload or mid-delete and is left alone.
+
+OBJECT, FILE, BLOB = 0, 1, 2
+
+HEX = set(string.hexdigits.lower())
+
+
+def uuid_floor(key):
+    # The smallest id whose hex could sort after key
+    prefix = ''.join(itertools.takewhile(lambda char: char in HEX, key[:32]))
+    return uuid.UUID(hex=prefix.ljust(32, '0'))
+
+
+def expected_objects(start_after=None, batch_size=None):
+    # Files without a blob own the object named after their id; blobs own
+    # the object under their key
+    files = FileMeta.objects.filter(blob__isnull=True).only('id', 'storage', 'parent', 'size', 'created_at')
+    blobs = Blob.objects.only('id', 'key', 'size', 'created_at')
+    if start_after:
+        files = files.filter(id__gte=uuid_floor(start_after))
+        blobs = blobs.filter(key__gt=start_after)
+
+    entries = heapq.merge(
+        ((filemeta.id.hex, FILE, filemeta) for filemeta in keyset_iterator(files, ('id',), batch_size)),
+        ((blob.key, BLOB, blob) for blob in keyset_iterator(blobs, ('key', 'id'), batch_size)),
+        key=lambda entry: entry[0])
+    return (entry for entry in entries if not start_after or entry[0] > start_after)
+
+
+def latest_run(restart=False):
+    run = ReconcileRun.objects.filter(finished_at__isnull=True).order_by('-id').first()
+    if run is None or restart:
+        run = ReconcileRun.objects.create()
+    return run
+
+
+def still_unreferenced(keys):
+    # Rows created after their range was read adopt objects that looked
+    # orphaned, so keys are checked again right before deleting
+    referenced = set()
+    for chunk in chunked(keys):
+        ids = [uuid.UUID(key) for key in chunk if len(key) == 32 and set(key) <= HEX]
+        referenced.update(Blob.objects.filter(key__in=chunk).values_list('key', flat=True))
+        referenced.update(id.hex for id in FileMeta.objects.filter(id__in=ids).values_list('id', flat=True))
+    return [key for key in keys if key not in referenced]
+
+
+def delete_orphans(store, keys, stats):
+    keys = still_unreferenced(keys)
+    failed = store.delete_many(keys) if keys else []
+    stats.update(deleted=len(keys) - len(failed), failed=len(failed))
+
+
+def remove_dangling(store, filemeta, stats):
+    # The object may have shown up since the listing was read
+    if store.stat(filemeta.id.hex) is not None:
+        return
+    filemeta = FileMeta.objects.select_related('storage', 'parent').filter(pk=filemeta.pk, blob__isnull=True).first()
+    if filemeta is not None:
+        filemeta.storage.delete_filemeta(parent=filemeta.parent, id=filemeta.id)
+        stats['repaired'] += 1
+
+
+def reconcile_objects(run, batch_size=None, delete=False, repair=False, pause=0, rate=None, report=None):
+    # Orphaned objects are deleted with delete=True, files whose object is
+    # gone with repair=True; otherwise mismatches are only counted and
+    # passed to report(kind, key, detail). rate caps the keys checked per
+    # second.
+    batch_size = batch_size or settings.RECONCILE_BATCH_SIZE
+    report = report or (lambda kind, key, detail: None)
+    store = get_object_store()
+    stats = Counter(json.loads(run.stats) if run.stats else {})
+    cutoff = time.time() - settings.RECONCILE_GRACE_SECONDS
+    row_cutoff = timezone.now() - timedelta(seconds=settings.RECONCILE_GRACE_SECONDS)
+
+    start_after = run.last_key or None
+    entries = heapq.merge(
+        ((info.key, OBJECT, info) for info in store.list_objects(start_after=start_after)),
+        expected_objects(start_after, batch_size),
+        key=lambda entry: entry[0])
+    groups = ((key, list(group)) for key, group in itertools.groupby(entries, key=lambda entry: entry[0]))
+
+    started = time.time()
+    checked = 0
+    while True:
+        batch = list(itertools.islice(groups, batch_size))
+        if not batch:
+            break
+
+        orphans = []
+        dangling = []
+        for key, group in batch:
+            info = next((item for key, kind, item in group if kind == OBJECT), None)
+            rows = [(kind, item) for key, kind, item in group if kind != OBJECT]
+            stats['keys'] += 1
+
+            if info is not None and not rows:
+                stats.update(orphans=1, orphan_bytes=info.size)
+                report('orphan', key, '{} bytes'.format(info.size))
+                if info.modified < cutoff:
+                    orphans.append(key)
+                else:
+                    stats['recent'] += 1
+
+            for kind, item in rows:
+                if info is None and kind == FILE:
+                    stats['missing_files'] += 1
+                    report('missing', key, 'file {} in storage {}'.format(item.id, item.storage_id))
+                    if item.created_at < row_cutoff:
+                        dangling.append(item)
+                elif info is None:
+                    stats['missing_blobs'] += 1
+                    report('missing', key, 'blob {}'.format(item.id))
+                elif info.size != item.size:
+                    stats['size_mismatches'] += 1
+                    report('size', key, '{} bytes stored, {} expected'.format(info.size, item.size))
+
+        if delete and orphans:
+            delete_orphans(store, orphans, stats)
+        if repair:
+            for filemeta in dangling:
+                remove_dangling(store, filemeta, stats)
+
+        run.last_key = batch[-1][0]
+        run.stats = json.dumps(stats)
+        run.save(update_fields=['last_key', 'stats'])
+
+        checked += len(batch)
+        wait = checked / rate - (time.time() - started) if rate else 0
+        time.sleep(max(wait, 0) + pause)
+
+    run.finished_at = timezone.now()
+    run.save(update_fields=['finished_at'])
+    return stats
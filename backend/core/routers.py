@@ -1,19 +1,558 @@
+# Django
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.http import quote_etag, urlquote
+from django.utils.dateparse import parse_datetime
+
 # DRF
-from rest_framework import routers, viewsets
+from rest_framework import routers, viewsets, permissions, serializers, status
+from rest_framework.decorators import detail_route, list_route
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
 
 # Core
-from core.models import Storage
-from core.serializers import FileMetaSerializer
+from core.archive import stream_archive
+from core.batch import run_batch, enqueue_batch, estimate_rows
+from core.bulk import import_tree
+from core.dedup import deduplicate_upload
+from core.downloads import download_response, parse_etag_list
+from core.journal import changes_since, current_sequence
+from core.listcache import get_listing_cache, listing_key
+from core.listing import listing_page
+from core.models import DirMeta, FileMeta, UploadSession, BatchJob, CATEGORY_CHOICES, CATEGORY_OTHER
+from core.objectstore import get_object_store
+from core.parsers import NDJSONParser
+from core.paths import PathResolver, split_path, breadcrumbs
+from core.search import get_search_backend, file_paths, SEARCH_MODES, SEARCH_SUBSTRING
+from core.serializers import (
+    DirMetaSerializer, FileMetaSerializer,
+    UploadSerializer, UploadCompleteSerializer,
+    UploadSessionSerializer, UploadSessionCreateSerializer, UploadPartsSerializer,
+    BatchSerializer, BatchJobSerializer, ImportSerializer)
+from core.stats import subtree_stats
+from core.thumbnails import thumbnail_map
+from core.uploads import create_session, sign_parts, session_parts, complete_session, abort_session
+
+# Misc
+from collections.abc import Iterator
+import base64
+import json
+import uuid
+
+
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+
+    payload = json.dumps(list(cursor), cls=DjangoJSONEncoder).encode('utf-8')
+    return base64.urlsafe_b64encode(payload).decode('ascii')
+
+
+def decode_cursor(value, *types):
+    if not value:
+        return None
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(value.encode('ascii')).decode('utf-8'))
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError(values)
+        return tuple(convert(item) for convert, item in zip(types, values))
+    except (TypeError, ValueError, UnicodeError):
+        raise ParseError('Invalid cursor.')
+
+
+def crumbs(dirmetas):
+    return [{'id': str(dirmeta.id), 'name': dirmeta.name} for dirmeta in dirmetas]
+
+
+def entry_kind(value):
+    if value not in ('dir', 'file'):
+        raise ValueError(value)
+    return value
+
+
+def timestamp(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed
+
 
+class StorageViewSet(viewsets.ViewSet):
+    permission_classes = (permissions.IsAuthenticated,)
+    default_page_size = 100
+    max_page_size = 1000
 
-class MainStorageViewSet(viewsets.ViewSet):
+    def get_storage(self, request):
+        return request.user.profile.main_storage()
+
+    def get_parent(self, request, storage):
+        return self.lookup_parent(storage, request.query_params.get('parent', None))
+
+    def lookup_parent(self, storage, parent):
+        if not parent:
+            return None
+
+        try:
+            return get_object_or_404(DirMeta, id=uuid.UUID(str(parent)), storage=storage)
+        except ValueError:
+            raise ParseError('Invalid parent.')
+
+    def get_dirmeta(self, request, pk):
+        try:
+            return get_object_or_404(DirMeta, id=uuid.UUID(pk), storage__owner=request.user.profile)
+        except ValueError:
+            raise NotFound()
+
+    def get_filemeta(self, request, pk):
+        try:
+            return get_object_or_404(
+                FileMeta.objects.select_related('blob', 'content_type'),
+                id=uuid.UUID(pk), storage__owner=request.user.profile)
+        except ValueError:
+            raise NotFound()
+
+    def get_page_size(self, request):
+        try:
+            limit = int(request.query_params.get('limit', self.default_page_size))
+        except ValueError:
+            raise ParseError('Invalid limit.')
+
+        return max(1, min(limit, self.max_page_size))
+
+
+class MainStorageViewSet(StorageViewSet):
+    # Listings are stamped with the version of the listed directory. Repeat
+    # requests are answered from the ETag or the listing cache without
+    # touching DirMeta/FileMeta rows; subtree stats are not versioned and
+    # bypass both.
 
     def list(self, request):
-        storage = Storage.objects.get(owner=request.user.profile)
-        queryset = storage.browse()
-        return Response(serializer.data)
+        storage = self.get_storage(request)
+        parent = self.get_parent(request, storage)
+        if request.query_params.get('stats', None):
+            return Response(self.listing(request, storage, parent))
+
+        params = dict((name, request.query_params.get(name, '')) for name in ('cursor', 'limit'))
+        version = parent.version if parent else storage.root_version
+        key = listing_key(storage, parent, version, params)
+        etag = quote_etag(key)
+
+        if etag in parse_etag_list(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            cache = get_listing_cache()
+            data = cache.get(key)
+            if data is None:
+                data = self.listing(request, storage, parent)
+                cache.set(key, data)
+            response = Response(data)
+
+        response['ETag'] = etag
+        return response
+
+    def listing(self, request, storage, parent):
+        directories, files, cursor = listing_page(
+            storage,
+            parent=parent,
+            cursor=decode_cursor(request.query_params.get('cursor', None), entry_kind, str, uuid.UUID),
+            limit=self.get_page_size(request))
+
+        if request.query_params.get('stats', None) and directories:
+            stats = subtree_stats(DirMeta.objects.filter(id__in=[item['id'] for item in directories]))
+            for item in directories:
+                item.update(stats[uuid.UUID(item['id'])])
+
+        thumbnails = thumbnail_map([item['id'] for item in files]) if files else {}
+        for item in files:
+            item['thumbnails'] = thumbnails.get(uuid.UUID(item['id']), {})
+
+        return {
+            'next': encode_cursor(cursor),
+            'directories': directories,
+            'files': files,
+        }
+
+
+class SearchViewSet(StorageViewSet):
+    # Ranked name search over the main storage; pages are addressed by
+    # offset since the ranking has no stable key to resume from
+    max_offset = 10000
+
+    def list(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ParseError('Missing query.')
+
+        mode = request.query_params.get('mode', SEARCH_SUBSTRING)
+        if mode not in SEARCH_MODES:
+            raise ParseError('Invalid mode.')
+
+        limit = self.get_page_size(request)
+        cursor = decode_cursor(request.query_params.get('cursor', None), int)
+        offset = cursor[0] if cursor else 0
+        if not 0 <= offset <= self.max_offset:
+            raise ParseError('Invalid cursor.')
+
+        hits = get_search_backend().search(self.get_storage(request), query, mode, offset=offset, limit=limit + 1)
+        more = len(hits) > limit
+        hits = hits[:limit]
+
+        paths = file_paths(hits)
+        data = FileMetaSerializer(hits, many=True).data
+        for filemeta, item in zip(hits, data):
+            item['path'] = paths[filemeta.id]
+            item['score'] = round(filemeta.score, 3)
+
+        return Response({
+            'next': encode_cursor((offset + limit,)) if more else None,
+            'results': data,
+        })
+
+
+class PathViewSet(StorageViewSet):
+    # Resolves one or more `path` parameters with a resolver shared by the
+    # whole request, so common prefixes are looked up once
+
+    def list(self, request):
+        paths = request.query_params.getlist('path')
+        if not 1 <= len(paths) <= settings.PATH_MAX_LOOKUPS:
+            raise ParseError('Between 1 and {} paths are allowed per request.'.format(settings.PATH_MAX_LOOKUPS))
+
+        storage = self.get_storage(request)
+        resolver = PathResolver(storage)
+        nodes = resolver.resolve_many(paths)
+
+        results = []
+        for path in paths:
+            node = nodes[path]
+            result = {'path': path, 'type': None, 'item': None, 'breadcrumbs': []}
+            if node is not None:
+                directory = isinstance(node, DirMeta)
+                result.update({
+                    'type': 'dir' if directory else 'file',
+                    'item': (DirMetaSerializer if directory else FileMetaSerializer)(node).data,
+                    'breadcrumbs': crumbs(resolver.breadcrumbs(split_path(path))),
+                })
+            results.append(result)
+        return Response({'results': results})
+
+
+class ImportViewSet(StorageViewSet):
+    parser_classes = (NDJSONParser, JSONParser)
+
+    def create(self, request):
+        storage = self.get_storage(request)
+        parent = self.get_parent(request, storage)
+
+        entries = request.data
+        if not isinstance(entries, Iterator):
+            serializer = ImportSerializer(data={'entries': entries} if isinstance(entries, list) else entries)
+            serializer.is_valid(raise_exception=True)
+            entries = serializer.validated_data['entries']
+
+        try:
+            result = import_tree(storage, entries, parent=parent)
+        except ValidationError as exc:
+            raise ParseError(exc.messages[0])
+
+        return Response(result, status=status.HTTP_201_CREATED)
+
+
+class FeedViewSet(StorageViewSet):
+    categories = dict((name, category) for category, name in CATEGORY_CHOICES if category != CATEGORY_OTHER)
+
+    def retrieve(self, request, pk=None):
+        category = self.categories.get(pk, None)
+        if category is None:
+            raise NotFound()
+
+        storage = self.get_storage(request)
+        page, cursor = storage.category_page(
+            category,
+            cursor=decode_cursor(request.query_params.get('cursor', None), timestamp, uuid.UUID),
+            limit=self.get_page_size(request))
+
+        return Response({
+            'next': encode_cursor(cursor),
+            'files': FileMetaSerializer(page, many=True).data,
+        })
+
+
+class ChangeViewSet(StorageViewSet):
+    # Without a cursor, or with one older than the retained journal, the
+    # client is told to reset: list the tree, then follow the returned cursor.
+
+    def list(self, request):
+        storage = self.get_storage(request)
+        cursor = decode_cursor(request.query_params.get('cursor', None), int)
+
+        result = None
+        if cursor is not None:
+            result = changes_since(storage, cursor[0], limit=self.get_page_size(request))
+
+        if result is None:
+            return Response({
+                'reset': True,
+                'cursor': encode_cursor([current_sequence(storage)]),
+                'more': False,
+                'changes': [],
+            })
+
+        changes, seq, more = result
+        return Response({
+            'reset': False,
+            'cursor': encode_cursor([seq]),
+            'more': more,
+            'changes': changes,
+        })
+
+
+class UploadViewSet(StorageViewSet):
+    salt = 'core.uploads'
+
+    def create(self, request):
+        serializer = UploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        name = serializer.validated_data['name']
+        size = serializer.validated_data['size']
+
+        storage = self.get_storage(request)
+        parent = self.lookup_parent(storage, serializer.validated_data.get('parent', None))
+        if not storage.has_space_for(size):
+            raise serializers.ValidationError({'size': ['Storage quota exceeded.']})
+        if FileMeta.objects.filter(storage=storage, parent=parent, name=name).exists():
+            raise serializers.ValidationError({'name': ['Duplicate file name.']})
+
+        id = uuid.uuid4()
+        expires = settings.UPLOAD_URL_EXPIRES
+        token = signing.dumps({
+            'id': id.hex,
+            'storage': storage.id,
+            'parent': parent.id.hex if parent else None,
+            'name': name,
+            'size': size,
+        }, salt=self.salt)
+
+        return Response({
+            'id': id,
+            'url': get_object_store().presigned_put_url(id.hex, expires),
+            'token': token,
+            'expires': expires,
+        }, status=status.HTTP_201_CREATED)
+
+    @list_route(methods=['post'])
+    def complete(self, request):
+        serializer = UploadCompleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            upload = signing.loads(
+                serializer.validated_data['token'], salt=self.salt, max_age=settings.UPLOAD_URL_EXPIRES)
+        except signing.BadSignature:
+            raise serializers.ValidationError({'token': ['Invalid or expired upload token.']})
+
+        storage = self.get_storage(request)
+        if upload['storage'] != storage.id:
+            raise serializers.ValidationError({'token': ['Invalid or expired upload token.']})
+
+        existing = FileMeta.objects.filter(id=uuid.UUID(upload['id'])).first()
+        if existing is not None:
+            return Response(FileMetaSerializer(existing).data)
+
+        store = get_object_store()
+        info = store.stat(upload['id'])
+        if info is None:
+            raise serializers.ValidationError({'token': ['Upload not found.']})
+
+        try:
+            if info.size != upload['size']:
+                raise serializers.ValidationError({'size': ['Uploaded size does not match.']})
+            if not storage.has_space_for(info.size):
+                raise serializers.ValidationError({'size': ['Storage quota exceeded.']})
+
+            filemeta = storage.create_filemeta(
+                parent=self.lookup_parent(storage, upload['parent']),
+                id=uuid.UUID(upload['id']),
+                name=upload['name'],
+                size=info.size)
+        except ValidationError as exc:
+            store.delete(upload['id'])
+            raise serializers.ValidationError({'name': exc.messages})
+        except serializers.ValidationError:
+            store.delete(upload['id'])
+            raise
+
+        deduplicate_upload(filemeta)
+        return Response(FileMetaSerializer(filemeta).data, status=status.HTTP_201_CREATED)
+
+
+class UploadSessionViewSet(StorageViewSet):
+    # Parts go straight to the object store through presigned URLs, so
+    # clients may upload them in parallel and no worker holds their bytes.
+
+    def get_session(self, request, pk):
+        try:
+            return get_object_or_404(UploadSession, id=uuid.UUID(pk), storage__owner=request.user.profile)
+        except ValueError:
+            raise NotFound()
+
+    def create(self, request):
+        serializer = UploadSessionCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        storage = self.get_storage(request)
+        try:
+            session = create_session(
+                storage,
+                parent=self.lookup_parent(storage, serializer.validated_data.pop('parent', None)),
+                **serializer.validated_data)
+        except ValidationError as exc:
+            raise serializers.ValidationError(exc.message_dict)
+
+        return Response(UploadSessionSerializer(session).data, status=status.HTTP_201_CREATED)
+
+    def retrieve(self, request, pk=None):
+        session = self.get_session(request, pk)
+        try:
+            parts = session_parts(session)
+        except ValidationError as exc:
+            raise serializers.ValidationError(exc.message_dict)
+
+        data = UploadSessionSerializer(session).data
+        data['parts'] = [part._asdict() for part in parts]
+        return Response(data)
+
+    def destroy(self, request, pk=None):
+        abort_session(self.get_session(request, pk))
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @detail_route(methods=['post'])
+    def parts(self, request, pk=None):
+        session = self.get_session(request, pk)
+        serializer = UploadPartsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        try:
+            parts = sign_parts(session, serializer.validated_data['numbers'])
+        except ValidationError as exc:
+            raise serializers.ValidationError(exc.message_dict)
+
+        return Response({'parts': parts, 'expires': settings.UPLOAD_URL_EXPIRES})
+
+    @detail_route(methods=['post'])
+    def complete(self, request, pk=None):
+        try:
+            session = self.get_session(request, pk)
+        except Http404:
+            # Completing twice is idempotent
+            return Response(FileMetaSerializer(self.get_filemeta(request, pk)).data)
+
+        try:
+            filemeta = complete_session(session)
+        except ValidationError as exc:
+            if hasattr(exc, 'error_dict'):
+                raise serializers.ValidationError(exc.message_dict)
+            raise serializers.ValidationError({'name': exc.messages})
+
+        return Response(FileMetaSerializer(filemeta).data, status=status.HTTP_201_CREATED)
+
+
+class BatchViewSet(StorageViewSet):
+    # Batches run inside the request unless the client asks for the
+    # background or their subtrees are too large, in which case the batch
+    # worker picks them up and the job can be polled.
+
+    def create(self, request):
+        serializer = BatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        storage = self.get_storage(request)
+        operation = data.pop('operation')
+        if data.pop('background') or estimate_rows(storage, data) > settings.BATCH_ASYNC_THRESHOLD:
+            job = enqueue_batch(storage, operation, data)
+            return Response(BatchJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+        try:
+            result = run_batch(storage, operation, data)
+        except ValidationError as exc:
+            if hasattr(exc, 'error_dict'):
+                raise serializers.ValidationError(exc.message_dict)
+            raise serializers.ValidationError({'target': exc.messages})
+
+        return Response(result)
+
+    def retrieve(self, request, pk=None):
+        try:
+            job = get_object_or_404(BatchJob, id=uuid.UUID(pk), storage__owner=request.user.profile)
+        except ValueError:
+            raise NotFound()
+
+        return Response(BatchJobSerializer(job).data)
+
+
+class DirViewSet(StorageViewSet):
+
+    def retrieve(self, request, pk=None):
+        return Response(DirMetaSerializer(self.get_dirmeta(request, pk)).data)
+
+    @detail_route(methods=['get'])
+    def breadcrumbs(self, request, pk=None):
+        return Response({'breadcrumbs': crumbs(breadcrumbs(self.get_dirmeta(request, pk)))})
+
+    @detail_route(methods=['get'])
+    def archive(self, request, pk=None):
+        dirmeta = self.get_dirmeta(request, pk)
+        response = StreamingHttpResponse(stream_archive(dirmeta), content_type='application/zip')
+        response['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(
+            urlquote(dirmeta.name + '.zip'))
+        return response
+
+
+class FileViewSet(StorageViewSet):
+
+    def retrieve(self, request, pk=None):
+        return Response(FileMetaSerializer(self.get_filemeta(request, pk)).data)
+
+    @detail_route(methods=['get'])
+    def breadcrumbs(self, request, pk=None):
+        try:
+            filemeta = get_object_or_404(
+                FileMeta.objects.select_related('parent'), id=uuid.UUID(pk), storage__owner=request.user.profile)
+        except ValueError:
+            raise NotFound()
+        return Response({'breadcrumbs': crumbs(breadcrumbs(filemeta))})
+
+    @detail_route(methods=['get'])
+    def link(self, request, pk=None):
+        filemeta = self.get_filemeta(request, pk)
+        expires = settings.DOWNLOAD_URL_EXPIRES
+
+        return Response({
+            'url': get_object_store().presigned_get_url(filemeta.object_key, expires),
+            'expires': expires,
+        })
+
+    @detail_route(methods=['get'])
+    def download(self, request, pk=None):
+        return download_response(request, self.get_filemeta(request, pk))
 
 
 router = routers.DefaultRouter()
-# router.register(r'browse', MainStorageViewSet)
+router.register(r'browse', MainStorageViewSet, base_name='browse')
+router.register(r'search', SearchViewSet, base_name='search')
+router.register(r'paths', PathViewSet, base_name='paths')
+router.register(r'import', ImportViewSet, base_name='import')
+router.register(r'feed', FeedViewSet, base_name='feed')
+router.register(r'changes', ChangeViewSet, base_name='changes')
+router.register(r'uploads', UploadViewSet, base_name='uploads')
+router.register(r'upload-sessions', UploadSessionViewSet, base_name='upload-sessions')
+router.register(r'batch', BatchViewSet, base_name='batch')
+router.register(r'dirs', DirViewSet, base_name='dirs')
+router.register(r'files', FileViewSet, base_name='files')
@@ -0,0 +1,220 @@
+# Django
+from django.apps import apps
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, When, Value, Count, IntegerField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Length
+from django.utils.module_loading import import_string
+
+# Core
+from core.tree import path_ids
+
+SEARCH_PREFIX = 'prefix'
+SEARCH_SUBSTRING = 'substring'
+SEARCH_FUZZY = 'fuzzy'
+
+SEARCH_MODES = (SEARCH_PREFIX, SEARCH_SUBSTRING, SEARCH_FUZZY)
+
+# Hits are ranked by how they match first, then by name similarity
+MATCH_EXACT = 3
+MATCH_PREFIX = 2
+MATCH_SUBSTRING = 1
+MATCH_FUZZY = 0
+
+DEFAULT_SEARCH_BACKENDS = {
+    'postgresql': 'core.search.TrigramSearchBackend',
+}
+
+CHUNK_SIZE = 500
+
+BACKENDS = {}
+
+
+def get_search_backend():
+    path = getattr(settings, 'SEARCH_BACKEND', None) or DEFAULT_SEARCH_BACKENDS.get(
+        connection.vendor, 'core.search.TokenSearchBackend')
+    if path not in BACKENDS:
+        BACKENDS[path] = import_string(path)()
+    return BACKENDS[path]
+
+
+def trigrams(value):
+    value = value.lower()
+    if len(value) < 3:
+        return set([value]) if value else set()
+    return set(value[index:index + 3] for index in range(len(value) - 2))
+
+
+def similarity(name, query):
+    # Same measure as pg_trgm, minus its word padding
+    name, query = trigrams(name), trigrams(query)
+    if not name or not query:
+        return 0.0
+    return len(name & query) / len(name | query)
+
+
+def match_class(name, query):
+    name, query = name.lower(), query.lower()
+    if name == query:
+        return MATCH_EXACT
+    if name.startswith(query):
+        return MATCH_PREFIX
+    if query in name:
+        return MATCH_SUBSTRING
+    return MATCH_FUZZY
+
+
+def match_expression(query):
+    return Case(
+        When(name__iexact=query, then=Value(MATCH_EXACT)),
+        When(name__istartswith=query, then=Value(MATCH_PREFIX)),
+        When(name__icontains=query, then=Value(MATCH_SUBSTRING)),
+        default=Value(MATCH_FUZZY),
+        output_field=IntegerField())
+
+
+def like_pattern(query, mode):
+    query = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return query + '%' if mode == SEARCH_PREFIX else '%' + query + '%'
+
+
+def file_paths(filemetas):
+    # Full paths of the hits from the materialized paths of their parents,
+    # resolving every directory name with one query
+    DirMeta = apps.get_model('core', 'DirMeta')
+
+    ids = set()
+    for filemeta in filemetas:
+        if filemeta.parent_id:
+            ids.update(path_ids(filemeta.parent.path))
+    names = dict(DirMeta.objects.filter(id__in=ids).values_list('id', 'name')) if ids else {}
+
+    paths = {}
+    for filemeta in filemetas:
+        segments = [names.get(id, '') for id in path_ids(filemeta.parent.path)] if filemeta.parent_id else []
+        paths[filemeta.id] = '/' + '/'.join(segments + [filemeta.name])
+    return paths
+
+
+def rebuild_tokens(batch_size=CHUNK_SIZE):
+    filemeta_model = apps.get_model('core', 'FileMeta')
+    token_model = apps.get_model('core', 'NameToken')
+    last_id = None
+    indexed = 0
+    while True:
+        queryset = filemeta_model.objects.exclude(storage__storage_type=3).order_by('id')
+        if last_id is not None:
+            queryset = queryset.filter(id__gt=last_id)
+        rows = list(queryset.values_list('id', 'name')[:batch_size])
+        if not rows:
+            return indexed
+
+        last_id = rows[-1][0]
+        token_model.objects.filter(filemeta__in=[id for id, name in rows]).delete()
+        token_model.objects.bulk_create([
+            token_model(filemeta_id=id, token=token) for id, name in rows for token in sorted(trigrams(name))])
+        indexed += len(rows)
+
+
+class SearchBackend(object):
+    name = None
+
+    def index(self, filemetas, replace=False):
+        pass
+
+    def rebuild(self):
+        return 0
+
+    def search(self, storage, query, mode, offset=0, limit=100):
+        # Returns one page of FileMeta hits, best first, each carrying
+        # `match` and `score`
+        raise NotImplementedError
+
+
+class TrigramSearchBackend(SearchBackend):
+    # Served by a pg_trgm GIN index on FileMeta.name, which answers ILIKE
+    # and the similarity operator alike
+    name = 'trigram'
+
+    def search(self, storage, query, mode, offset=0, limit=100):
+        FileMeta = apps.get_model('core', 'FileMeta')
+        column = '{}.{}'.format(
+            connection.ops.quote_name(FileMeta._meta.db_table), connection.ops.quote_name('name'))
+
+        queryset = FileMeta.objects.filter(storage=storage)
+        if mode == SEARCH_FUZZY:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT set_limit(%s)', [settings.SEARCH_FUZZY_THRESHOLD])
+            queryset = queryset.extra(where=['{} %% %s'.format(column)], params=[query])
+        else:
+            queryset = queryset.extra(where=['{} ILIKE %s'.format(column)], params=[like_pattern(query, mode)])
+
+        queryset = queryset.annotate(
+            match=match_expression(query),
+            score=RawSQL('similarity({}, %s)'.format(column), (query,)))
+        return list(queryset.select_related('parent').order_by('-match', '-score', 'name', 'id')[offset:offset + limit])
+
+
+class TokenSearchBackend(SearchBackend):
+    # Portable fallback: the trigrams of every name are kept in NameToken,
+    # and a name qualifies when it holds enough of the query's trigrams.
+    # Candidates are then checked against the name itself.
+    name = 'token'
+
+    def index(self, filemetas, replace=False):
+        NameToken = apps.get_model('core', 'NameToken')
+
+        # Thumbnails are never searched
+        filemetas = [filemeta for filemeta in filemetas if filemeta.storage.storage_type != 3]
+        for start in range(0, len(filemetas), CHUNK_SIZE):
+            chunk = filemetas[start:start + CHUNK_SIZE]
+            if replace:
+                NameToken.objects.filter(filemeta__in=[filemeta.id for filemeta in chunk]).delete()
+            NameToken.objects.bulk_create([
+                NameToken(filemeta_id=filemeta.id, token=token)
+                for filemeta in chunk for token in sorted(trigrams(filemeta.name))])
+
+    def rebuild(self):
+        return rebuild_tokens()
+
+    def matches(self, storage, grams, needed):
+        # Files holding at least `needed` of the trigrams, most shared first
+        NameToken = apps.get_model('core', 'NameToken')
+        return NameToken.objects.filter(token__in=grams, filemeta__storage=storage).values('filemeta').annotate(
+            shared=Count('token', distinct=True)).filter(shared__gte=needed)
+
+    def search(self, storage, query, mode, offset=0, limit=100):
+        FileMeta = apps.get_model('core', 'FileMeta')
+        grams = trigrams(query)
+        queryset = FileMeta.objects.filter(storage=storage).select_related('parent')
+
+        if mode == SEARCH_FUZZY:
+            # Names at least SEARCH_FUZZY_THRESHOLD similar share at least
+            # that fraction of the query's trigrams
+            needed = max(1, int(len(grams) * settings.SEARCH_FUZZY_THRESHOLD))
+            ids = [row['filemeta'] for row in self.matches(storage, grams, needed).order_by(
+                '-shared')[:settings.SEARCH_MAX_CANDIDATES]]
+            hits = []
+            for start in range(0, len(ids), CHUNK_SIZE):
+                for filemeta in queryset.filter(id__in=ids[start:start + CHUNK_SIZE]):
+                    filemeta.match = match_class(filemeta.name, query)
+                    filemeta.score = similarity(filemeta.name, query)
+                    if filemeta.score >= settings.SEARCH_FUZZY_THRESHOLD or filemeta.match != MATCH_FUZZY:
+                        hits.append(filemeta)
+            hits.sort(key=lambda filemeta: (-filemeta.match, -filemeta.score, filemeta.name, filemeta.id))
+            return hits[offset:offset + limit]
+
+        if len(query) >= 3:
+            queryset = queryset.filter(id__in=self.matches(storage, grams, len(grams)).values('filemeta'))
+        if mode == SEARCH_PREFIX:
+            queryset = queryset.filter(name__istartswith=query)
+        else:
+            queryset = queryset.filter(name__icontains=query)
+
+        # Among names containing the query, shorter ones are more similar
+        hits = list(queryset.annotate(match=match_expression(query), length=Length('name')).order_by(
+            '-match', 'length', 'name', 'id')[offset:offset + limit])
+        for filemeta in hits:
+            filemeta.score = similarity(filemeta.name, query)
+        return hits
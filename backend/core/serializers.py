@@ -1,8 +1,24 @@
+# Django
+from django.conf import settings
+
 # DRF
 from rest_framework import serializers
 
 # Core
-from core.models import FileMeta
+from core.models import DirMeta, FileMeta, UploadSession, BatchJob, BATCH_OPERATION_CHOICES
+
+# Misc
+import json
+
+
+class DirMetaSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = DirMeta
+        fields = (
+            'id', 'storage', 'created_at',
+            'modified_at', 'name', 'parent'
+        )
 
 
 class FileMetaSerializer(serializers.ModelSerializer):
@@ -14,3 +30,76 @@ class FileMetaSerializer(serializers.ModelSerializer):
             'modified_at', 'name', 'parent',
             'content_type', 'size'
         )
+
+
+class UploadSerializer(serializers.Serializer):
+    name = serializers.CharField(max_length=4096)
+    size = serializers.IntegerField(min_value=0)
+    parent = serializers.UUIDField(required=False, allow_null=True)
+
+
+class UploadCompleteSerializer(serializers.Serializer):
+    token = serializers.CharField()
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    part_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = UploadSession
+        fields = (
+            'id', 'storage', 'parent', 'name', 'size',
+            'part_size', 'part_count', 'created_at', 'expires_at'
+        )
+
+
+class UploadSessionCreateSerializer(UploadSerializer):
+    part_size = serializers.IntegerField(required=False, min_value=1)
+
+
+class UploadPartsSerializer(serializers.Serializer):
+    numbers = serializers.ListField(child=serializers.IntegerField())
+
+    def validate_numbers(self, value):
+        if not value or len(value) > 1000:
+            raise serializers.ValidationError('Between 1 and 1000 part numbers are allowed per request.')
+        return value
+
+
+class ImportSerializer(serializers.Serializer):
+    # JSON manifests only; NDJSON bodies stream their entries unvalidated
+    entries = serializers.ListField(child=serializers.DictField(), required=False, default=list)
+
+
+class BatchSerializer(serializers.Serializer):
+    operation = serializers.ChoiceField(choices=BATCH_OPERATION_CHOICES)
+    dirs = serializers.ListField(child=serializers.UUIDField(), required=False, default=list)
+    files = serializers.ListField(child=serializers.UUIDField(), required=False, default=list)
+    target = serializers.UUIDField(required=False, allow_null=True)
+    background = serializers.BooleanField(required=False, default=False)
+
+    def validate(self, data):
+        count = len(data['dirs']) + len(data['files'])
+        if not 1 <= count <= settings.BATCH_MAX_ITEMS:
+            raise serializers.ValidationError(
+                'Between 1 and {} items are allowed per batch.'.format(settings.BATCH_MAX_ITEMS))
+        return data
+
+
+class BatchJobSerializer(serializers.ModelSerializer):
+    status = serializers.CharField(source='get_status_display')
+    result = serializers.SerializerMethodField()
+    error = serializers.SerializerMethodField()
+
+    class Meta:
+        model = BatchJob
+        fields = (
+            'id', 'operation', 'status', 'result', 'error',
+            'created_at', 'started_at', 'finished_at'
+        )
+
+    def get_result(self, job):
+        return json.loads(job.result) if job.result else None
+
+    def get_error(self, job):
+        return json.loads(job.error) if job.error else None
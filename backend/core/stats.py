@@ -0,0 +1,126 @@
+# Django
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+
+# Core
+from core.tree import get_tree_backend
+
+CHUNK_SIZE = 500
+
+SUBTREE_STATS_SQL = '''
+    SELECT d.id, COALESCE(SUM(f.size), 0), COUNT(f.id)
+    FROM {dirmeta} d
+    INNER JOIN {dirmeta} p ON {subtree}
+    INNER JOIN {filemeta} f ON f.parent_id = p.id
+    WHERE d.id IN ({ids})
+    GROUP BY d.id
+'''
+
+SUBTREE_DIRS_SQL = '''
+    SELECT d.id, COUNT(p.id) - 1
+    FROM {dirmeta} d
+    INNER JOIN {dirmeta} p ON {subtree}
+    WHERE d.id IN ({ids})
+    GROUP BY d.id
+'''
+
+
+def stats_key(dirmeta, version):
+    return 'dirstats:{}:{}:{}'.format(get_tree_backend().tree_key(dirmeta), version, dirmeta.id.hex)
+
+
+def tree_versions(tree_keys):
+    TreeVersion = apps.get_model('core', 'TreeVersion')
+    return dict(TreeVersion.objects.filter(tree_key__in=set(tree_keys)).values_list('tree_key', 'version'))
+
+
+def invalidate_tree(*tree_keys):
+    # Bumping the version orphans every cached rollup of the tree at once.
+    # Versions live in the database rather than the cache, which may be
+    # local to each process.
+    TreeVersion = apps.get_model('core', 'TreeVersion')
+    tree_keys = set(str(tree_key) for tree_key in tree_keys if tree_key is not None)
+    if not tree_keys:
+        return
+
+    with transaction.atomic():
+        existing = set(TreeVersion.objects.filter(tree_key__in=tree_keys).values_list('tree_key', flat=True))
+        if existing:
+            TreeVersion.objects.filter(tree_key__in=existing).update(version=F('version') + 1)
+        for tree_key in tree_keys - existing:
+            try:
+                with transaction.atomic():
+                    TreeVersion.objects.create(tree_key=tree_key, version=1)
+            except IntegrityError:
+                TreeVersion.objects.filter(tree_key=tree_key).update(version=F('version') + 1)
+
+
+def invalidate_nodes(*dirmetas):
+    backend = get_tree_backend()
+    invalidate_tree(*[backend.tree_key(dirmeta) for dirmeta in dirmetas if dirmeta is not None])
+
+
+def compute_subtree_stats(dirmetas):
+    DirMeta = apps.get_model('core', 'DirMeta')
+    FileMeta = apps.get_model('core', 'FileMeta')
+    pk = DirMeta._meta.pk
+
+    backend = get_tree_backend()
+
+    stats = dict((dirmeta.id, {'size': 0, 'files': 0, 'dirs': 0}) for dirmeta in dirmetas)
+    if backend.nested_sets:
+        for dirmeta in dirmetas:
+            stats[dirmeta.id]['dirs'] = (dirmeta.rght - dirmeta.lft - 1) // 2
+
+    ids = list(stats)
+    with connection.cursor() as cursor:
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE]
+            tables = {
+                'dirmeta': connection.ops.quote_name(DirMeta._meta.db_table),
+                'filemeta': connection.ops.quote_name(FileMeta._meta.db_table),
+                'subtree': backend.subtree_sql,
+                'ids': ', '.join(['%s'] * len(chunk)),
+            }
+            params = [pk.get_db_prep_value(id, connection) for id in chunk]
+
+            cursor.execute(SUBTREE_STATS_SQL.format(**tables), params)
+            for id, size, files in cursor.fetchall():
+                stats[pk.to_python(id)].update(size=int(size), files=files)
+
+            if not backend.nested_sets:
+                cursor.execute(SUBTREE_DIRS_SQL.format(**tables), params)
+                for id, dirs in cursor.fetchall():
+                    stats[pk.to_python(id)]['dirs'] = dirs
+
+    return stats
+
+
+def subtree_stats(dirmetas, cached=True):
+    dirmetas = list(dirmetas)
+    timeout = getattr(settings, 'DIRMETA_STATS_TIMEOUT', 300)
+    if not cached or not timeout:
+        return compute_subtree_stats(dirmetas)
+
+    backend = get_tree_backend()
+    tree_keys = dict((dirmeta.id, str(backend.tree_key(dirmeta))) for dirmeta in dirmetas)
+    versions = tree_versions(tree_keys.values())
+    keys = dict(
+        (stats_key(dirmeta, versions.get(tree_keys[dirmeta.id], 0)), dirmeta)
+        for dirmeta in dirmetas)
+
+    found = cache.get_many(list(keys))
+    stats = dict((keys[key].id, value) for key, value in found.items())
+
+    missing = [dirmeta for key, dirmeta in keys.items() if key not in found]
+    if missing:
+        computed = compute_subtree_stats(missing)
+        cache.set_many(
+            dict((key, computed[dirmeta.id]) for key, dirmeta in keys.items() if key not in found),
+            timeout)
+        stats.update(computed)
+
+    return stats
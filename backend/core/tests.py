@@ -1,15 +1,22 @@
 # Django
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.contrib.auth.models import User
 
 # Core
-from core.models import Profile
+from core.mimecache import mime_cache
+from core.models import Profile, Storage
+
+# Misc
+import json
+import os
+import unittest
 
 
 class MainTestCase(TestCase):
     fixtures = ['fixtures/services.yaml']
 
     def setUp(self):
+        mime_cache.invalidate()
         self.user = User.objects.create_user(
             username='testuser',
             password='qwe123123',
@@ -113,3 +120,2339 @@ class MainTestCase(TestCase):
         total_size = sum(range(1, 11)) * 10
         self.assertGreater(self.user.profile.storage_set.first().total_size, 0)
         self.assertEqual(self.user.profile.storage_set.first().total_size, total_size)
+
+
+class StorageUsageTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from core.models import DirMeta
+
+        mime_cache.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.trash = self.user.profile.storage_set.get(storage_type=2)
+
+        self.storage.create_dirmeta(parent=None, name='photos')
+        self.photos = DirMeta.objects.get(name='photos')
+        self.storage.create_dirmeta(parent=self.photos, name='2016')
+        self.year = DirMeta.objects.get(name='2016')
+
+        for x in range(1, 4):
+            self.storage.create_filemeta(parent=self.year, name='img-' + str(x) + '.jpg', size=100 * x)
+        self.storage.create_filemeta(parent=None, name='notes.txt', size=50)
+
+    def tearDown(self):
+        del self.user
+
+    def test_counters_on_create(self):
+        storage = Storage.objects.get(pk=self.storage.pk)
+        self.assertEqual(storage.total_size, 650)
+        self.assertEqual(storage.file_count, 4)
+        self.assertEqual(storage.dir_count, 2)
+
+    def test_counters_on_delete(self):
+        from core.models import FileMeta
+
+        notes = FileMeta.objects.get(name='notes.txt')
+        self.storage.delete_filemeta(parent=None, id=notes.id)
+        self.assertEqual(self.storage.total_size, 600)
+        self.assertEqual(self.storage.file_count, 3)
+
+        self.storage.delete_dirmeta(parent=None, id=self.photos.id)
+        self.assertEqual(self.storage.total_size, 0)
+        self.assertEqual(self.storage.file_count, 0)
+        self.assertEqual(self.storage.dir_count, 0)
+
+    def test_counters_on_move(self):
+        self.storage.move_dirmeta(parent=self.photos, id=self.year.id, target=None, storage=self.trash)
+        self.assertEqual(self.storage.total_size, 50)
+        self.assertEqual(self.storage.dir_count, 1)
+        self.assertEqual(self.trash.total_size, 600)
+        self.assertEqual(self.trash.file_count, 3)
+        self.assertEqual(self.trash.dir_count, 1)
+        self.assertEqual(self.trash.browse(parent=self.year)[0].storage, self.trash)
+
+    def test_repair_usage(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+
+        Storage.objects.filter(pk=self.storage.pk).update(used_size=1, file_count=0, dir_count=0)
+        out = StringIO()
+        call_command('repair_usage', batch_size=1, stdout=out)
+        self.assertIn('1 repaired', out.getvalue())
+
+        storage = Storage.objects.get(pk=self.storage.pk)
+        self.assertEqual((storage.total_size, storage.file_count, storage.dir_count), (650, 4, 2))
+
+
+class BrowsePageTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        mime_cache.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+
+        for x in range(5):
+            self.storage.create_dirmeta(parent=None, name='dir-' + str(x))
+        for x in range(7):
+            self.storage.create_filemeta(parent=None, name='file-' + str(x) + '.txt', size=10)
+
+    def tearDown(self):
+        del self.user
+
+    def test_browse_page_order(self):
+        from core.models import DirMeta
+
+        names = []
+        cursor = None
+        while True:
+            page, cursor = self.storage.browse_page(parent=None, cursor=cursor, limit=5)
+            self.assertLessEqual(len(page), 5)
+            names.extend((isinstance(item, DirMeta), item.name) for item in page)
+            if cursor is None:
+                break
+
+        self.assertEqual(len(names), 12)
+        self.assertEqual([name for is_dir, name in names[:5]], ['dir-' + str(x) for x in range(5)])
+        self.assertTrue(all(is_dir for is_dir, name in names[:5]))
+        self.assertEqual([name for is_dir, name in names[5:]], ['file-' + str(x) + '.txt' for x in range(7)])
+
+    def test_browse_api(self):
+        from rest_framework.test import APIClient
+        from core.listcache import get_listing_cache
+
+        get_listing_cache().clear()
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        response = client.get('/api/browse/', {'limit': 4})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['directories']), 4)
+        self.assertEqual(len(response.data['files']), 0)
+
+        response = client.get('/api/browse/', {'limit': 4, 'cursor': response.data['next']})
+        self.assertEqual(len(response.data['directories']), 1)
+        self.assertEqual(len(response.data['files']), 3)
+
+        response = client.get('/api/browse/', {'limit': 4, 'cursor': response.data['next']})
+        self.assertEqual(len(response.data['files']), 4)
+        self.assertIsNone(response.data['next'])
+
+        response = client.get('/api/browse/', {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkImportTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from core.models import DirMeta
+
+        mime_cache.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.storage.create_dirmeta(parent=None, name='photos')
+        self.photos = DirMeta.objects.get(name='photos')
+        self.storage.create_dirmeta(parent=self.photos, name='2015')
+        self.storage.create_filemeta(parent=self.photos, name='cover.jpg', size=5)
+
+    def tearDown(self):
+        del self.user
+
+    def test_import_tree(self):
+        from core.bulk import import_tree
+        from core.models import DirMeta, FileMeta
+
+        entries = [
+            {'path': 'photos/cover.jpg', 'size': 5},
+            {'path': 'photos/2016/trip/a.jpg', 'size': 10},
+            {'path': 'photos/2016/trip/b.tar.gz', 'size': 20},
+            {'path': 'photos/2015/c.png', 'size': 30},
+            {'path': 'docs/empty', 'type': 'dir'},
+            {'path': 'readme', 'size': 0},
+        ]
+        result = import_tree(self.storage, entries)
+        self.assertEqual(result['entries'], 6)
+        self.assertEqual(result['dirs'], 4)
+        self.assertEqual(result['files'], 4)
+        self.assertEqual(result['skipped'], 1)
+
+        self.assertEqual(self.storage.total_size, 65)
+        self.assertEqual(self.storage.file_count, 5)
+        self.assertEqual(self.storage.dir_count, 6)
+
+        # Bulk inserted nodes must form a valid nested set
+        self.photos.refresh_from_db()
+        trip = DirMeta.objects.get(name='trip')
+        self.assertEqual(
+            sorted(node.name for node in self.photos.get_descendants()),
+            ['2015', '2016', 'trip'])
+        self.assertEqual([node.name for node in trip.get_ancestors()], ['photos', '2016'])
+        self.assertEqual(FileMeta.objects.get(name='b.tar.gz').content_type.extension, 'gz')
+        self.assertIn(FileMeta.objects.get(name='a.jpg'), self.storage.browse(parent=trip))
+
+        # MPTT inserts keep working on top of bulk inserted nodes
+        self.storage.create_dirmeta(parent=trip, name='day-1')
+        trip.refresh_from_db()
+        self.assertEqual([node.name for node in trip.get_children()], ['day-1'])
+        self.photos.refresh_from_db()
+        self.assertEqual(self.photos.get_descendant_count(), 4)
+
+    def test_import_api(self):
+        from rest_framework.test import APIClient
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        body = '\n'.join(json.dumps({'path': 'import/file-' + str(x) + '.txt', 'size': x}) for x in range(1, 101))
+        response = client.post(
+            '/api/import/?parent=' + str(self.photos.id), body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['files'], 100)
+        self.assertEqual(response.data['dirs'], 1)
+
+        response = client.post('/api/import/', '[{"path": "../x", "size": 1}]', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        for body in ('"x"', '5', '[1]', '{"entries": 3}'):
+            response = client.post('/api/import/', body, content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+
+        response = client.post(
+            '/api/import/', '{"entries": [{"path": "x.txt", "size": 1}]}', content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['files'], 1)
+
+    def test_positions_follow_names(self):
+        from core.bulk import import_tree
+        from core.models import FileMeta
+
+        entries = [
+            {'path': 'b/z.txt', 'size': 1}, {'path': 'b/y.txt', 'size': 1},
+            {'path': 'a/d/x.txt', 'size': 1}, {'path': 'a/c/w.txt', 'size': 1},
+        ]
+        trees = []
+        for name, manifest in (('forward', entries), ('backward', entries[::-1])):
+            root = self.storage.create_dirmeta(name=name)
+            import_tree(self.storage, manifest, parent=root)
+            root.refresh_from_db()
+            dirs = root.get_descendants()
+            trees.append((
+                [node.name for node in dirs.order_by('lft')],
+                [node.name for node in FileMeta.objects.filter(parent__in=dirs).order_by('lft')]))
+        self.assertEqual(trees[0], trees[1])
+        self.assertEqual(trees[0][0], ['a', 'c', 'd', 'b'])
+
+
+class MimeTypeCacheTestCase(TransactionTestCase):
+    # Commits for real, so rows written outside a test transaction get cached
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from core.models import MimeContentType
+
+        mime_cache.invalidate()
+        self.text = MimeContentType.objects.create(name='text/plain', extension='txt')
+        self.gzip = MimeContentType.objects.create(name='application/gzip', extension='gz')
+
+    def test_file_extension(self):
+        from core.mimecache import file_extension
+
+        self.assertEqual(file_extension('a.tar.gz'), 'gz')
+        self.assertEqual(file_extension('Photo.JPG'), 'jpg')
+        self.assertEqual(file_extension('.bashrc'), '')
+        self.assertEqual(file_extension('README'), '')
+        self.assertEqual(file_extension('trailing.'), '')
+
+    def test_lookups_are_cached(self):
+        mime_cache.get('txt')
+        with self.assertNumQueries(0):
+            self.assertEqual(mime_cache.get('txt'), self.text)
+            self.assertEqual(mime_cache.get_many(['txt', 'gz']), {'txt': self.text, 'gz': self.gzip})
+
+    def test_negative_entries(self):
+        from core.models import MimeContentType
+
+        self.assertIsNone(mime_cache.get('xyz'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(mime_cache.get('xyz'))
+
+        created = MimeContentType.objects.create(name='chemical/x-xyz', extension='xyz')
+        self.assertEqual(mime_cache.get('xyz'), created)
+
+    def test_rolled_back_rows_are_not_cached(self):
+        from django.db import transaction
+        from core.models import MimeContentType
+
+        with self.assertRaises(ZeroDivisionError), transaction.atomic():
+            MimeContentType.objects.create(name='chemical/x-xyz', extension='xyz')
+            self.assertEqual(mime_cache.get('xyz').name, 'chemical/x-xyz')
+            1 / 0
+        self.assertIsNone(mime_cache.get('xyz'))
+
+        with transaction.atomic():
+            created = MimeContentType.objects.create(name='chemical/x-xyz', extension='xyz')
+            mime_cache.get('xyz')
+        self.assertEqual(mime_cache.get('xyz'), created)
+        with self.assertNumQueries(0):
+            self.assertEqual(mime_cache.get('xyz'), created)
+
+    def test_invalidation(self):
+        self.assertEqual(mime_cache.get('txt').name, 'text/plain')
+        self.text.name = 'text/x-plain'
+        self.text.save()
+        self.assertEqual(mime_cache.get('txt').name, 'text/x-plain')
+
+        self.text.delete()
+        self.assertIsNone(mime_cache.get('txt'))
+
+    def test_bounded_size(self):
+        from core.mimecache import MimeTypeCache
+
+        cache = MimeTypeCache(maxsize=2)
+        for extension in ['txt', 'gz', 'a', 'b']:
+            cache.get(extension)
+        self.assertEqual(list(cache.entries), ['a', 'b'])
+
+    def test_create_filemeta_multi_dot(self):
+        from core.models import FileMeta
+
+        user = User.objects.create_user(username='testuser', password='qwe123123')
+        storage = user.profile.storage_set.get(storage_type=1)
+        storage.create_filemeta(parent=None, name='backup.tar.gz', size=10)
+        storage.create_filemeta(parent=None, name='Makefile', size=10)
+        self.assertEqual(FileMeta.objects.get(name='backup.tar.gz').content_type, self.gzip)
+        self.assertEqual(FileMeta.objects.get(name='Makefile').content_type.name, 'application/octet-stream')
+
+
+class CategoryFeedTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from core.models import MimeContentType
+
+        mime_cache.invalidate()
+        MimeContentType.objects.create(name='image/jpeg', extension='jpg')
+        MimeContentType.objects.create(name='audio/mpeg', extension='mp3')
+        MimeContentType.objects.create(name='video/mp4', extension='mp4')
+        MimeContentType.objects.create(name='application/msword', extension='doc')
+
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+
+        for x in range(5):
+            self.storage.create_filemeta(parent=None, name='img-' + str(x) + '.jpg', size=10)
+        self.storage.create_filemeta(parent=None, name='song.mp3', size=10)
+        self.storage.create_filemeta(parent=None, name='clip.mp4', size=10)
+        self.storage.create_filemeta(parent=None, name='letter.doc', size=10)
+        self.storage.create_filemeta(parent=None, name='notes.txt', size=10)
+
+    def tearDown(self):
+        del self.user
+
+    def test_category_feeds(self):
+        from core.models import CATEGORY_OTHER
+
+        self.assertEqual(self.storage.images().count(), 5)
+        self.assertEqual([item.name for item in self.storage.audios()], ['song.mp3'])
+        self.assertEqual([item.name for item in self.storage.videos()], ['clip.mp4'])
+        self.assertEqual([item.name for item in self.storage.documents()], ['letter.doc'])
+        self.assertEqual(self.storage.file_count, 9)
+        self.assertTrue(self.storage.images().filter(category=CATEGORY_OTHER).count() == 0)
+
+    def test_category_page(self):
+        from core.models import CATEGORY_IMAGE
+
+        seen = []
+        cursor = None
+        while True:
+            page, cursor = self.storage.category_page(CATEGORY_IMAGE, cursor=cursor, limit=2)
+            seen.extend(page)
+            if cursor is None:
+                break
+
+        self.assertEqual(seen, list(self.storage.images()))
+
+    def test_feed_api(self):
+        from rest_framework.test import APIClient
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        response = client.get('/api/feed/images/', {'limit': 3})
+        self.assertEqual(len(response.data['files']), 3)
+        response = client.get('/api/feed/images/', {'limit': 3, 'cursor': response.data['next']})
+        self.assertEqual(len(response.data['files']), 2)
+        self.assertIsNone(response.data['next'])
+
+        self.assertEqual(client.get('/api/feed/other/').status_code, 404)
+
+
+class SubtreeStatsTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from core.models import DirMeta
+
+        mime_cache.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+
+        for name in ['music', 'photos']:
+            self.storage.create_dirmeta(parent=None, name=name)
+        self.music = DirMeta.objects.get(name='music')
+        self.photos = DirMeta.objects.get(name='photos')
+        self.storage.create_dirmeta(parent=self.photos, name='2016')
+        self.year = DirMeta.objects.get(name='2016')
+        self.storage.create_dirmeta(parent=self.year, name='trip')
+        self.trip = DirMeta.objects.get(name='trip')
+
+        self.storage.create_filemeta(parent=self.photos, name='cover.jpg', size=1)
+        self.storage.create_filemeta(parent=self.year, name='a.jpg', size=10)
+        self.storage.create_filemeta(parent=self.trip, name='b.jpg', size=100)
+        self.storage.create_filemeta(parent=self.trip, name='c.jpg', size=1000)
+
+    def tearDown(self):
+        del self.user
+
+    def refresh(self):
+        for dirmeta in [self.music, self.photos, self.year, self.trip]:
+            dirmeta.refresh_from_db()
+
+    def test_subtree_stats(self):
+        from core.stats import subtree_stats
+
+        self.refresh()
+        with self.assertNumQueries(1):
+            stats = subtree_stats([self.music, self.photos, self.year, self.trip], cached=False)
+
+        self.assertEqual(stats[self.music.id], {'size': 0, 'files': 0, 'dirs': 0})
+        self.assertEqual(stats[self.photos.id], {'size': 1111, 'files': 4, 'dirs': 2})
+        self.assertEqual(stats[self.year.id], {'size': 1110, 'files': 3, 'dirs': 1})
+        self.assertEqual(stats[self.trip.id], {'size': 1100, 'files': 2, 'dirs': 0})
+
+    def test_cached_rollup(self):
+        from core.models import TreeVersion
+
+        self.refresh()
+        self.assertEqual(self.year.subtree_stats()['size'], 1110)
+        # Only the tree's version is read
+        with self.assertNumQueries(1):
+            self.assertEqual(self.year.subtree_stats()['size'], 1110)
+
+        version = TreeVersion.objects.get(tree_key=str(self.year.tree_id)).version
+        self.storage.create_filemeta(parent=self.trip, name='d.jpg', size=10000)
+        self.assertEqual(TreeVersion.objects.get(tree_key=str(self.year.tree_id)).version, version + 1)
+        self.refresh()
+        self.assertEqual(self.year.subtree_stats()['size'], 11110)
+        self.assertEqual(self.year.subtree_stats()['files'], 4)
+
+    def test_browse_stats_api(self):
+        from rest_framework.test import APIClient
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        response = client.get('/api/browse/', {'stats': 1})
+        directories = dict((item['name'], item) for item in response.data['directories'])
+        self.assertEqual(directories['photos']['size'], 1111)
+        self.assertEqual(directories['photos']['files'], 4)
+        self.assertEqual(directories['photos']['dirs'], 2)
+        self.assertEqual(directories['music']['size'], 0)
+
+
+class TreeBackendTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        mime_cache.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+
+    def tearDown(self):
+        del self.user
+
+    def get(self, name):
+        from core.models import DirMeta
+        return DirMeta.objects.get(name=name)
+
+    def exercise(self):
+        from core.models import FileMeta
+
+        self.storage.create_dirmeta(parent=None, name='a')
+        self.storage.create_dirmeta(parent=self.get('a'), name='b')
+        self.storage.create_dirmeta(parent=self.get('b'), name='c')
+        self.storage.create_dirmeta(parent=None, name='x')
+        self.storage.create_filemeta(parent=self.get('c'), name='f.txt', size=10)
+        self.storage.create_filemeta(parent=self.get('b'), name='g.txt', size=5)
+
+        c = self.get('c')
+        self.assertEqual(c.path, self.get('a').id.hex + '/' + self.get('b').id.hex + '/' + c.id.hex + '/')
+        self.assertEqual([node.name for node in c.ancestors()], ['a', 'b'])
+        self.assertEqual(sorted(node.name for node in self.get('a').descendants()), ['b', 'c'])
+        self.assertEqual(self.get('a').subtree_stats(cached=False), {'size': 15, 'files': 2, 'dirs': 2})
+
+        # Move b (with c and both files) under x
+        self.storage.move_dirmeta(parent=self.get('a'), id=self.get('b').id, target=self.get('x'))
+        self.assertEqual([node.name for node in self.get('c').ancestors(include_self=True)], ['x', 'b', 'c'])
+        self.assertEqual(self.get('c').level, 2)
+        self.assertEqual(list(self.get('a').descendants()), [])
+        self.assertEqual(self.get('x').subtree_stats(cached=False), {'size': 15, 'files': 2, 'dirs': 2})
+        self.assertEqual(self.get('a').subtree_stats(cached=False), {'size': 0, 'files': 0, 'dirs': 0})
+
+        from django.core.exceptions import ValidationError
+        with self.assertRaises(ValidationError):
+            self.storage.move_dirmeta(parent=self.get('x'), id=self.get('b').id, target=self.get('c'))
+
+        self.storage.delete_dirmeta(parent=self.get('x'), id=self.get('b').id)
+        self.assertEqual(FileMeta.objects.count(), 0)
+        self.assertEqual((self.storage.total_size, self.storage.dir_count), (0, 2))
+
+    def test_mptt_backend(self):
+        self.exercise()
+
+    def test_path_backend(self):
+        from django.test.utils import override_settings
+
+        with override_settings(CLOUD_TREE_BACKEND='core.tree.PathBackend'):
+            self.exercise()
+
+    def test_rebuild_tree(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from core.models import DirMeta
+
+        self.storage.create_dirmeta(parent=None, name='a')
+        self.storage.create_dirmeta(parent=self.get('a'), name='b')
+        self.storage.create_dirmeta(parent=self.get('b'), name='c')
+        expected = dict(DirMeta.objects.values_list('name', 'path'))
+
+        DirMeta.objects.update(path='')
+        call_command('rebuild_tree', stdout=StringIO())
+        self.assertEqual(dict(DirMeta.objects.values_list('name', 'path')), expected)
+
+    def test_benchmark_tree(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from core.models import DirMeta
+
+        out = StringIO()
+        call_command('benchmark_tree', dirs=20, files=20, moves=10, stdout=out)
+        self.assertIn('mptt', out.getvalue())
+        self.assertIn('path', out.getvalue())
+        self.assertFalse(DirMeta.objects.exists())
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend')
+class PresignedUploadTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        del self.user
+
+    def test_upload_and_download(self):
+        response = self.client.post('/api/uploads/', {'name': 'hello.txt', 'size': 5}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(response.data['url'].startswith('memory://cloud/'))
+
+        # The client uploads straight to the object store
+        self.store.put(response.data['id'].hex, b'hello')
+
+        complete = self.client.post('/api/uploads/complete/', {'token': response.data['token']}, format='json')
+        self.assertEqual(complete.status_code, 201)
+        self.assertEqual(complete.data['name'], 'hello.txt')
+        self.assertEqual(Storage.objects.get(pk=self.storage.pk).total_size, 5)
+
+        # Completing twice is idempotent
+        again = self.client.post('/api/uploads/complete/', {'token': response.data['token']}, format='json')
+        self.assertEqual(again.status_code, 200)
+
+        link = self.client.get('/api/files/{}/link/'.format(complete.data['id']))
+        self.assertEqual(link.status_code, 200)
+        self.assertIn(response.data['id'].hex, link.data['url'])
+
+    def test_quota_enforced_on_issue(self):
+        quota = self.storage.capacity_quota
+        response = self.client.post('/api/uploads/', {'name': 'big.iso', 'size': quota + 1}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('size', response.data)
+
+    def test_complete_rejects_missing_or_mismatched_upload(self):
+        response = self.client.post('/api/uploads/', {'name': 'hello.txt', 'size': 5}, format='json')
+        token = response.data['token']
+
+        missing = self.client.post('/api/uploads/complete/', {'token': token}, format='json')
+        self.assertEqual(missing.status_code, 400)
+
+        self.store.put(response.data['id'].hex, b'hello world')
+        mismatch = self.client.post('/api/uploads/complete/', {'token': token}, format='json')
+        self.assertEqual(mismatch.status_code, 400)
+        self.assertIsNone(self.store.stat(response.data['id'].hex))
+
+        forged = self.client.post('/api/uploads/complete/', {'token': token + 'x'}, format='json')
+        self.assertEqual(forged.status_code, 400)
+
+
+@override_settings(
+    OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend',
+    UPLOAD_PART_SIZE=4, UPLOAD_MIN_PART_SIZE=4)
+class UploadSessionTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        del self.user
+
+    def test_parallel_parts_resume_and_complete(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        session = self.client.post('/api/upload-sessions/', {'name': 'movie.mp4', 'size': 10}, format='json')
+        self.assertEqual(session.status_code, 201)
+        self.assertEqual(session.data['part_count'], 3)
+        url = '/api/upload-sessions/{}/'.format(session.data['id'])
+        key = session.data['id'].replace('-', '')
+
+        signed = self.client.post(url + 'parts/', {'numbers': [1, 2, 3]}, format='json')
+        self.assertEqual([part['number'] for part in signed.data['parts']], [1, 2, 3])
+        upload_id = list(self.store.uploads)[0]
+
+        # Parts arrive out of order and concurrently; the last one is dropped
+        chunks = {1: b'0123', 2: b'4567', 3: b'89'}
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(lambda number: self.store.put_part(key, upload_id, number, chunks[number]), [2, 1]))
+
+        incomplete = self.client.post(url + 'complete/')
+        self.assertEqual(incomplete.status_code, 400)
+        self.assertIn('3', incomplete.data['parts'][0])
+
+        # Resume from the list of uploaded parts
+        resumed = self.client.get(url)
+        self.assertEqual([part['number'] for part in resumed.data['parts']], [1, 2])
+        self.store.put_part(key, upload_id, 3, chunks[3])
+
+        complete = self.client.post(url + 'complete/')
+        self.assertEqual(complete.status_code, 201)
+        self.assertEqual(complete.data['id'], session.data['id'])
+        self.assertEqual(self.store.get(key), b'0123456789')
+        self.assertEqual(Storage.objects.get(pk=self.storage.pk).total_size, 10)
+
+        again = self.client.post(url + 'complete/')
+        self.assertEqual(again.status_code, 200)
+
+    def test_abort_and_expire(self):
+        from datetime import timedelta
+        from django.core.management import call_command
+        from django.utils import timezone
+        from django.utils.six import StringIO
+        from core.models import UploadSession
+
+        first = self.client.post('/api/upload-sessions/', {'name': 'a.bin', 'size': 8}, format='json')
+        second = self.client.post('/api/upload-sessions/', {'name': 'b.bin', 'size': 8}, format='json')
+        self.assertEqual(len(self.store.uploads), 2)
+
+        response = self.client.delete('/api/upload-sessions/{}/'.format(first.data['id']))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(len(self.store.uploads), 1)
+
+        UploadSession.objects.filter(id=second.data['id']).update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        call_command('expire_uploads', stdout=out)
+        self.assertIn('Expired 1', out.getvalue())
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(self.store.uploads)
+
+    def test_expired_sessions_cannot_complete(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from core.models import UploadSession
+
+        session = self.client.post('/api/upload-sessions/', {'name': 'a.bin', 'size': 2}, format='json')
+        upload_id = list(self.store.uploads)[0]
+        self.store.put_part(session.data['id'].replace('-', ''), upload_id, 1, b'01')
+
+        UploadSession.objects.filter(id=session.data['id']).update(expires_at=timezone.now() - timedelta(seconds=1))
+        response = self.client.post('/api/upload-sessions/{}/complete/'.format(session.data['id']))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('id', response.data)
+
+    def test_part_size_and_quota_limits(self):
+        with self.settings(UPLOAD_MAX_PARTS=2):
+            response = self.client.post('/api/upload-sessions/', {'name': 'a.bin', 'size': 10}, format='json')
+        self.assertEqual(response.data['part_size'], 5)
+        self.assertEqual(response.data['part_count'], 2)
+
+        invalid = self.client.post(
+            '/api/upload-sessions/{}/parts/'.format(response.data['id']), {'numbers': [3]}, format='json')
+        self.assertEqual(invalid.status_code, 400)
+
+        quota = self.storage.capacity_quota
+        response = self.client.post('/api/upload-sessions/', {'name': 'big.iso', 'size': quota + 1}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('size', response.data)
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend')
+class UploadSessionCascadeTestCase(TransactionTestCase):
+    # Commits for real, so aborts queued by the delete run
+    fixtures = ['fixtures/services.yaml']
+
+    def test_cascades_abort_uploads(self):
+        from rest_framework.test import APIClient
+        from core.objectstore import get_object_store
+        from core.models import UploadSession
+
+        store = get_object_store()
+        store.clear()
+        user = User.objects.create_user(username='testuser', password='qwe123123', email='testuser@localhost')
+        storage = user.profile.storage_set.get(storage_type=1)
+        docs = storage.create_dirmeta(name='docs')
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        client.post('/api/upload-sessions/', {'name': 'a.bin', 'size': 8, 'parent': str(docs.id)}, format='json')
+        client.post('/api/upload-sessions/', {'name': 'b.bin', 'size': 8}, format='json')
+        self.assertEqual(len(store.uploads), 2)
+
+        storage.delete_dirmeta(id=docs.id)
+        self.assertEqual(UploadSession.objects.count(), 1)
+        self.assertEqual(len(store.uploads), 1)
+
+        user.delete()
+        self.assertFalse(store.uploads)
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend', ARCHIVE_BATCH_SIZE=2, ARCHIVE_CHUNK_SIZE=3)
+class ArchiveDownloadTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.models import DirMeta
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.storage.create_dirmeta(name='music')
+        self.root = DirMeta.objects.get(name='music')
+        for name in ('rock', 'jazz'):
+            self.storage.create_dirmeta(parent=self.root, name=name)
+        rock = DirMeta.objects.get(name='rock')
+        self.storage.create_dirmeta(parent=rock, name='live')
+
+        self.contents = {}
+        for parent, name in ((self.root, 'list.txt'), (rock, 'a.mp3'), (rock, 'b.mp3'),
+                             (DirMeta.objects.get(name='live'), 'c.mp3'), (DirMeta.objects.get(name='jazz'), 'd.mp3')):
+            data = ('{} in {}'.format(name, parent.name)).encode('utf-8')
+            filemeta = self.storage.create_filemeta(parent=parent, name=name, size=len(data))
+            self.store.put(filemeta.object_key, data)
+            self.contents[filemeta.object_key] = data
+
+    def tearDown(self):
+        del self.user
+
+    def download(self):
+        import io
+        import zipfile
+
+        response = self.client.get('/api/dirs/{}/archive/'.format(self.root.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def assertArchive(self):
+        archive = self.download()
+        self.assertIsNone(archive.testzip())
+        names = archive.namelist()
+        self.assertEqual(sorted(names), [
+            'music/', 'music/jazz/', 'music/jazz/d.mp3', 'music/list.txt',
+            'music/rock/', 'music/rock/a.mp3', 'music/rock/b.mp3',
+            'music/rock/live/', 'music/rock/live/c.mp3'])
+        # Every directory precedes its contents
+        for index, name in enumerate(names):
+            parent = name.rstrip('/').rpartition('/')[0]
+            if parent:
+                self.assertLess(names.index(parent + '/'), index)
+        self.assertEqual(archive.read('music/rock/live/c.mp3'), b'c.mp3 in live')
+
+    def test_streams_subtree(self):
+        self.assertArchive()
+
+    def test_streams_subtree_with_path_backend(self):
+        with self.settings(CLOUD_TREE_BACKEND='core.tree.PathBackend'):
+            self.assertArchive()
+
+    def test_missing_objects_are_skipped(self):
+        from core.models import FileMeta
+
+        self.store.delete(FileMeta.objects.get(name='a.mp3').object_key)
+        archive = self.download()
+        self.assertNotIn('music/rock/a.mp3', archive.namelist())
+        self.assertEqual(archive.read('music/rock/b.mp3'), b'b.mp3 in rock')
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend', DOWNLOAD_CHUNK_SIZE=4)
+class DownloadTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.data = b'0123456789abcdefghij'
+        self.filemeta = self.storage.create_filemeta(name='clip.mp4', size=len(self.data))
+        self.store.put(self.filemeta.object_key, self.data)
+        self.url = '/api/files/{}/download/'.format(self.filemeta.id)
+
+    def tearDown(self):
+        del self.user
+
+    def test_full_download_and_conditional_get(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Content-Length'], '20')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+        cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached['ETag'], response['ETag'])
+
+        since = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(since.status_code, 304)
+
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(changed.status_code, 200)
+
+    def test_single_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/20')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+
+        suffix = self.client.get(self.url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(suffix.streaming_content), b'hij')
+
+        open_ended = self.client.get(self.url, HTTP_RANGE='bytes=15-')
+        self.assertEqual(b''.join(open_ended.streaming_content), b'fghij')
+
+        unsatisfiable = self.client.get(self.url, HTTP_RANGE='bytes=50-60')
+        self.assertEqual(unsatisfiable.status_code, 416)
+        self.assertEqual(unsatisfiable['Content-Range'], 'bytes */20')
+
+        stale = self.client.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(stale.status_code, 200)
+
+    def test_multiple_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1, 10-12, 11-13')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(b'Content-Range: bytes 0-1/20\r\n\r\n01\r\n', body)
+        self.assertIn(b'Content-Range: bytes 10-13/20\r\n\r\nabcd\r\n', body)
+
+    def test_missing_object(self):
+        self.store.delete(self.filemeta.object_key)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1').status_code, 404)
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-1, 10-12').status_code, 404)
+
+
+class ChangeJournalTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        mime_cache.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        del self.user
+
+    def changes(self, cursor=None, limit=100):
+        params = {'limit': limit}
+        if cursor:
+            params['cursor'] = cursor
+        response = self.client.get('/api/changes/', params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_sequence_follows_every_change(self):
+        from core.models import ChangeEntry
+
+        docs = self.storage.create_dirmeta(name='docs')
+        filemeta = self.storage.create_filemeta(name='a.txt', size=1)
+        self.storage.rename_filemeta(id=filemeta.id, name='b.txt')
+        self.storage.move_filemeta(id=filemeta.id, target=docs)
+        self.storage.delete_dirmeta(id=docs.id)
+
+        self.assertEqual(
+            list(ChangeEntry.objects.filter(storage=self.storage).values_list('seq', 'action')),
+            [(1, 1), (2, 1), (3, 2), (4, 3), (5, 4)])
+        self.assertEqual(Storage.objects.get(pk=self.storage.pk).change_seq, 5)
+
+    def test_delta_sync(self):
+        reset = self.changes()
+        self.assertTrue(reset['reset'])
+
+        docs = self.storage.create_dirmeta(name='docs')
+        kept = self.storage.create_filemeta(parent=docs, name='kept.txt', size=1)
+        self.storage.rename_filemeta(parent=docs, id=kept.id, name='renamed.txt')
+        temp = self.storage.create_filemeta(name='temp.txt', size=1)
+        self.storage.delete_filemeta(id=temp.id)
+
+        page = self.changes(reset['cursor'], limit=3)
+        self.assertFalse(page['reset'])
+        self.assertTrue(page['more'])
+        self.assertEqual([(change['action'], change['name']) for change in page['changes']], [
+            ('upsert', 'docs'), ('upsert', 'renamed.txt')])
+
+        # temp.txt was created and deleted between cursors
+        page = self.changes(page['cursor'])
+        self.assertFalse(page['more'])
+        self.assertEqual(page['changes'], [])
+
+        self.storage.delete_dirmeta(id=docs.id)
+        page = self.changes(page['cursor'])
+        self.assertEqual([(change['action'], change['id']) for change in page['changes']], [('delete', docs.id)])
+
+        self.assertEqual(self.changes(page['cursor'])['changes'], [])
+
+    def test_nodes_under_deleted_dirs(self):
+        from core.journal import changes_since, current_sequence
+
+        old = self.storage.create_filemeta(name='f.txt', size=1)
+        cursor = current_sequence(self.storage)
+        docs = self.storage.create_dirmeta(name='a')
+        self.storage.move_filemeta(id=old.id, target=docs)
+        self.storage.create_filemeta(parent=docs, name='new.txt', size=1)
+        self.storage.delete_dirmeta(id=docs.id)
+
+        deltas, cursor, more = changes_since(self.storage, cursor)
+        self.assertEqual([(delta['action'], delta['id']) for delta in deltas], [('delete', old.id)])
+
+    def test_parents_come_first(self):
+        from core.journal import changes_since, current_sequence
+
+        filemeta = self.storage.create_filemeta(name='a.txt', size=1)
+        cursor = current_sequence(self.storage)
+        self.storage.rename_filemeta(id=filemeta.id, name='b.txt')
+        outer = self.storage.create_dirmeta(name='outer')
+        inner = self.storage.create_dirmeta(name='inner')
+        self.storage.move_filemeta(id=filemeta.id, target=inner)
+        outer.refresh_from_db()
+        self.storage.move_dirmeta(id=inner.id, target=outer)
+
+        deltas, cursor, more = changes_since(self.storage, cursor)
+        self.assertEqual([delta['name'] for delta in deltas], ['outer', 'inner', 'b.txt'])
+
+    def test_truncation_forces_resync(self):
+        from datetime import timedelta
+        from django.core.management import call_command
+        from django.utils import timezone
+        from django.utils.six import StringIO
+        from core.models import ChangeEntry
+
+        cursor = self.changes()['cursor']
+        self.storage.create_dirmeta(name='old')
+        ChangeEntry.objects.update(created_at=timezone.now() - timedelta(days=60))
+        self.storage.create_dirmeta(name='new')
+
+        out = StringIO()
+        call_command('truncate_changes', stdout=out)
+        self.assertIn('Deleted 1', out.getvalue())
+
+        resync = self.changes(cursor)
+        self.assertTrue(resync['reset'])
+        page = self.changes(resync['cursor'])
+        self.assertFalse(page['reset'])
+        self.assertEqual(page['changes'], [])
+
+
+class ListingVersionTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.listcache import get_listing_cache
+
+        mime_cache.invalidate()
+        get_listing_cache().clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        del self.user
+
+    def version(self, dirmeta=None):
+        from core.models import DirMeta
+
+        if dirmeta is None:
+            return Storage.objects.get(pk=self.storage.pk).root_version
+        return DirMeta.objects.get(pk=dirmeta.pk).version
+
+    def test_versions_follow_direct_children(self):
+        docs = self.storage.create_dirmeta(name='docs')
+        self.assertEqual(self.version(), 1)
+        self.assertEqual(self.version(docs), 0)
+
+        # The root listing shows the entry counts of docs, so it moves too
+        filemeta = self.storage.create_filemeta(parent=docs, name='a.txt', size=1)
+        self.storage.rename_filemeta(parent=docs, id=filemeta.id, name='b.txt')
+        self.assertEqual(self.version(docs), 2)
+        self.assertEqual(self.version(), 3)
+
+        self.storage.move_filemeta(parent=docs, id=filemeta.id, target=None)
+        self.assertEqual(self.version(docs), 3)
+        self.assertEqual(self.version(), 5)
+
+        self.storage.rename_dirmeta(id=docs.id, name='papers')
+        self.storage.delete_filemeta(id=filemeta.id)
+        self.assertEqual(self.version(), 7)
+
+    def test_cached_listing_follows_child_counts(self):
+        docs = self.storage.create_dirmeta(name='docs')
+        before = self.client.get('/api/browse/')
+        self.assertTrue(before.data['directories'][0]['is_empty'])
+
+        self.storage.create_filemeta(parent=docs, name='a.txt', size=1)
+        # A fresh user, as a real request would load, rather than the one
+        # whose profile cached the storages
+        self.client.force_authenticate(user=User.objects.get(pk=self.user.pk))
+        after = self.client.get('/api/browse/', HTTP_IF_NONE_MATCH=before['ETag'])
+        self.assertEqual(after.status_code, 200)
+        self.assertEqual(after.data['directories'][0]['file_count'], 1)
+        self.assertFalse(after.data['directories'][0]['is_empty'])
+
+    def test_listing_etag_and_cache(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        docs = self.storage.create_dirmeta(name='docs')
+        self.storage.create_filemeta(parent=docs, name='a.txt', size=1)
+
+        first = self.client.get('/api/browse/', {'parent': docs.id})
+        self.assertEqual(first.status_code, 200)
+        etag = first['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get('/api/browse/', {'parent': docs.id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(cached.status_code, 304)
+        self.assertFalse([query for query in queries if 'core_filemeta' in query['sql']])
+
+        with CaptureQueriesContext(connection) as queries:
+            repeat = self.client.get('/api/browse/', {'parent': docs.id})
+        self.assertEqual(repeat.data, first.data)
+        self.assertFalse([query for query in queries if 'core_filemeta' in query['sql']])
+
+        # Another page of the same directory has its own ETag
+        self.assertNotEqual(self.client.get('/api/browse/', {'parent': docs.id, 'limit': 1})['ETag'], etag)
+
+        self.storage.create_filemeta(parent=docs, name='b.txt', size=1)
+        changed = self.client.get('/api/browse/', {'parent': docs.id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(len(changed.data['files']), 2)
+        self.assertNotEqual(changed['ETag'], etag)
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend')
+class DeduplicationTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        del self.user
+
+    def upload(self, name, data):
+        response = self.client.post('/api/uploads/', {'name': name, 'size': len(data)}, format='json')
+        self.store.put(response.data['id'].hex, data)
+        complete = self.client.post('/api/uploads/complete/', {'token': response.data['token']}, format='json')
+        self.assertEqual(complete.status_code, 201)
+        return complete.data['id']
+
+    def test_duplicate_upload_links_blob(self):
+        from core.models import Blob, FileMeta
+
+        first = self.upload('setup.exe', b'installer')
+        second = self.upload('copy of setup.exe', b'installer')
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(len(self.store.objects), 1)
+        self.assertEqual(FileMeta.objects.get(id=second).object_key, blob.key)
+
+        # Both copies still count in full against the storage
+        self.assertEqual(Storage.objects.get(pk=self.storage.pk).total_size, 18)
+
+        download = self.client.get('/api/files/{}/download/'.format(second))
+        self.assertEqual(b''.join(download.streaming_content), b'installer')
+
+        self.storage.delete_filemeta(id=first)
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        self.storage.delete_filemeta(id=second)
+        self.assertEqual(Blob.objects.get().refcount, 0)
+
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+
+        out = StringIO()
+        call_command('collect_blobs', stdout=out)
+        self.assertIn('Collected 1', out.getvalue())
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(self.store.objects)
+
+    def test_backfill_and_subtree_release(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from core.models import Blob
+
+        with self.settings(DEDUP_INLINE_MAX_SIZE=0):
+            docs = self.storage.create_dirmeta(name='docs')
+            for parent, name in ((None, 'a.jpg'), (docs, 'b.jpg'), (docs, 'c.jpg')):
+                filemeta = self.storage.create_filemeta(parent=parent, name=name, size=5)
+                self.store.put(filemeta.object_key, b'photo')
+        self.assertFalse(Blob.objects.exists())
+
+        out = StringIO()
+        call_command('dedup_objects', stdout=out)
+        self.assertIn('Checked 3 files, 2 duplicates', out.getvalue())
+        self.assertEqual(Blob.objects.get().refcount, 3)
+        self.assertEqual(len(self.store.objects), 1)
+
+        self.storage.delete_dirmeta(id=docs.id)
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        call_command('collect_blobs', stdout=out)
+        self.assertEqual(len(self.store.objects), 1)
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend', THUMBNAIL_SIZES=(16, 64))
+class ThumbnailTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.listcache import get_listing_cache
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        get_listing_cache().clear()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def tearDown(self):
+        del self.user
+
+    def image(self):
+        import io
+        from PIL import Image
+
+        output = io.BytesIO()
+        Image.new('RGB', (200, 100), (255, 0, 0)).save(output, 'PNG')
+        return output.getvalue()
+
+    def run_jobs(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from core.thumbnails import claim_jobs, process_jobs
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            return process_jobs(claim_jobs(10), pool)
+
+    def test_jobs_are_queued_once_per_size(self):
+        from core.models import ThumbnailJob, enqueue_thumbnails
+
+        photo = self.storage.create_filemeta(name='photo.png', size=10)
+        self.storage.create_filemeta(name='notes.txt', size=10)
+        self.assertEqual(sorted(ThumbnailJob.objects.values_list('size', flat=True)), [16, 64])
+
+        self.assertEqual(enqueue_thumbnails([photo]), 0)
+        self.assertEqual(ThumbnailJob.objects.count(), 2)
+
+    def test_renders_into_thumb_storage(self):
+        import io
+        from PIL import Image
+        from core.models import FileMeta, ThumbnailJob, JOB_DONE
+
+        data = self.image()
+        photo = self.storage.create_filemeta(name='photo.png', size=len(data))
+        self.store.put(photo.object_key, data)
+
+        self.assertEqual(self.run_jobs(), (2, 0))
+        self.assertEqual(set(ThumbnailJob.objects.values_list('status', flat=True)), {JOB_DONE})
+
+        thumb_storage = self.user.profile.storage_set.get(storage_type=3)
+        thumbnails = FileMeta.objects.filter(storage=thumb_storage)
+        self.assertEqual(thumbnails.count(), 2)
+        small = Image.open(io.BytesIO(self.store.get(thumbnails.get(name__endswith='_16.jpg').object_key)))
+        self.assertEqual(small.size, (16, 8))
+
+        listing = self.client.get('/api/browse/')
+        self.assertEqual(sorted(listing.data['files'][0]['thumbnails']), ['16', '64'])
+
+        # Nothing is left to do
+        self.assertEqual(self.run_jobs(), (0, 0))
+
+    def test_prune_deletes_objects(self):
+        from core.models import FileMeta, ObjectTombstone
+        from core.thumbnails import prune_thumbnails
+
+        data = self.image()
+        photo = self.storage.create_filemeta(name='photo.png', size=len(data))
+        self.store.put(photo.object_key, data)
+        self.run_jobs()
+        self.storage.delete_filemeta(id=photo.id)
+        self.store.delete(photo.object_key)
+        self.assertEqual(len(self.store.objects), 2)
+
+        self.assertEqual(prune_thumbnails(), 2)
+        self.assertFalse(FileMeta.objects.filter(storage__storage_type=3).exists())
+        self.assertEqual(self.store.objects, {})
+        self.assertFalse(ObjectTombstone.objects.exists())
+
+    def test_retry_with_backoff(self):
+        from django.utils import timezone
+        from core.models import ThumbnailJob, JOB_PENDING, JOB_FAILED
+
+        self.storage.create_filemeta(name='missing.png', size=10)
+        self.assertEqual(self.run_jobs(), (0, 0))
+
+        job = ThumbnailJob.objects.first()
+        self.assertEqual((job.status, job.attempts), (JOB_PENDING, 1))
+        self.assertGreater(job.run_after, timezone.now())
+
+        ThumbnailJob.objects.update(run_after=timezone.now())
+        with self.settings(THUMBNAIL_MAX_ATTEMPTS=2):
+            self.run_jobs()
+        self.assertEqual(set(ThumbnailJob.objects.values_list('status', flat=True)), {JOB_FAILED})
+
+    def test_undecodable_image_fails_permanently(self):
+        from core.models import ThumbnailJob, JOB_FAILED
+
+        photo = self.storage.create_filemeta(name='broken.jpg', size=3)
+        self.store.put(photo.object_key, b'abc')
+        self.assertEqual(self.run_jobs(), (0, 2))
+        self.assertEqual(set(ThumbnailJob.objects.values_list('status', flat=True)), {JOB_FAILED})
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend')
+class BatchTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.listcache import get_listing_cache
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        get_listing_cache().clear()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.trash = self.user.profile.storage_set.get(storage_type=2)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.docs = self.storage.create_dirmeta(name='docs')
+        self.sub = self.storage.create_dirmeta(parent=self.docs, name='sub')
+        self.backup = self.storage.create_dirmeta(name='backup')
+        self.files = {}
+        for parent, name in ((self.docs, 'a.txt'), (self.sub, 'b.txt'), (None, 'c.txt')):
+            filemeta = self.storage.create_filemeta(parent=parent, name=name, size=len(name))
+            self.store.put(filemeta.object_key, name.encode('utf-8'))
+            self.files[name] = filemeta
+
+    def tearDown(self):
+        del self.user
+
+    def batch(self, operation, dirs=(), files=(), target=None, **kwargs):
+        data = dict(kwargs, operation=operation, dirs=[str(id) for id in dirs], files=[str(id) for id in files])
+        if target is not None:
+            data['target'] = str(target)
+        return self.client.post('/api/batch/', data, format='json')
+
+    def check_copy(self):
+        from core.models import Blob, DirMeta, FileMeta
+
+        response = self.batch('copy', dirs=[self.docs.id, self.sub.id], files=[self.files['c.txt'].id],
+                              target=self.backup.id)
+        self.assertEqual(response.status_code, 200)
+        # sub travels with docs
+        self.assertEqual(response.data, {'dirs': 2, 'files': 3})
+
+        copy = DirMeta.objects.get(storage=self.storage, parent=self.backup, name='docs')
+        self.assertEqual(
+            sorted(dirmeta.name for dirmeta in copy.descendants()), ['sub'])
+        self.assertEqual(
+            sorted(FileMeta.objects.filter(parent__in=copy.descendants(include_self=True)).values_list(
+                'name', flat=True)), ['a.txt', 'b.txt'])
+        self.assertEqual(
+            [dirmeta.name for dirmeta in DirMeta.objects.get(pk=self.backup.pk).descendants()], ['docs', 'sub'])
+
+        storage = Storage.objects.get(pk=self.storage.pk)
+        self.assertEqual((storage.used_size, storage.file_count, storage.dir_count), (30, 6, 5))
+        self.assertEqual(len(self.store.objects), 3)
+        self.assertEqual(sorted(Blob.objects.values_list('refcount', flat=True)), [2, 2, 2])
+
+        copied = FileMeta.objects.get(parent=self.backup, name='c.txt')
+        download = self.client.get('/api/files/{}/download/'.format(copied.id))
+        self.assertEqual(b''.join(download.streaming_content), b'c.txt')
+        return copy
+
+    def test_copy_shares_objects(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from core.models import Blob, FileMeta
+
+        copy = self.check_copy()
+
+        self.storage.delete_dirmeta(id=self.docs.id)
+        self.storage.delete_filemeta(id=self.files['c.txt'].id)
+        self.assertEqual(sorted(Blob.objects.values_list('refcount', flat=True)), [1, 1, 1])
+        call_command('collect_blobs', stdout=StringIO())
+        self.assertEqual(len(self.store.objects), 3)
+
+        copied = FileMeta.objects.get(parent=copy.descendants().get(), name='b.txt')
+        download = self.client.get('/api/files/{}/download/'.format(copied.id))
+        self.assertEqual(b''.join(download.streaming_content), b'b.txt')
+
+    def test_copy_with_path_backend(self):
+        with self.settings(CLOUD_TREE_BACKEND='core.tree.PathBackend'):
+            self.check_copy()
+
+    def test_copy_checks_names(self):
+        response = self.batch('copy', files=[self.files['c.txt'].id])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('c.txt', response.data['files'][0])
+
+    def test_move(self):
+        from core.models import ChangeEntry, DirMeta, FileMeta
+
+        seq = Storage.objects.get(pk=self.storage.pk).change_seq
+        response = self.batch('move', dirs=[self.sub.id], files=[self.files['c.txt'].id], target=self.backup.id)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(DirMeta.objects.get(pk=self.sub.pk).parent_id, self.backup.id)
+        self.assertEqual(FileMeta.objects.get(pk=self.files['c.txt'].pk).parent_id, self.backup.id)
+        self.assertEqual(
+            [dirmeta.name for dirmeta in DirMeta.objects.get(pk=self.backup.pk).descendants()], ['sub'])
+        entries = ChangeEntry.objects.filter(storage=self.storage, seq__gt=seq)
+        self.assertEqual(
+            sorted((entry.get_action_display(), entry.name, entry.parent_id) for entry in entries),
+            [('move', 'c.txt', self.backup.id), ('move', 'sub', self.backup.id)])
+
+        response = self.batch('move', dirs=[self.backup.id], target=self.sub.id)
+        self.assertEqual(response.status_code, 400)
+
+    def test_trash(self):
+        from core.models import DirMeta, FileMeta
+        from core.search import get_search_backend
+
+        older = self.storage.create_filemeta(name='a.txt', size=5)
+        self.batch('trash', files=[older.id])
+
+        response = self.batch('trash', dirs=[self.docs.id], files=[self.files['a.txt'].id])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'dirs': 1, 'files': 0})
+
+        storage = Storage.objects.get(pk=self.storage.pk)
+        trash = Storage.objects.get(pk=self.trash.pk)
+        self.assertEqual((storage.used_size, storage.file_count, storage.dir_count), (5, 1, 1))
+        self.assertEqual((trash.used_size, trash.file_count, trash.dir_count), (15, 3, 2))
+
+        docs = DirMeta.objects.get(pk=self.docs.pk)
+        self.assertEqual((docs.storage_id, docs.parent_id), (self.trash.id, None))
+        self.assertIsNotNone(docs.trashed_at)
+        self.assertEqual(FileMeta.objects.get(pk=self.files['b.txt'].pk).storage_id, self.trash.id)
+
+        response = self.batch('trash', files=[self.files['c.txt'].id])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(FileMeta.objects.filter(storage=self.trash, parent=None).values_list('name', flat=True)),
+            ['a.txt', 'c.txt'])
+
+        second = self.storage.create_filemeta(name='c.txt', size=5)
+        self.batch('trash', files=[second.id])
+        self.assertEqual(FileMeta.objects.filter(storage=self.trash, parent=None, name__startswith='c (').count(), 1)
+
+        # Renamed files are found under their new names
+        hits = get_search_backend().search(Storage.objects.get(pk=self.trash.pk), second.id.hex[:8], 'substring')
+        self.assertEqual([filemeta.id for filemeta in hits], [second.id])
+
+    def test_background_job(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from core.models import DirMeta
+
+        response = self.batch('move', dirs=[self.docs.id], target=self.backup.id, background=True)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(DirMeta.objects.get(pk=self.docs.pk).parent_id, None)
+
+        call_command('batch_worker', '--once', stdout=StringIO())
+        job = self.client.get('/api/batch/{}/'.format(response.data['id']))
+        self.assertEqual(job.data['status'], 'done')
+        self.assertEqual(job.data['result']['dirs'], 1)
+        self.assertEqual(DirMeta.objects.get(pk=self.docs.pk).parent_id, self.backup.id)
+
+        response = self.batch('move', dirs=[self.backup.id], target=self.sub.id, background=True)
+        call_command('batch_worker', '--once', stdout=StringIO())
+        job = self.client.get('/api/batch/{}/'.format(response.data['id']))
+        self.assertEqual(job.data['status'], 'failed')
+
+    def test_claims_are_exclusive(self):
+        from datetime import timedelta
+        from core.batch import claim_batch_job, run_batch_job
+        from core.models import BatchJob
+
+        response = self.batch('move', dirs=[self.docs.id], target=self.backup.id, background=True)
+        job = claim_batch_job()
+        self.assertEqual(str(job.id), str(response.data['id']))
+        self.assertIsNone(claim_batch_job())
+
+        # Once the lease runs out another worker takes over, and the first
+        # one can no longer record a result
+        BatchJob.objects.filter(pk=job.pk).update(started_at=job.started_at - timedelta(days=1))
+        retry = claim_batch_job()
+        self.assertEqual(retry.pk, job.pk)
+        run_batch_job(job)
+        self.assertEqual(BatchJob.objects.get(pk=job.pk).finished_at, None)
+        run_batch_job(retry)
+        self.assertIsNotNone(BatchJob.objects.get(pk=job.pk).finished_at)
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend', TRASH_PURGE_BATCH_SIZE=2)
+class TrashPurgeTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.trash = self.user.profile.storage_set.get(storage_type=2)
+
+    def tearDown(self):
+        del self.user
+
+    def create_file(self, name, parent=None, size=None):
+        filemeta = self.storage.create_filemeta(parent=parent, name=name, size=size or len(name))
+        self.store.put(filemeta.object_key, name.encode('utf-8'))
+        return filemeta
+
+    def trash_items(self, days, dirs=(), files=()):
+        from datetime import timedelta
+        from django.utils import timezone
+        from core.batch import trash_items
+        from core.models import DirMeta, FileMeta
+
+        trash_items(self.storage, dirs=[node.id for node in dirs], files=[node.id for node in files])
+        trashed_at = timezone.now() - timedelta(days=days)
+        DirMeta.objects.filter(id__in=[node.id for node in dirs]).update(trashed_at=trashed_at)
+        FileMeta.objects.filter(id__in=[node.id for node in files]).update(trashed_at=trashed_at)
+
+    def purge(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+
+        out = StringIO()
+        call_command('purge_trash', stdout=out)
+        return out.getvalue()
+
+    def test_retention(self):
+        from core.models import ChangeEntry, DirMeta, FileMeta, ObjectTombstone
+
+        old = self.storage.create_dirmeta(name='old')
+        sub = self.storage.create_dirmeta(parent=old, name='sub')
+        for index in range(5):
+            self.create_file('{}.txt'.format(index), parent=sub if index % 2 else old)
+        stale = self.create_file('stale.txt')
+        recent = self.create_file('recent.txt')
+        self.trash_items(40, dirs=[old], files=[stale])
+        self.trash_items(1, files=[recent])
+
+        self.assertIn('Purged 2 items: 6 files, 2 directories, 34 bytes; deleted 6 objects.', self.purge())
+
+        self.assertFalse(DirMeta.objects.filter(storage=self.trash).exists())
+        self.assertEqual(list(FileMeta.objects.filter(storage=self.trash)), [FileMeta.objects.get(pk=recent.pk)])
+        self.assertEqual(sorted(self.store.objects), [recent.object_key])
+        self.assertFalse(ObjectTombstone.objects.exists())
+
+        trash = Storage.objects.get(pk=self.trash.pk)
+        self.assertEqual((trash.used_size, trash.file_count, trash.dir_count), (10, 1, 0))
+        deleted = ChangeEntry.objects.filter(storage=self.trash, action=4).values_list('name', flat=True)
+        self.assertEqual(sorted(deleted), ['old', 'stale.txt'])
+
+        self.assertIn('Purged 0 items', self.purge())
+
+    def test_over_quota_purges_oldest_first(self):
+        from core.models import FileMeta
+
+        size = self.trash.capacity_quota // 2 + 1
+        files = [self.create_file('{}.iso'.format(index), size=size) for index in range(3)]
+        for days, filemeta in zip((3, 2, 1), files):
+            self.trash_items(days, files=[filemeta])
+
+        self.purge()
+        self.assertEqual(list(FileMeta.objects.filter(storage=self.trash)), [files[2]])
+        self.assertEqual(Storage.objects.get(pk=self.trash.pk).used_size, size)
+
+    def test_deletes_tombstone_objects(self):
+        from core.dedup import adopt_objects
+        from core.models import FileMeta, ObjectTombstone
+        from core.purge import flush_tombstones
+
+        single = self.create_file('single.txt')
+        docs = self.storage.create_dirmeta(name='docs')
+        nested = self.create_file('nested.txt', parent=docs)
+        shared = self.create_file('shared.txt')
+        adopt_objects([FileMeta.objects.get(pk=shared.pk)])
+
+        self.storage.delete_filemeta(id=single.id)
+        self.storage.delete_filemeta(id=shared.id)
+        self.storage.delete_dirmeta(id=docs.id)
+        self.assertEqual(
+            sorted(ObjectTombstone.objects.values_list('key', flat=True)), sorted([single.object_key, nested.object_key]))
+
+        self.assertEqual(flush_tombstones(), 2)
+        self.assertEqual(sorted(self.store.objects), [shared.object_key])
+
+    def test_undated_roots_wait_for_quota(self):
+        from core.models import FileMeta
+
+        size = self.trash.capacity_quota // 2 + 1
+        undated = self.create_file('undated.iso', size=size)
+        dated = self.create_file('dated.iso', size=size)
+        self.trash_items(40, files=[undated])
+        FileMeta.objects.filter(pk=undated.pk).update(trashed_at=None)
+        self.trash_items(1, files=[dated])
+
+        self.purge()
+        self.assertEqual(list(FileMeta.objects.filter(storage=self.trash)), [undated])
+
+    def test_shared_blobs_and_failed_deletes(self):
+        from core.batch import copy_items
+        from core.models import Blob, ObjectTombstone
+
+        shared = self.create_file('shared.txt')
+        target = self.storage.create_dirmeta(name='copies')
+        copy_items(self.storage, files=[shared.id], target=target)
+        lonely = self.create_file('lonely.txt')
+        self.trash_items(40, files=[shared, lonely])
+
+        failing = self.store.delete_many
+        self.store.delete_many = lambda keys: list(keys)
+        try:
+            self.purge()
+        finally:
+            self.store.delete_many = failing
+
+        # The copy keeps the shared object; the failed delete is retried
+        self.assertEqual(Blob.objects.get().refcount, 1)
+        self.assertEqual(list(ObjectTombstone.objects.values_list('key', flat=True)), [lonely.object_key])
+        self.assertIn('deleted 1 objects', self.purge())
+        self.assertEqual(list(self.store.objects), [shared.id.hex])
+
+
+class SearchTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+
+        mime_cache.invalidate()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+        self.docs = self.storage.create_dirmeta(name='docs')
+        self.reports = self.storage.create_dirmeta(parent=self.docs, name='reports')
+        for parent, name in (
+                (None, 'report.pdf'),
+                (self.reports, 'Annual Report 2016.pdf'),
+                (self.reports, 'quarterly-report.xlsx'),
+                (self.docs, 'holiday.jpg'),
+                (None, 'Report')):
+            self.storage.create_filemeta(parent=parent, name=name, size=1)
+
+    def tearDown(self):
+        del self.user
+
+    def search(self, query, **params):
+        response = self.client.get('/api/search/', dict(params, q=query))
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_substring(self):
+        data = self.search('report')
+        self.assertEqual(
+            [(item['name'], item['path']) for item in data['results']],
+            [('Report', '/Report'),
+             ('report.pdf', '/report.pdf'),
+             ('quarterly-report.xlsx', '/docs/reports/quarterly-report.xlsx'),
+             ('Annual Report 2016.pdf', '/docs/reports/Annual Report 2016.pdf')])
+        self.assertIsNone(data['next'])
+
+        data = self.search('REPORT', limit=3)
+        self.assertEqual(len(data['results']), 3)
+        data = self.search('REPORT', limit=3, cursor=data['next'])
+        self.assertEqual([item['name'] for item in data['results']], ['Annual Report 2016.pdf'])
+
+        self.assertEqual(self.search('ho')['results'][0]['name'], 'holiday.jpg')
+        self.assertEqual(self.search('100%')['results'], [])
+
+    def test_prefix_and_fuzzy(self):
+        self.assertEqual(
+            [item['name'] for item in self.search('rep', mode='prefix')['results']], ['Report', 'report.pdf'])
+        self.assertEqual(
+            [item['name'] for item in self.search('holday.jpg', mode='fuzzy')['results']], ['holiday.jpg'])
+        self.assertEqual(self.client.get('/api/search/', {'q': 'x', 'mode': 'regex'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/search/').status_code, 400)
+
+    def test_index_follows_changes(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from core.batch import copy_items
+        from core.models import FileMeta, NameToken
+
+        holiday = FileMeta.objects.get(name='holiday.jpg')
+        self.storage.rename_filemeta(parent=self.docs, id=holiday.id, name='vacation.jpg')
+        self.assertEqual(self.search('holiday')['results'], [])
+        self.assertEqual(self.search('vacation')['results'][0]['path'], '/docs/vacation.jpg')
+
+        copy_items(self.storage, dirs=[self.reports.id])
+        self.assertEqual(len(self.search('quarterly')['results']), 2)
+
+        self.storage.delete_dirmeta(id=self.docs.id)
+        self.assertEqual(len(self.search('quarterly')['results']), 1)
+
+        count = NameToken.objects.count()
+        NameToken.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('Indexed 4 files', out.getvalue())
+        self.assertEqual(NameToken.objects.count(), count)
+
+
+class BenchmarkMetadataTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        mime_cache.invalidate()
+
+    def test_report(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        from core.models import FileMeta
+
+        for shape in ('wide', 'deep'):
+            out = StringIO()
+            call_command(
+                'benchmark_metadata', '--users', '2', '--shape', shape, '--dirs', '30', '--files', '60',
+                '--depth', '10', '--iterations', '5', '--chunk-size', '40', stdout=out)
+            report = json.loads(out.getvalue())
+
+            self.assertEqual(report['load']['rows'], 180)
+            self.assertEqual(report['meta']['options']['shape'], shape)
+            browse = report['operations']['browse']
+            self.assertEqual(browse['count'], 5)
+            self.assertLessEqual(browse['p50_ms'], browse['p99_ms'])
+            self.assertLessEqual(report['operations']['total_size']['queries_max'], 1)
+            self.assertEqual(report['operations']['listing_rows']['queries_max'], 2)
+
+        # Rolled back unless --keep is given
+        self.assertFalse(User.objects.filter(username__startswith='bench-').exists())
+        self.assertFalse(FileMeta.objects.exists())
+
+
+class MetricsTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from rest_framework.test import APIClient
+        from core.listcache import get_listing_cache
+        from core.metrics import registry
+
+        mime_cache.invalidate()
+        get_listing_cache().clear()
+        registry.clear()
+        self.user = User.objects.create_user(username='metrics', password='qwe123123')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def scrape(self, **extra):
+        return self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret', **extra)
+
+    def test_storage_methods(self):
+        from django.db import connection
+        from core.metrics import registry
+
+        logged = len(connection.queries_log)
+        docs = self.storage.create_dirmeta(name='docs')
+        self.storage.create_filemeta(parent=docs, name='a.txt', size=1)
+        self.storage.browse_page(parent=docs)
+        self.assertFalse(docs.is_empty)
+
+        text = registry.render()
+        self.assertIn('cloud_method_queries_count{method="Storage.create_dirmeta"} 1', text)
+        self.assertIn('cloud_method_duration_seconds_count{method="Storage.browse_page"} 1', text)
+        self.assertIn('cloud_method_queries_bucket{method="Storage.browse_page",le="2"} 1', text)
+        self.assertIn('cloud_method_queries_bucket{method="DirMeta.is_empty",le="1"} 0', text)
+        # Queries logged only for the counts are dropped again
+        self.assertEqual(len(connection.queries_log), logged)
+
+    def test_full_query_log(self):
+        from django.db import connection
+        from core.metrics import QueryCapture
+
+        with QueryCapture() as expected:
+            self.storage.create_dirmeta(name='docs')
+
+        with self.settings(DEBUG=True):
+            connection.queries_log.extend({'sql': '', 'time': '0'} for index in range(connection.queries_log.maxlen))
+            with QueryCapture() as capture:
+                self.storage.create_dirmeta(name='photos')
+            self.assertEqual(len(capture.queries), len(expected.queries))
+            self.assertEqual(len(connection.queries_log), connection.queries_log.maxlen)
+        connection.queries_log.clear()
+
+    def test_requests(self):
+        self.storage.create_dirmeta(name='docs')
+        self.assertEqual(self.client.get('/api/browse/').status_code, 200)
+
+        response = self.scrape()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode('utf-8')
+        self.assertIn('cloud_requests_total{endpoint="browse-list",method="GET",status="200"} 1', text)
+        self.assertIn('cloud_request_serialization_seconds_count{endpoint="browse-list",method="GET"} 1', text)
+        self.assertIn('# TYPE cloud_request_queries histogram', text)
+        self.assertIn('cloud_request_queries_bucket{endpoint="browse-list",method="GET",le="+Inf"} 1', text)
+
+    def test_access(self):
+        from rest_framework.test import APIClient
+
+        self.assertEqual(APIClient().get('/metrics', REMOTE_ADDR='127.0.0.1').status_code, 403)
+        with self.settings(METRICS_TOKEN='secret'):
+            self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(APIClient().get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+            with self.settings(METRICS_ALLOWED_IPS=('10.0.0.2',)):
+                self.assertEqual(APIClient().get(
+                    '/metrics', HTTP_AUTHORIZATION='Bearer secret', REMOTE_ADDR='10.0.0.1').status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/metrics', REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+    @override_settings(METRICS_SLOW_REQUEST_SECONDS=0)
+    def test_slow_requests(self):
+        from core.metrics import registry
+
+        for name in ('a', 'b', 'c'):
+            self.storage.create_dirmeta(name=name)
+        with self.assertLogs('core.metrics', 'WARNING') as logs:
+            self.client.get('/api/browse/')
+
+        self.assertIn('Slow request GET /api/browse/ (browse-list)', logs.output[0])
+        self.assertIn('core_dirmeta', logs.output[0])
+        self.assertIn('cloud_slow_requests_total{endpoint="browse-list",method="GET"} 1', registry.render())
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        from core.metrics import registry
+
+        self.storage.create_dirmeta(name='docs')
+        self.client.get('/api/browse/')
+        self.assertNotIn('cloud_requests_total{', registry.render())
+
+
+class ListingTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from core.listcache import get_listing_cache
+
+        mime_cache.invalidate()
+        get_listing_cache().clear()
+        self.user = User.objects.create_user(username='listing', password='qwe123123')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+
+        self.docs = self.storage.create_dirmeta(name='docs')
+        self.empty = self.storage.create_dirmeta(name='empty')
+        self.storage.create_dirmeta(parent=self.docs, name='drafts')
+        for name in ('a.txt', 'b.pdf'):
+            self.storage.create_filemeta(parent=self.docs, name=name, size=1)
+        for index in range(6):
+            self.storage.create_filemeta(name='file-{}.jpg'.format(index), size=index)
+
+    def test_rows(self):
+        from core.listing import listing_page
+        from core.serializers import DirMetaSerializer, FileMetaSerializer
+
+        with self.assertNumQueries(2):
+            dirs, files, cursor = listing_page(self.storage, limit=100)
+        self.assertIsNone(cursor)
+
+        dirs = dict((item['name'], item) for item in dirs)
+        self.assertEqual((dirs['docs']['dir_count'], dirs['docs']['file_count'], dirs['docs']['is_empty']), (1, 2, False))
+        self.assertTrue(dirs['empty']['is_empty'])
+        self.assertEqual(files[0]['mime_type'], 'image/jpeg')
+
+        # Same fields and rendering as the model serializers
+        expected = dict(DirMetaSerializer(self.docs).data)
+        self.assertEqual(dict((name, dirs['docs'][name]) for name in expected), expected)
+        filemeta = self.storage.browse()[-1]
+        expected = dict(FileMetaSerializer(filemeta).data)
+        self.assertEqual(dict((name, files[-1][name]) for name in expected), expected)
+
+    def test_pages_match_browse_page(self):
+        from core.listing import listing_page
+
+        rows, cursor = [], None
+        while True:
+            dirs, files, cursor = listing_page(self.storage, cursor=cursor, limit=3)
+            self.assertLessEqual(len(dirs) + len(files), 3)
+            rows.extend(item['name'] for item in dirs + files)
+            if cursor is None:
+                break
+
+        objects, cursor = [], None
+        while True:
+            page, cursor = self.storage.browse_page(cursor=cursor, limit=3)
+            objects.extend(item.name for item in page)
+            if cursor is None:
+                break
+        self.assertEqual(rows, objects)
+        self.assertEqual(len(rows), 8)
+
+    def test_api(self):
+        from rest_framework.test import APIClient
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.get('/api/browse/', {'parent': self.docs.id, 'stats': 1})
+        self.assertEqual(response.status_code, 200)
+        drafts = response.data['directories'][0]
+        self.assertEqual((drafts['name'], drafts['is_empty'], drafts['dirs']), ('drafts', True, 0))
+        self.assertEqual([item['mime_type'] for item in response.data['files']], ['text/plain', 'application/pdf'])
+        self.assertEqual(response.data['files'][0]['thumbnails'], {})
+
+
+class PathResolveTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        mime_cache.invalidate()
+        self.user = User.objects.create_user(username='paths', password='qwe123123')
+        self.storage = self.user.profile.storage_set.get(storage_type=1)
+
+    def build(self):
+        self.photos = self.storage.create_dirmeta(name='photos')
+        self.year = self.storage.create_dirmeta(parent=self.photos, name='2016')
+        self.trip = self.storage.create_dirmeta(parent=self.year, name='trip')
+        self.image = self.storage.create_filemeta(parent=self.trip, name='img.jpg', size=1)
+        self.storage.create_filemeta(name='notes.txt', size=1)
+        # Same names elsewhere in the tree
+        music = self.storage.create_dirmeta(name='music')
+        self.storage.create_dirmeta(parent=music, name='2016')
+        self.storage.create_dirmeta(parent=self.storage.create_dirmeta(name='trip'), name='trip')
+
+    def check(self):
+        from core.paths import PathResolver, breadcrumbs
+
+        self.build()
+        with self.assertNumQueries(2):
+            self.assertEqual(self.storage.resolve('/photos/2016/trip/img.jpg'), self.image)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.storage.resolve('/photos/2016/trip/'), self.trip)
+        self.assertEqual(self.storage.resolve('notes.txt').name, 'notes.txt')
+        self.assertIsNone(self.storage.resolve('/photos/2016/trip/img.jpg/'))
+        self.assertIsNone(self.storage.resolve('/photos/2017/trip'))
+        self.assertIsNone(self.storage.resolve('/trip/img.jpg'))
+
+        resolver = PathResolver(self.storage)
+        with self.assertNumQueries(2):
+            found = resolver.resolve_many(['/photos/2016', '/music/2016', '/photos/2016/trip/img.jpg', '/nope'])
+        self.assertEqual(found['/photos/2016'], self.year)
+        self.assertEqual(found['/music/2016'].parent.name, 'music')
+        self.assertIsNone(found['/nope'])
+        # Known prefixes are not looked up again
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.resolve('/photos/2016/trip'), self.trip)
+
+        trip = self.storage.resolve('/photos/2016/trip')
+        with self.assertNumQueries(1):
+            self.assertEqual([node.name for node in breadcrumbs(trip)], ['photos', '2016'])
+        with self.assertNumQueries(1):
+            self.assertEqual([node.name for node in breadcrumbs(found['/photos/2016/trip/img.jpg'])],
+                             ['photos', '2016', 'trip'])
+
+    def test_mptt_backend(self):
+        self.check()
+
+    def test_path_backend(self):
+        with self.settings(CLOUD_TREE_BACKEND='core.tree.PathBackend'):
+            self.check()
+
+    def test_api(self):
+        from rest_framework.test import APIClient
+
+        self.build()
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+
+        response = client.get('/api/paths/', {'path': ['/photos/2016/trip/img.jpg', '/photos/2016', '/missing']})
+        self.assertEqual(response.status_code, 200)
+        image, year, missing = response.data['results']
+        self.assertEqual((image['type'], image['item']['id']), ('file', str(self.image.id)))
+        self.assertEqual([crumb['name'] for crumb in image['breadcrumbs']], ['photos', '2016', 'trip'])
+        self.assertEqual((year['type'], [crumb['name'] for crumb in year['breadcrumbs']]), ('dir', ['photos']))
+        self.assertIsNone(missing['item'])
+        self.assertEqual(client.get('/api/paths/').status_code, 400)
+
+        response = client.get('/api/dirs/{}/breadcrumbs/'.format(self.trip.id))
+        self.assertEqual([crumb['name'] for crumb in response.data['breadcrumbs']], ['photos', '2016'])
+        response = client.get('/api/files/{}/breadcrumbs/'.format(self.image.id))
+        self.assertEqual([crumb['name'] for crumb in response.data['breadcrumbs']], ['photos', '2016', 'trip'])
+
+
+class ProvisioningTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def test_storages(self):
+        with self.assertNumQueries(3):
+            user = User.objects.create_user(username='fresh', password='qwe123123')
+
+        profile = Profile.objects.get(user=user)
+        with self.assertNumQueries(1):
+            storages = (profile.main_storage(), profile.trash_storage(), profile.thumb_storage())
+            self.assertEqual([storage.storage_type for storage in storages], [1, 2, 3])
+            self.assertIs(storages[0].owner, profile)
+
+        Storage.objects.filter(owner=profile, storage_type=3).delete()
+        with self.assertRaises(Storage.DoesNotExist):
+            Profile.objects.get(user=user).thumb_storage()
+
+    def test_command(self):
+        from django.core.management import call_command
+        from django.utils.six import StringIO
+        import os
+        import tempfile
+
+        User.objects.create_user(username='taken')
+        rows = [
+            'username,email,password,service,language',
+            'alice,alice@localhost,secret123,2,en',
+            'alice,,,,',
+            'bob,,,,',
+            'taken,,,,',
+            'carol,,,9,',
+            ',,,,',
+        ] + ['user{},,,,'.format(index) for index in range(7)]
+
+        handle, path = tempfile.mkstemp(suffix='.csv')
+        with os.fdopen(handle, 'w') as csv_file:
+            csv_file.write('\n'.join(rows) + '\n')
+        try:
+            out, err = StringIO(), StringIO()
+            call_command('provision_users', path, '--batch-size', '4', '--hasher', 'pbkdf2_sha256',
+                         stdout=out, stderr=err)
+        finally:
+            os.remove(path)
+
+        self.assertIn('Created 9 accounts, skipped 1 existing and 3 invalid rows', out.getvalue())
+        self.assertIn('Line 3: duplicate username', err.getvalue())
+        self.assertIn('Line 6: unknown service', err.getvalue())
+        self.assertIn('Line 7: invalid username', err.getvalue())
+
+        alice = User.objects.get(username='alice')
+        self.assertTrue(alice.check_password('secret123'))
+        self.assertEqual(alice.profile.service_id, 2)
+        self.assertFalse(User.objects.get(username='bob').has_usable_password())
+        self.assertEqual(Storage.objects.filter(owner__user__username__startswith='user').count(), 21)
+        self.assertEqual(sorted(alice.profile.storages), [1, 2, 3])
+
+
+S3_XML = '<{0} xmlns="http://s3.amazonaws.com/doc/2006-03-01/">{1}</{0}>'
+
+
+class ScriptedPool(object):
+    # Stands in for the urllib3 pool of a MinioBackend. Requests are
+    # answered in order from (status, body) pairs; bucket location lookups
+    # are answered on the side.
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def urlopen(self, method, url, body=None, headers=None, preload_content=True, **kwargs):
+        from urllib.parse import urlparse, parse_qs
+        import io
+        import urllib3
+
+        url = urlparse(url)
+        if url.query == 'location':
+            status, data = 200, S3_XML.format('LocationConstraint', '')
+        else:
+            self.requests.append((method, url.path, parse_qs(url.query, keep_blank_values=True), body))
+            status, data = self.responses.pop(0)
+        return urllib3.HTTPResponse(io.BytesIO(data.encode('utf-8')), status=status, preload_content=preload_content)
+
+
+def s3_error(status, code):
+    return status, '<Error><Code>{}</Code><Message></Message></Error>'.format(code)
+
+
+@override_settings(OBJECT_STORE_RETRY_DELAY=0)
+class ObjectStoreTestCase(TestCase):
+
+    def setUp(self):
+        from core.metrics import registry
+        from core.objectstore import MemoryBackend
+
+        registry.clear()
+        self.store = MemoryBackend()
+
+    def test_retries(self):
+        from core.metrics import registry
+
+        self.store.inject('put', ConnectionError('reset'), times=2)
+        self.store.put('a', b'data')
+        self.assertEqual(self.store.get('a'), b'data')
+
+        self.store.inject('get', ConnectionError('reset'), times=4)
+        with self.assertRaises(ConnectionError):
+            self.store.get('a')
+        self.store.inject('get', ValueError('bad'))
+        with self.assertRaises(ValueError):
+            self.store.get('a')
+        self.assertEqual(self.store.get('a'), b'data')
+
+        text = registry.render()
+        self.assertIn('cloud_object_store_retries_total{operation="put"} 2', text)
+        self.assertIn('cloud_object_store_retries_total{operation="get"} 3', text)
+        self.assertIn('cloud_object_store_failures_total{operation="get"} 2', text)
+        self.assertIn('cloud_object_store_seconds_count{operation="put"} 3', text)
+
+    @override_settings(OBJECT_STORE_CONCURRENCY=4, OBJECT_STORE_RETRIES=0)
+    def test_batches(self):
+        keys = ['key-{}'.format(index) for index in range(20)]
+        self.store.put_many((key, key.encode('ascii')) for key in keys)
+
+        found = self.store.get_many(keys + ['missing'])
+        self.assertEqual(len(found), 20)
+        self.assertEqual(found['key-7'], b'key-7')
+        stats = self.store.stat_many(['key-1', 'missing'])
+        self.assertEqual(stats['key-1'].size, 5)
+        self.assertIsNone(stats['missing'])
+
+        self.store.inject('delete', ConnectionError('reset'))
+        failed = self.store.delete_many(keys)
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(sorted(self.store.objects), failed)
+
+    @override_settings(OBJECT_STORE_POOL_SIZE=7)
+    def test_minio_pool(self):
+        from core.objectstore import MinioBackend
+        import urllib3
+
+        store = MinioBackend()
+        self.assertEqual(store.client._http.connection_pool_kw['maxsize'], 7)
+        self.assertTrue(store.transient(urllib3.exceptions.ProtocolError('reset')))
+        self.assertFalse(store.transient(ValueError('bad')))
+
+    def test_minio_requests(self):
+        # Pins the private minio 2.0.4 helpers MinioBackend relies on
+        from core.metrics import registry
+        from core.objectstore import MinioBackend, PartInfo
+
+        part = '<PartNumber>1</PartNumber><LastModified>2017-01-01T00:00:00.000Z</LastModified>' \
+            '<ETag>"e1"</ETag><Size>5</Size>'
+        completed = '<Location>l</Location><Bucket>cloud</Bucket><Key>k</Key><ETag>"e"</ETag>'
+        listing = '<Name>cloud</Name><IsTruncated>{}</IsTruncated>{}<Contents><Key>{}</Key>' \
+            '<LastModified>2017-01-01T00:00:00.000Z</LastModified><ETag>"e"</ETag><Size>1</Size></Contents>'
+        store = MinioBackend()
+        pool = store.client._http = ScriptedPool(
+            (200, S3_XML.format('InitiateMultipartUploadResult', '<UploadId>up-1</UploadId>')),
+            (200, S3_XML.format('ListPartsResult', '<IsTruncated>false</IsTruncated><Part>{}</Part>'.format(part))),
+            (200, S3_XML.format('CompleteMultipartUploadResult', completed)),
+            s3_error(404, 'NoSuchUpload'),
+            s3_error(503, 'SlowDown'),
+            (200, 'data'),
+            (404, ''),
+            (200, S3_XML.format('ListBucketResult', listing.format(
+                'true', '<NextContinuationToken>t1</NextContinuationToken>', 'a'))),
+            (200, S3_XML.format('ListBucketResult', listing.format('false', '', 'b'))))
+
+        self.assertEqual(store.create_multipart('k'), 'up-1')
+        url = store.presigned_part_url('k', 'up-1', 2, 60)
+        self.assertIn('partNumber=2&uploadId=up-1&X-Amz-Signature=', url)
+        parts = store.list_parts('k', 'up-1')
+        self.assertEqual(parts, [PartInfo(1, 5, 'e1')])
+        store.complete_multipart('k', 'up-1', parts)
+        store.abort_multipart('k', 'up-1')
+        self.assertEqual(store.get('k'), b'data')
+        self.assertIsNone(store.stat('k'))
+        self.assertEqual([info.key for info in store.list_objects(start_after='0')], ['a', 'b'])
+
+        requests = [(method, path, query) for method, path, query, body in pool.requests]
+        self.assertEqual(requests, [
+            ('POST', '/cloud/k', {'uploads': ['']}),
+            ('GET', '/cloud/k', {'uploadId': ['up-1'], 'max-parts': ['1000']}),
+            ('POST', '/cloud/k', {'uploadId': ['up-1']}),
+            ('DELETE', '/cloud/k', {'uploadId': ['up-1']}),
+            ('GET', '/cloud/k', {}),
+            ('GET', '/cloud/k', {}),
+            ('HEAD', '/cloud/k', {}),
+            ('GET', '/cloud/', {'list-type': ['2'], 'max-keys': ['1000'], 'start-after': ['0']}),
+            ('GET', '/cloud/', {'list-type': ['2'], 'max-keys': ['1000'], 'start-after': ['0'],
+                                'continuation-token': ['t1']}),
+        ])
+        self.assertIn(b'<PartNumber>1</PartNumber><ETag>"e1"</ETag>', pool.requests[2][3])
+        self.assertIn('cloud_object_store_retries_total{operation="get"} 1', registry.render())
+
+    @unittest.skipUnless(os.environ.get('MINIO_TEST_BACKEND'), 'MINIO_TEST_BACKEND names no MinIO or S3 server')
+    def test_minio_server(self):
+        # e.g. MINIO_TEST_BACKEND=http://localhost:9000 with the MINIO_* keys
+        from core.objectstore import MinioBackend, ObjectNotFound
+
+        with self.settings(MINIO_BACKEND=os.environ['MINIO_TEST_BACKEND'], MINIO_BUCKET='cloud-test'):
+            store = MinioBackend()
+            if not store.client.bucket_exists(store.bucket):
+                store.client.make_bucket(store.bucket)
+
+            store.put_many([('a', b'first'), ('b', b'second')])
+            self.assertEqual(store.get_many(['a', 'b', 'c']), {'a': b'first', 'b': b'second'})
+            self.assertEqual(store.stat('b').size, 6)
+            self.assertEqual(b''.join(store.iter_range('b', 1, 3, 2)), b'eco')
+            self.assertEqual(store.delete_many(['a', 'b', 'c']), [])
+            with self.assertRaises(ObjectNotFound):
+                store.get('a')
+
+
+@override_settings(OBJECT_STORE_BACKEND='core.objectstore.MemoryBackend', RECONCILE_GRACE_SECONDS=3600)
+class ReconcileTestCase(TestCase):
+    fixtures = ['fixtures/services.yaml']
+
+    def setUp(self):
+        from core.objectstore import get_object_store
+
+        mime_cache.invalidate()
+        self.store = get_object_store()
+        self.store.clear()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='qwe123123',
+            email='testuser@localhost')
+        self.storage = self.user.profile.main_storage()
+
+    def tearDown(self):
+        del self.user
+
+    def create_file(self, name, stored=True):
+        filemeta = self.storage.create_filemeta(name=name, size=len(name))
+        if stored:
+            self.store.put(filemeta.object_key, name.encode('utf-8'))
+        return filemeta
+
+    def age(self, keys=(), files=()):
+        from datetime import timedelta
+        from django.utils import timezone
+        from core.models import FileMeta
+
+        for key in keys:
+            data, modified = self.store.objects[key]
+            self.store.objects[key] = (data, modified - 7200)
+        FileMeta.objects.filter(id__in=[filemeta.id for filemeta in files]).update(
+            created_at=timezone.now() - timedelta(hours=2))
+
+    def test_report(self):
+        import uuid
+        from core.models import Blob, ReconcileRun
+        from core.reconcile import latest_run, reconcile_objects
+
+        self.create_file('kept.txt')
+        dangling = self.create_file('dangling.txt', stored=False)
+        resized = self.create_file('resized.txt')
+        self.store.put(resized.object_key, b'different size')
+        Blob.objects.create(digest='a' * 64, key=uuid.uuid4().hex, size=3)
+        orphan = uuid.uuid4().hex
+        self.store.put(orphan, b'orphan')
+        self.age([orphan], [dangling])
+
+        reported = []
+        stats = reconcile_objects(latest_run(), batch_size=2, report=lambda *args: reported.append(args))
+        self.assertEqual(stats['keys'], 5)
+        self.assertEqual(stats['orphans'], 1)
+        self.assertEqual(stats['orphan_bytes'], 6)
+        self.assertEqual(stats['missing_files'], 1)
+        self.assertEqual(stats['missing_blobs'], 1)
+        self.assertEqual(stats['size_mismatches'], 1)
+        self.assertIn(('orphan', orphan, '6 bytes'), reported)
+        self.assertEqual(stats['deleted'] + stats['repaired'], 0)
+        self.assertIn(orphan, self.store.objects)
+        self.assertIsNotNone(ReconcileRun.objects.get().finished_at)
+
+    def test_repair(self):
+        import uuid
+        from core.models import FileMeta, Storage
+        from core.reconcile import latest_run, reconcile_objects
+
+        kept = self.create_file('kept.txt')
+        dangling = self.create_file('dangling.txt', stored=False)
+        recent = self.create_file('recent.txt', stored=False)
+        old, new = uuid.uuid4().hex, uuid.uuid4().hex
+        self.store.put(old, b'old')
+        self.store.put(new, b'new')
+        self.age([old, kept.object_key], [dangling, kept])
+
+        stats = reconcile_objects(latest_run(), batch_size=2, delete=True, repair=True)
+        self.assertEqual(stats['deleted'], 1)
+        self.assertEqual(stats['recent'], 1)
+        self.assertEqual(stats['repaired'], 1)
+        self.assertEqual(sorted(self.store.objects), sorted([kept.object_key, new]))
+        self.assertEqual(
+            set(FileMeta.objects.filter(storage=self.storage).values_list('id', flat=True)), {kept.id, recent.id})
+        self.assertEqual(Storage.objects.get(pk=self.storage.pk).file_count, 2)
+
+    def test_resume(self):
+        import uuid
+        from core.reconcile import latest_run, reconcile_objects
+
+        keys = sorted(uuid.uuid4().hex for index in range(6))
+        for key in keys:
+            self.store.put(key, b'x')
+        self.age(keys)
+
+        def crash(kind, key, detail):
+            if key == keys[2]:
+                raise RuntimeError('interrupted')
+
+        run = latest_run()
+        with self.assertRaises(RuntimeError):
+            reconcile_objects(run, batch_size=2, delete=True, report=crash)
+        self.assertEqual(sorted(self.store.objects), keys[2:])
+
+        resumed = latest_run()
+        self.assertEqual((resumed, resumed.last_key), (run, keys[1]))
+        stats = reconcile_objects(resumed, batch_size=2, delete=True)
+        self.assertEqual((stats['keys'], stats['deleted']), (6, 6))
+        self.assertEqual(self.store.objects, {})
+        self.assertNotEqual(latest_run(), run)
@@ -0,0 +1,247 @@
+# Django
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q, F, Count
+from django.utils import timezone
+
+# Core
+from core.models import (
+    FileMeta, ThumbnailJob, CATEGORY_VIDEO, STORAGE_THUMB,
+    JOB_PENDING, JOB_RUNNING, JOB_DONE, JOB_FAILED)
+from core.objectstore import get_object_store, ObjectNotFound
+from core.purge import flush_tombstones
+
+# Misc
+from datetime import timedelta
+import io
+import random
+import shutil
+import subprocess
+import time
+import uuid
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+class ThumbnailError(Exception):
+    # The source cannot be rendered; retrying will not help
+    pass
+
+
+def claim_jobs(limit):
+    # One conditional UPDATE claims the batch; rows another worker claimed
+    # first no longer match and are skipped. Jobs whose lease ran out are
+    # picked up again.
+    now = timezone.now()
+    due = Q(status=JOB_PENDING, run_after__lte=now) | Q(status=JOB_RUNNING, locked_until__lt=now)
+    ids = list(ThumbnailJob.objects.filter(due).order_by('run_after', 'id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+
+    claim = uuid.uuid4()
+    ThumbnailJob.objects.filter(due, id__in=ids).update(
+        status=JOB_RUNNING,
+        claim=claim,
+        attempts=F('attempts') + 1,
+        locked_until=now + timedelta(seconds=settings.THUMBNAIL_LEASE))
+    return list(ThumbnailJob.objects.filter(claim=claim).select_related(
+        'filemeta', 'filemeta__blob', 'filemeta__storage', 'filemeta__content_type'))
+
+
+def render_image(data, sizes):
+    if Image is None:
+        raise ThumbnailError('Pillow is not installed.')
+
+    try:
+        source = Image.open(io.BytesIO(data))
+        source.load()
+    except (IOError, SyntaxError, ValueError) as exc:
+        raise ThumbnailError(str(exc))
+
+    if source.mode not in ('RGB', 'L'):
+        source = source.convert('RGB')
+
+    rendered = {}
+    for size in sorted(sizes, reverse=True):
+        image = source.copy()
+        image.thumbnail((size, size), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'JPEG', quality=85)
+        rendered[size] = output.getvalue()
+    return rendered
+
+
+def render_video(url, sizes):
+    # ffmpeg reads the object through a presigned URL, so only the frame it
+    # needs is transferred
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise ThumbnailError('ffmpeg is not installed.')
+
+    try:
+        frame = subprocess.run(
+            [ffmpeg, '-v', 'error', '-ss', '1', '-i', url, '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=settings.THUMBNAIL_VIDEO_TIMEOUT, check=True)
+    except subprocess.CalledProcessError as exc:
+        raise ThumbnailError(exc.stderr.decode('utf-8', 'replace')[:1000])
+    return render_image(frame.stdout, sizes)
+
+
+def render(kind, source, sizes):
+    # Runs in a worker process; must not touch the database
+    if kind == CATEGORY_VIDEO:
+        return render_video(source, sizes)
+    return render_image(source, sizes)
+
+
+def load_source(filemeta):
+    store = get_object_store()
+    if filemeta.category == CATEGORY_VIDEO:
+        return store.presigned_get_url(filemeta.object_key, settings.THUMBNAIL_VIDEO_TIMEOUT + 60)
+
+    if filemeta.size > settings.THUMBNAIL_MAX_SOURCE_SIZE:
+        raise ThumbnailError('Source image is too large.')
+    return store.get(filemeta.object_key)
+
+
+def backoff(attempts):
+    delay = min(settings.THUMBNAIL_RETRY_DELAY * 2 ** (attempts - 1), settings.THUMBNAIL_RETRY_MAX_DELAY)
+    return timedelta(seconds=delay * random.uniform(0.5, 1.0))
+
+
+def fail_jobs(jobs, error, permanent=False):
+    now = timezone.now()
+    for job in jobs:
+        if permanent or job.attempts >= settings.THUMBNAIL_MAX_ATTEMPTS:
+            changes = {'status': JOB_FAILED}
+        else:
+            changes = {'status': JOB_PENDING, 'run_after': now + backoff(job.attempts)}
+        ThumbnailJob.objects.filter(pk=job.pk, claim=job.claim).update(
+            claim=None, locked_until=None, error=str(error)[:4096], **changes)
+
+
+def thumbnail_name(filemeta, size):
+    return '{}_{}.jpg'.format(filemeta.id.hex, size)
+
+
+def save_thumbnails(filemeta, jobs, rendered):
+    store = get_object_store()
+    storage = filemeta.storage.owner.thumb_storage()
+
+    with transaction.atomic():
+        thumbnails = []
+        for job in jobs:
+            data = rendered[job.size]
+            name = thumbnail_name(filemeta, job.size)
+
+            # A run that died after writing the thumbnail left it in place
+            thumbnail = FileMeta.objects.filter(storage=storage, parent=None, name=name).first()
+            if thumbnail is None:
+                thumbnail = storage.create_filemeta(name=name, size=len(data))
+            thumbnails.append((job, thumbnail, data))
+
+        # All sizes are uploaded in parallel
+        store.put_many([(thumbnail.object_key, data) for job, thumbnail, data in thumbnails])
+
+        for job, thumbnail, data in thumbnails:
+            ThumbnailJob.objects.filter(pk=job.pk, claim=job.claim).update(
+                status=JOB_DONE, thumbnail=thumbnail, claim=None, locked_until=None, error='')
+
+        # Cached listings of the parent now lack the thumbnails
+        filemeta.storage.touch(filemeta.parent)
+
+
+def process_jobs(jobs, pool):
+    # Jobs are grouped by file so each source is fetched and decoded once
+    # for all of its sizes.
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job.filemeta_id, []).append(job)
+
+    futures = []
+    for group in groups.values():
+        filemeta = group[0].filemeta
+        try:
+            source = load_source(filemeta)
+        except ObjectNotFound as exc:
+            fail_jobs(group, 'Object not found: {}'.format(exc))
+            continue
+        except ThumbnailError as exc:
+            fail_jobs(group, exc, permanent=True)
+            continue
+        futures.append((group, pool.submit(render, filemeta.category, source, [job.size for job in group])))
+
+    done = failed = 0
+    for group, future in futures:
+        try:
+            rendered = future.result()
+            save_thumbnails(group[0].filemeta, group, rendered)
+            done += len(group)
+        except ThumbnailError as exc:
+            fail_jobs(group, exc, permanent=True)
+            failed += len(group)
+        except Exception as exc:
+            fail_jobs(group, exc)
+            failed += len(group)
+
+    return done, failed
+
+
+def prune_thumbnails(batch_size=500):
+    # Thumbnails whose source is gone lost their job with it. Deleting them
+    # tombstones their objects, which are flushed at the end.
+    pruned = 0
+    while True:
+        thumbnails = list(FileMeta.objects.filter(
+            storage__storage_type=STORAGE_THUMB, thumbnail_sources__isnull=True).select_related('storage')[:batch_size])
+        for thumbnail in thumbnails:
+            thumbnail.storage.delete_filemeta(id=thumbnail.id)
+        pruned += len(thumbnails)
+        if len(thumbnails) < batch_size:
+            break
+
+    flush_tombstones()
+    return pruned
+
+
+def thumbnail_map(filemetas):
+    thumbnails = {}
+    jobs = ThumbnailJob.objects.filter(filemeta__in=filemetas, status=JOB_DONE).values_list(
+        'filemeta', 'size', 'thumbnail')
+    for filemeta_id, size, thumbnail_id in jobs:
+        if thumbnail_id is not None:
+            thumbnails.setdefault(filemeta_id, {})[str(size)] = thumbnail_id
+    return thumbnails
+
+
+def queue_stats():
+    return dict(ThumbnailJob.objects.order_by().values_list('status').annotate(count=Count('id')))
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.started = time.time()
+        self.done = self.failed = self.batches = 0
+
+    def add(self, done, failed):
+        self.batches += 1
+        self.done += done
+        self.failed += failed
+
+    @property
+    def rate(self):
+        seconds = time.time() - self.started
+        return self.done / seconds if seconds else 0.0
+
+    def as_dict(self):
+        return {
+            'batches': self.batches,
+            'done': self.done,
+            'failed': self.failed,
+            'seconds': round(time.time() - self.started, 3),
+            'thumbnails_per_second': round(self.rate, 2),
+        }
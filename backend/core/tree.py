@@ -0,0 +1,165 @@
+# Django
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Case, When, F, Value, TextField
+from django.db.models.functions import Concat, Substr
+from django.utils.module_loading import import_string
+from django.utils.translation import ugettext_lazy as _
+
+# Misc
+import contextlib
+import uuid
+
+DEFAULT_TREE_BACKEND = 'core.tree.MPTTBackend'
+
+BACKENDS = {}
+
+
+def get_tree_backend():
+    path = getattr(settings, 'CLOUD_TREE_BACKEND', DEFAULT_TREE_BACKEND)
+    if path not in BACKENDS:
+        BACKENDS[path] = import_string(path)()
+    return BACKENDS[path]
+
+
+def node_path(node, parent):
+    # Materialized path: the hex ids of every ancestor and the node itself
+    return (parent.path if parent is not None else '') + node.id.hex + '/'
+
+
+def path_ids(path):
+    return [uuid.UUID(segment) for segment in path.split('/') if segment]
+
+
+def rebuild_paths(model, batch_size=300):
+    # Rebuilds materialized paths level by level; each row reads the
+    # already rebuilt path of its parent through a join.
+    level = 0
+    while model.objects.filter(level=level).exists():
+        last_id = None
+        while True:
+            queryset = model.objects.filter(level=level).order_by('id')
+            if last_id is not None:
+                queryset = queryset.filter(id__gt=last_id)
+            rows = list(queryset.values_list('id', 'parent__path')[:batch_size])
+            if not rows:
+                break
+
+            last_id = rows[-1][0]
+            with transaction.atomic():
+                model.objects.filter(id__in=[id for id, parent_path in rows]).update(path=Case(
+                    *[When(id=id, then=Value((parent_path or '') + id.hex + '/')) for id, parent_path in rows],
+                    output_field=TextField()))
+        level += 1
+
+
+class TreeBackend(object):
+    name = None
+
+    # Whether lft/rght/tree_id describe the real tree and may be used
+    # for range queries
+    nested_sets = False
+
+    # SQL condition matching directory "p" inside the subtree of directory "d"
+    subtree_sql = None
+
+    # Unique fields listing a tree in depth-first order, parents first
+    ordering = None
+
+    def updates(self, model):
+        raise NotImplementedError
+
+    def tree_key(self, node):
+        raise NotImplementedError
+
+    def ancestors(self, node, include_self=False):
+        raise NotImplementedError
+
+    def descendants(self, node, include_self=False):
+        raise NotImplementedError
+
+    def move(self, node, target):
+        raise NotImplementedError
+
+    def delete(self, node):
+        raise NotImplementedError
+
+    def check_move(self, node, target):
+        if target is not None and target.path.startswith(node.path):
+            raise ValidationError(_('A directory cannot be moved into itself.'))
+
+    def rewrite_paths(self, node, target, levels=False):
+        old_path = node.path
+        new_path = node_path(node, target)
+        subtree = type(node).objects.filter(path__startswith=old_path)
+
+        changes = {'path': Concat(Value(new_path), Substr('path', len(old_path) + 1), output_field=TextField())}
+        if levels:
+            changes['level'] = F('level') + (new_path.count('/') - old_path.count('/'))
+        subtree.update(**changes)
+
+        node.path = new_path
+
+
+class MPTTBackend(TreeBackend):
+    name = 'mptt'
+    nested_sets = True
+    subtree_sql = 'p.tree_id = d.tree_id AND p.lft >= d.lft AND p.rght <= d.rght'
+    ordering = ('tree_id', 'lft')
+
+    def updates(self, model):
+        return contextlib.ExitStack()
+
+    def tree_key(self, node):
+        return node.tree_id
+
+    def ancestors(self, node, include_self=False):
+        return node.get_ancestors(include_self=include_self)
+
+    def descendants(self, node, include_self=False):
+        return node.get_descendants(include_self=include_self)
+
+    def move(self, node, target):
+        self.check_move(node, target)
+        self.rewrite_paths(node, target)
+        node.move_to(target, 'last-child')
+
+    def delete(self, node):
+        node.delete()
+
+
+class PathBackend(TreeBackend):
+    # Inserts and moves only touch the rows they change; nested set
+    # fields are left stale until a rebuild.
+    name = 'path'
+    subtree_sql = "p.path LIKE d.path || '%%'"
+    ordering = ('path',)
+
+    def updates(self, model):
+        return model.objects.disable_mptt_updates()
+
+    def tree_key(self, node):
+        return node.path.split('/', 1)[0]
+
+    def ancestors(self, node, include_self=False):
+        ids = path_ids(node.path)
+        if not include_self:
+            ids = ids[:-1]
+        return type(node).objects.filter(id__in=ids).order_by('level')
+
+    def descendants(self, node, include_self=False):
+        queryset = type(node).objects.filter(path__startswith=node.path)
+        if not include_self:
+            queryset = queryset.exclude(pk=node.pk)
+        return queryset
+
+    def move(self, node, target):
+        self.check_move(node, target)
+        self.rewrite_paths(node, target, levels=True)
+        type(node).objects.filter(pk=node.pk).update(parent=target)
+        node.parent = target
+        node.level = node.path.count('/') - 1
+
+    def delete(self, node):
+        type(node).objects.filter(pk=node.pk).delete()
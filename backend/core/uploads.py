@@ -0,0 +1,136 @@
+# Django
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+# Core
+from core.dedup import deduplicate_upload
+from core.models import FileMeta, UploadSession
+from core.objectstore import get_object_store, ObjectNotFound
+
+# Misc
+from datetime import timedelta
+import uuid
+
+
+def session_expiry():
+    return timezone.now() + timedelta(seconds=settings.UPLOAD_SESSION_EXPIRES)
+
+
+def choose_part_size(size, part_size=None):
+    part_size = part_size or settings.UPLOAD_PART_SIZE
+    part_size = max(settings.UPLOAD_MIN_PART_SIZE, min(part_size, settings.UPLOAD_MAX_PART_SIZE))
+
+    # Grow the parts rather than exceed the object store's part limit
+    return max(part_size, -(-size // settings.UPLOAD_MAX_PARTS))
+
+
+def check_upload(storage, parent, name, size):
+    if not storage.has_space_for(size):
+        raise ValidationError({'size': [_('Storage quota exceeded.')]})
+    if FileMeta.objects.filter(storage=storage, parent=parent, name=name).exists():
+        raise ValidationError({'name': [_('Duplicate file name.')]})
+
+
+def create_session(storage, parent=None, **kwargs):
+    name = kwargs['name']
+    size = kwargs['size']
+    check_upload(storage, parent, name, size)
+
+    id = uuid.uuid4()
+    return UploadSession.objects.create(
+        id=id,
+        storage=storage,
+        parent=parent,
+        name=name,
+        size=size,
+        part_size=choose_part_size(size, kwargs.get('part_size', None)),
+        upload_id=get_object_store().create_multipart(id.hex),
+        expires_at=session_expiry())
+
+
+def sign_parts(session, numbers):
+    invalid = [number for number in numbers if not 1 <= number <= session.part_count]
+    if invalid:
+        raise ValidationError({'numbers': [_('Invalid part numbers: %s.') % ', '.join(map(str, invalid))]})
+
+    # Any activity keeps an upload alive
+    UploadSession.objects.filter(pk=session.pk).update(expires_at=session_expiry())
+
+    store = get_object_store()
+    expires = settings.UPLOAD_URL_EXPIRES
+    return [
+        {'number': number, 'url': store.presigned_part_url(session.object_key, session.upload_id, number, expires)}
+        for number in sorted(set(numbers))]
+
+
+def session_parts(session):
+    try:
+        return get_object_store().list_parts(session.object_key, session.upload_id)
+    except ObjectNotFound:
+        raise ValidationError({'id': [_('Upload not found.')]})
+
+
+def complete_session(session):
+    store = get_object_store()
+
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().select_related('storage').get(pk=session.pk)
+        storage = session.storage
+        if session.expires_at < timezone.now():
+            raise ValidationError({'id': [_('Upload session expired.')]})
+
+        parts = session_parts(session)
+        missing = session.missing_parts(parts)
+        if missing:
+            raise ValidationError({'parts': [_('Missing or incomplete parts: %s.') % ', '.join(map(str, missing))]})
+
+        # Checked before the parts are stitched together so a failed
+        # completion leaves the session resumable
+        check_upload(storage, session.parent, session.name, session.size)
+
+        store.complete_multipart(
+            session.object_key, session.upload_id,
+            [part for part in parts if part.number <= session.part_count])
+
+        try:
+            filemeta = storage.create_filemeta(
+                parent=session.parent,
+                id=session.id,
+                name=session.name,
+                size=session.size)
+        except ValidationError:
+            store.delete(session.object_key)
+            raise
+
+        session.delete()
+
+    deduplicate_upload(filemeta)
+    return filemeta
+
+
+def abort_session(session):
+    get_object_store().abort_multipart(session.object_key, session.upload_id)
+    session.delete()
+
+
+def expire_sessions(now=None, batch_size=100):
+    # Expired sessions are aborted in the object store first, so a crash
+    # midway leaves rows that the next run picks up again.
+    now = now or timezone.now()
+    store = get_object_store()
+    expired = 0
+
+    while True:
+        sessions = list(UploadSession.objects.filter(expires_at__lt=now).order_by('expires_at')[:batch_size])
+        if not sessions:
+            break
+
+        for session in sessions:
+            store.abort_multipart(session.object_key, session.upload_id)
+        UploadSession.objects.filter(id__in=[session.id for session in sessions]).delete()
+        expired += len(sessions)
+
+    return expired
@@ -1,3 +1,28 @@
-from django.shortcuts import render
+# Django
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import HttpResponse
 
-# Create your views here.
+# Core
+from core.metrics import registry, CONTENT_TYPE
+
+# Misc
+import hmac
+
+
+def scraper_allowed(request):
+    # Scrapers send METRICS_TOKEN as a bearer token, from METRICS_ALLOWED_IPS
+    # when that is set. Behind a local proxy every address looks alike, so
+    # an address alone is never enough.
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if not settings.METRICS_TOKEN or not header.startswith('Bearer '):
+        return False
+    if settings.METRICS_ALLOWED_IPS and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return False
+    return hmac.compare_digest(header[len('Bearer '):].encode('utf-8'), settings.METRICS_TOKEN.encode('utf-8'))
+
+
+def metrics(request):
+    if not request.user.is_staff and not scraper_allowed(request):
+        raise PermissionDenied
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)